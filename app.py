@@ -1,164 +1,661 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, session, flash, jsonify
 import sqlite3
 import os
 import time
+import calendar
+import mimetypes
+import threading
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from cryptography.fernet import Fernet
-
-app = Flask(__name__)
-app.secret_key = 'local_secret_key_2026'
-
-ENCRYPTION_KEY = b'uX6-f1vE0zP_kYQ-jD2pL_9a_N3b_C4d_E5f_G6h_I7='
-cipher = Fernet(ENCRYPTION_KEY)
+from werkzeug.wsgi import FileWrapper
+from encryption import FLAG_FILE_ENCRYPTED, encrypt_payload, decrypt_payload, decrypt_legacy, parse_legacy_file
+from file_crypto import FileCipher
+from reencrypt import start_worker
+from write_queue import MessageWriter
+from db_pool import ReadPool
+from ephemeral import TypingTracker
+from upload_paths import fanout_path
+from chunked_upload import CHUNK_SIZE, CHUNKED_THRESHOLD, UploadError, UploadStaging
+from expiry import EXPIRES_INDEX_SQL, TTL_CHOICES, ExpirySweeper, delete_expired, not_expired
+from maintenance import MaintenanceScheduler, claim, run_all
+from search_index import SearchIndex
+from http_compression import init_compression
+from rate_limit import init_rate_limit, next_poll_ms
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATABASE = os.path.join(BASE_DIR, 'data1.db')
-UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static/uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'txt', 'docx', 'zip'}
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+DEFAULT_CONFIG = {
+    'SECRET_KEY': os.environ.get('SECRET_KEY', 'local_secret_key_2026'),
+    'DATABASE': os.path.join(BASE_DIR, 'data1.db'),
+    'UPLOAD_FOLDER': os.path.join(BASE_DIR, 'static/uploads'),
+    # Недокачанные части больших файлов - не под static, чтобы их нельзя было открыть по ссылке
+    'UPLOAD_STAGING': os.path.join(BASE_DIR, 'upload_staging'),
+    'UPLOAD_MAX_SIZE': 64 * 1024 * 1024,
+    # Новые файлы хранятся зашифрованными (file_crypto.py) и отдаются через /api/files/<id>
+    'ENCRYPT_UPLOADS': True,
+    # Поисковый индекс: отдельный файл с HMAC слов вместо открытого текста
+    'SEARCH_DATABASE': os.path.join(BASE_DIR, 'search.db'),
+    # Лимиты запросов: endpoint -> (запросов в секунду, запас). Общий для всех
+    # воркеров счетчик - путь к файлу SQLite в RATE_LIMIT_STORAGE
+    'RATE_LIMITS': {
+        'main.get_messages': (2, 10),
+        'main.send': (5, 20),
+        'main.send_bulk': (0.5, 3),
+        'main.upload': (1, 5),
+        'main.search': (2, 10),
+        'main.typing': (1, 3),
+        'main.start_upload': (1, 5),
+        'main.upload_chunk': (10, 40),
+    },
+    'RATE_LIMIT_STORAGE': os.environ.get('RATE_LIMIT_STORAGE'),
+    # Соединений mode=ro на процесс для запросов на чтение (не меньше WEB_THREADS)
+    'READ_POOL_SIZE': 8,
+    # Раз в сколько секунд удалять истекшие исчезающие сообщения (0 - не удалять в этом процессе)
+    'EXPIRY_SWEEP_INTERVAL': 30,
+    'EXPIRY_SWEEP_BATCH': 500,
+    # Раз в сколько секунд ANALYZE, возврат свободных страниц и checkpoint (0 - не в этом процессе);
+    # тихое время - не больше MAINTENANCE_QUIET_MESSAGES сообщений за минуту
+    'MAINTENANCE_INTERVAL': 600,
+    'MAINTENANCE_QUIET_MESSAGES': 30,
+    # Подготовить схему и шаблоны сразу в create_app (для gunicorn --preload)
+    'PRELOAD': False,
+}
+
+bp = Blueprint('main', __name__)
 
-def get_db():
-    conn = sqlite3.connect(DATABASE)
+def get_db(database=None):
+    """Соединение на запись мимо очереди - только для схемы и обслуживания"""
+    conn = sqlite3.connect(database or current_app.config['DATABASE'], timeout=5)
     conn.row_factory = sqlite3.Row
+    # В режиме WAL fsync при каждом commit не нужен для целостности
+    conn.execute('PRAGMA synchronous = NORMAL')
     return conn
 
+def init_db(database):
+    conn = get_db(database)
+    c = conn.cursor()
+    # Освобожденные страницы возвращаются по шагам (maintenance.py); действует только
+    # на новую базу, существующую переводит python maintenance.py --convert
+    c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    # WAL: читатели не блокируют писателя, несколько воркеров работают с одним файлом
+    c.execute('PRAGMA journal_mode = WAL')
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        last_seen INTEGER DEFAULT 0)''')
+    c.execute('CREATE TABLE IF NOT EXISTS friends (user_id INTEGER, friend_id INTEGER)')
+    # Дружба хранится одной канонической парой (user_a <= user_b) вместо двух
+    # направленных строк в friends; каждую сторону обслуживает свой индекс
+    friendships_exists = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'friendships'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS friendships (
+        user_a INTEGER NOT NULL, user_b INTEGER NOT NULL,
+        PRIMARY KEY (user_a, user_b)) WITHOUT ROWID''')
+    # Срок жизни новых сообщений диалога в секундах, 0 - хранить всегда
+    try:
+        c.execute('ALTER TABLE friendships ADD COLUMN message_ttl INTEGER DEFAULT 0')
+    except sqlite3.OperationalError:
+        pass
+    c.execute('CREATE INDEX IF NOT EXISTS idx_friendships_b ON friendships (user_b, user_a)')
+    if not friendships_exists:
+        c.execute('''INSERT OR IGNORE INTO friendships (user_a, user_b)
+            SELECT MIN(user_id, friend_id), MAX(user_id, friend_id) FROM friends''')
+    # text - старый формат (base64-токен), body - сырой шифротекст
+    c.execute('''CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER, receiver_id INTEGER,
+        text TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        body BLOB, msg_type TEXT DEFAULT 'text', file_url TEXT, flags INTEGER DEFAULT 0,
+        key_version INTEGER DEFAULT 1, expires_at INTEGER)''')
+    for column in ("body BLOB", "msg_type TEXT DEFAULT 'text'", "file_url TEXT", "flags INTEGER DEFAULT 0",
+                   "key_version INTEGER DEFAULT 1", "expires_at INTEGER"):
+        try:
+            c.execute(f'ALTER TABLE messages ADD COLUMN {column}')
+        except sqlite3.OperationalError:
+            pass
+    # expires_at - unix-время удаления исчезающего сообщения, NULL - бессрочное
+    c.execute(EXPIRES_INDEX_SQL)
+    # Какие файлы загрузок еще нужны сообщениям (upload_gc.py)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_file ON messages (file_url) WHERE file_url IS NOT NULL')
+    conn.commit()
+    conn.close()
+
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """Все одиночные INSERT сообщений идут через один поток с групповым commit.
+
+    Поток создается при первой записи - уже в воркере, а не в мастере до fork.
+    """
+    writer = current_app.extensions.get('message_writer')
+    if writer is None:
+        with _writer_lock:
+            writer = current_app.extensions.get('message_writer')
+            if writer is None:
+                writer = MessageWriter(current_app.config['DATABASE'])
+                current_app.extensions['message_writer'] = writer
+    return writer
+
+# Срок жизни берется из дружбы в той же транзакции, что и INSERT: ?1 - отправитель, ?2 - получатель
+EXPIRES_SQL = '''(SELECT CAST(strftime('%s', 'now') AS INTEGER) + message_ttl FROM friendships
+    WHERE user_a = MIN(?1, ?2) AND user_b = MAX(?1, ?2) AND message_ttl > 0)'''
+INSERT_MESSAGE_SQL = f'INSERT INTO messages (sender_id, receiver_id, body, flags, key_version, expires_at) VALUES (?1, ?2, ?3, ?4, ?5, {EXPIRES_SQL})'
+INSERT_FILE_SQL = f'INSERT INTO messages (sender_id, receiver_id, msg_type, file_url, flags, expires_at) VALUES (?1, ?2, ?3, ?4, ?5, {EXPIRES_SQL})'
+
+def remove_upload(upload_folder, file_url):
+    """Удаляет файл сообщения из папки загрузок (если он там)"""
+    if not file_url or not file_url.startswith('/static/uploads/'): return
+    relative = file_url[len('/static/uploads/'):]
+    if '..' in relative.split('/'): return
+    try: os.remove(os.path.join(upload_folder, relative))
+    except FileNotFoundError: pass
+
+def sweep_expired(app):
+    """Одна пачка истекших сообщений: строки, их файлы и записи поискового индекса"""
+    with app.app_context():
+        rows = get_writer().transaction(delete_expired, int(time.time()), app.config['EXPIRY_SWEEP_BATCH'], 'id, file_url')
+        for _, file_url in rows:
+            remove_upload(app.config['UPLOAD_FOLDER'], file_url)
+        if rows:
+            search_index().remove_many([r[0] for r in rows])
+    return len(rows)
+
+@bp.before_app_request
+def start_expiry_sweeper():
+    # Поток запускается при первом запросе - уже в воркере, а не в мастере до fork
+    if 'expiry_sweeper' in current_app.extensions or not current_app.config['EXPIRY_SWEEP_INTERVAL']:
+        return
+    with _writer_lock:
+        if 'expiry_sweeper' not in current_app.extensions:
+            app = current_app._get_current_object()
+            sweeper = ExpirySweeper(lambda: sweep_expired(app), app.config['EXPIRY_SWEEP_INTERVAL'])
+            app.extensions['expiry_sweeper'] = sweeper
+            sweeper.start()
+
+def run_maintenance(app):
+    """Проход обслуживания базы и поискового индекса; None - его недавно сделал другой воркер"""
+    with app.app_context():
+        writer = get_writer()
+        if not writer.transaction(claim, app.config['MAINTENANCE_INTERVAL']):
+            return None
+        index = search_index()
+        return run_all([app.config['DATABASE'], index.path], [writer.transaction, index.writer.transaction],
+                       app.config['MAINTENANCE_QUIET_MESSAGES'])
+
+@bp.before_app_request
+def start_maintenance():
+    if 'maintenance' in current_app.extensions or not current_app.config['MAINTENANCE_INTERVAL']:
+        return
+    with _writer_lock:
+        if 'maintenance' not in current_app.extensions:
+            app = current_app._get_current_object()
+            scheduler = MaintenanceScheduler(lambda: run_maintenance(app), app.config['MAINTENANCE_INTERVAL'])
+            app.extensions['maintenance'] = scheduler
+            scheduler.start()
+
+def read_db():
+    """Соединение только для чтения из пула; conn.close() возвращает его в пул"""
+    return current_app.extensions['read_pool'].get()
+
+@bp.teardown_app_request
+def release_read_db(exc):
+    # Соединение, не закрытое из-за исключения в обработчике, возвращается в пул здесь
+    current_app.extensions['read_pool'].release_held()
+
+FRIENDS_SQL = 'SELECT user_b AS id FROM friendships WHERE user_a = ? UNION SELECT user_a FROM friendships WHERE user_b = ?'
+
+def friend_ids(conn, user_id):
+    return {r['id'] for r in conn.execute(FRIENDS_SQL, (user_id, user_id))}
+
+def message_content(row):
+    """Возвращает (type, text, url) для строки messages в любом из форматов."""
+    if row['body'] is None and row['file_url'] is None:
+        # Строка еще не прошла migrate_payloads.py
+        txt = decrypt_legacy(row['text'], row['key_version'])
+        file_info = parse_legacy_file(txt)
+        if file_info:
+            return file_info[0], '', file_info[1]
+        return 'text', txt, None
+    if row['msg_type'] != 'text':
+        if row['flags'] & FLAG_FILE_ENCRYPTED:
+            # Зашифрованный файл открывается только через расшифровку с проверкой доступа
+            return row['msg_type'], '', f"/api/files/{row['id']}"
+        return row['msg_type'], '', row['file_url']
+    return 'text', decrypt_payload(row['body'], row['flags'], row['key_version']), None
+
+def search_index():
+    return current_app.extensions['search_index']
+
+def typing_tracker():
+    return current_app.extensions['typing']
+
+def file_cipher():
+    return current_app.extensions['file_cipher']
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.before_request
+# "В сети" - это last_seen за последние 60 секунд, поэтому писать его
+# чаще раза в LAST_SEEN_INTERVAL секунд на пользователя незачем
+LAST_SEEN_INTERVAL = 15
+# Время последней записи по пользователям; больше стольких записей - старые выбрасываются
+LAST_SEEN_MAX_USERS = 10000
+_last_seen_written = {}
+
+@bp.before_app_request
 def update_last_seen():
     if 'user_id' in session:
-        conn = get_db()
-        conn.execute('UPDATE users SET last_seen = ? WHERE id = ?', (int(time.time()), session['user_id']))
-        conn.commit()
-        conn.close()
+        now = int(time.time())
+        if now - _last_seen_written.get(session['user_id'], 0) < LAST_SEEN_INTERVAL:
+            return
+        if len(_last_seen_written) >= LAST_SEEN_MAX_USERS:
+            # Отметки старше LAST_SEEN_INTERVAL уже ничего не запрещают
+            for user_id, written in list(_last_seen_written.items()):
+                if now - written >= LAST_SEEN_INTERVAL:
+                    _last_seen_written.pop(user_id, None)
+        _last_seen_written[session['user_id']] = now
+        # Ответ не ждет записи: отметка "в сети" уходит в очередь писателя
+        get_writer().submit('UPDATE users SET last_seen = ? WHERE id = ?', (now, session['user_id']))
+
+def seconds_since(timestamp):
+    """Сколько секунд прошло с CURRENT_TIMESTAMP из SQLite (UTC, 'YYYY-MM-DD HH:MM:SS')"""
+    return time.time() - calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%d %H:%M:%S'))
 
-@app.route('/')
+@bp.route('/')
 def index():
-    if 'user_id' not in session: return redirect(url_for('login'))
+    if 'user_id' not in session: return redirect(url_for('.login'))
     user_id = session['user_id']
-    conn = get_db()
-    friends_rows = conn.execute('''
+    conn = read_db()
+    friends_rows = conn.execute(f'''
         SELECT u.id, u.username FROM users u
-        JOIN friends f ON u.id = f.friend_id
-        WHERE f.user_id = ?
-    ''', (user_id,)).fetchall()
+        JOIN ({FRIENDS_SQL}) f ON u.id = f.id
+    ''', (user_id, user_id)).fetchall()
     conn.close()
     friends = [{'id': r['id'], 'username': "⭐ Избранное" if r['id'] == user_id else r['username']} for r in friends_rows]
-    return render_template('index.html', username=session['username'], friends=friends)
+    return render_template('index.html', username=session['username'], friends=friends,
+                           chunked_threshold=CHUNKED_THRESHOLD)
+
+COMPACT_FIELDS = ('id', 'type', 'text', 'url', 'time', 'is_me')
 
-@app.route('/api/messages/<int:friend_id>')
+@bp.route('/api/messages/<int:friend_id>')
 def get_messages(friend_id):
     u_id = session.get('user_id')
-    conn = get_db()
+    conn = read_db()
     friend = conn.execute('SELECT username, last_seen FROM users WHERE id = ?', (friend_id,)).fetchone()
+    if friend is None:
+        conn.close()
+        return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
     is_online = (int(time.time()) - (friend['last_seen'] or 0)) < 60
-    rows = conn.execute('''
-        SELECT id, sender_id, text, timestamp FROM messages 
-        WHERE (sender_id=? AND receiver_id=?) OR (sender_id=? AND receiver_id=?)
+    rows = conn.execute(f'''
+        SELECT id, sender_id, text, timestamp, body, msg_type, file_url, flags, key_version FROM messages 
+        WHERE ((sender_id=? AND receiver_id=?) OR (sender_id=? AND receiver_id=?)) AND {not_expired()}
         ORDER BY timestamp ASC''', (u_id, friend_id, friend_id, u_id)).fetchall()
+    ttl = conn.execute('SELECT message_ttl FROM friendships WHERE user_a = ? AND user_b = ?',
+                       (min(u_id, friend_id), max(u_id, friend_id))).fetchone()
     conn.close()
+    # ?compact=1 - сообщения массивами в порядке COMPACT_FIELDS, без повторения ключей
+    compact = request.args.get('compact', type=int)
     msgs = []
     for r in rows:
-        try: txt = cipher.decrypt(r.encode()).decode()
-        except: txt = "[Ошибка расшифровки]"
-        msgs.append({"id": r['id'], "text": txt, "time": r['timestamp'][11:16], "is_me": r['sender_id'] == u_id})
-    return jsonify({"messages": msgs, "friend_name": "Избранное" if friend_id == u_id else friend['username'], "online": is_online})
+        try: msg_type, txt, url = message_content(r)
+        except: msg_type, txt, url = 'text', "[Ошибка расшифровки]", None
+        if compact: msgs.append([r['id'], msg_type, txt, url, r['timestamp'][11:16], int(r['sender_id'] == u_id)])
+        else: msgs.append({"id": r['id'], "type": msg_type, "text": txt, "url": url, "time": r['timestamp'][11:16], "is_me": r['sender_id'] == u_id})
+    # Подсказка клиенту: затихший диалог можно опрашивать реже, но если собеседник
+    # печатает - часто, чтобы сообщение появилось сразу
+    typing = friend_id != u_id and typing_tracker().is_typing(friend_id, u_id)
+    idle = 0 if typing else seconds_since(rows[-1]['timestamp']) if rows else None
+    return jsonify({"messages": msgs, "friend_name": "Избранное" if friend_id == u_id else friend['username'], "online": is_online,
+                    "typing": typing, "ttl": (ttl[0] or 0) if ttl else 0, "next_poll_ms": next_poll_ms(idle)})
 
-@app.route('/api/send', methods=['POST'])
+@bp.route('/api/send', methods=['POST'])
 def send():
-    data = request.json
-    enc_text = cipher.encrypt(data.encode()).decode()
-    conn = get_db()
-    conn.execute('INSERT INTO messages (sender_id, receiver_id, text) VALUES (?, ?, ?)', (session['user_id'], data['receiver_id'], enc_text))
-    conn.commit()
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict): return jsonify({"status": "error"}), 400
+    text = data.get('text')
+    try: receiver_id = int(data.get('receiver_id'))
+    except (TypeError, ValueError): return jsonify({"status": "error"}), 400
+    if not isinstance(text, str):
+        return jsonify({"status": "error", "message": "Текст сообщения должен быть строкой"}), 400
+    if not text:
+        return jsonify({"status": "error", "message": "Пустое сообщение"}), 400
+    user_id = session['user_id']
+    body, flags, key_version = encrypt_payload(text)
+    msg_id = get_writer().execute(INSERT_MESSAGE_SQL, (user_id, receiver_id, body, flags, key_version))
+    search_index().add(msg_id, user_id, receiver_id, text)
+    typing_tracker().stop(user_id, receiver_id)
+    return jsonify({"status": "ok", "id": msg_id})
+
+@bp.route('/api/typing', methods=['POST'])
+def typing():
+    """Отметка "печатаю" для собеседника: только в памяти, не чаще раза в TYPING_THROTTLE секунд"""
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    try: receiver_id = int((request.json or {}).get('receiver_id'))
+    except (TypeError, ValueError): return jsonify({"status": "error"}), 400
+    return jsonify({"status": "ok", "accepted": typing_tracker().touch(session['user_id'], receiver_id)})
+
+BULK_LIMIT = 1000
+
+def insert_messages(conn, rows):
+    # Пачка пишется в одной транзакции потока-писателя, поэтому id вставленных
+    # строк идут подряд и заканчиваются на last_insert_rowid()
+    conn.executemany(INSERT_MESSAGE_SQL, rows)
+    return conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+
+@bp.route('/api/send_bulk', methods=['POST'])
+def send_bulk():
+    """Пачка сообщений за один запрос: {"items": [{"receiver_id": 2, "text": "..."}, ...]}."""
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    data = request.get_json(silent=True)
+    items = (data.get('items') if isinstance(data, dict) else None) or []
+    if not isinstance(items, list):
+        return jsonify({"status": "error", "message": "items должен быть списком"}), 400
+    if len(items) > BULK_LIMIT:
+        return jsonify({"status": "error", "message": f"Не больше {BULK_LIMIT} сообщений за раз"}), 400
+    user_id = session['user_id']
+    conn = read_db()
+    # Дружбу проверяем одним запросом на всю пачку
+    friends = friend_ids(conn, user_id)
     conn.close()
-    return jsonify({"status": "ok"})
+    results, rows, texts = [], [], []
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({"status": "error", "message": "Неверный формат сообщения"})
+            continue
+        text = item.get('text')
+        try: receiver_id = int(item.get('receiver_id'))
+        except (TypeError, ValueError): receiver_id = None
+        if receiver_id not in friends:
+            results.append({"status": "error", "message": "Не в списке друзей"})
+        elif not isinstance(text, str):
+            results.append({"status": "error", "message": "Текст сообщения должен быть строкой"})
+        elif not text:
+            results.append({"status": "error", "message": "Пустое сообщение"})
+        else:
+            results.append(None)
+            rows.append((user_id, receiver_id, *encrypt_payload(text)))
+            texts.append(text)
+    if rows:
+        last_id = get_writer().transaction(insert_messages, rows)
+        next_id = last_id - len(rows) + 1
+        index = search_index()
+        for row, text, msg_id in zip(rows, texts, range(next_id, last_id + 1)):
+            index.add(msg_id, user_id, row[1], text)
+        for i, res in enumerate(results):
+            if res is None:
+                results[i] = {"status": "ok", "id": next_id}
+                next_id += 1
+    return jsonify({"status": "ok", "results": results})
+
+def create_file_message(user_id, receiver_id, original_name, store, encrypted=False):
+    """Кладет файл в папку загрузок вызовом store(путь) и создает сообщение о нем; возвращает id"""
+    filename = secure_filename(f"{int(time.time())}_{original_name}")
+    # Не все файлы в одну папку, а в подпапки по хешу имени: static/uploads/ab/cd/имя
+    relative = fanout_path(filename)
+    save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], relative)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    store(save_path)
+    file_url = f"/static/uploads/{relative}"
+    ext = filename.rsplit('.', 1)[1].lower()
+    msg_type = "img" if ext in {'png', 'jpg', 'jpeg', 'gif'} else "file"
+    try:
+        flags = FLAG_FILE_ENCRYPTED if encrypted else 0
+        return get_writer().execute(INSERT_FILE_SQL, (user_id, int(receiver_id), msg_type, file_url, flags))
+    except Exception:
+        # Сообщение не записалось - файл без него никому не нужен
+        remove_upload(current_app.config['UPLOAD_FOLDER'], file_url)
+        raise
 
-@app.route('/api/upload', methods=['POST'])
+@bp.route('/api/upload', methods=['POST'])
 def upload():
     if 'user_id' not in session: return jsonify({"status": "error"}), 403
     file = request.files.get('file')
     receiver_id = request.form.get('receiver_id')
     if file and allowed_file(file.filename):
-        filename = secure_filename(f"{int(time.time())}_{file.filename}")
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        file_url = f"/static/uploads/{filename}"
-        ext = filename.rsplit('.', 1)[1].lower()
-        msg_type = "img" if ext in {'png', 'jpg', 'jpeg', 'gif'} else "file"
-        payload = f"__file__:{msg_type}:{file_url}"
-        enc_payload = cipher.encrypt(payload.encode()).decode()
-        conn = get_db()
-        conn.execute('INSERT INTO messages (sender_id, receiver_id, text) VALUES (?, ?, ?)', (session['user_id'], receiver_id, enc_payload))
-        conn.commit()
-        conn.close()
-        return jsonify({"status": "ok"})
+        encrypted = current_app.config['ENCRYPT_UPLOADS']
+        # Шифруется прямо из потока запроса - открытая копия на диск не пишется
+        store = (lambda path: file_cipher().encrypt_to(file.stream, path)) if encrypted else file.save
+        msg_id = create_file_message(session['user_id'], receiver_id, file.filename, store, encrypted)
+        return jsonify({"status": "ok", "id": msg_id})
     return jsonify({"status": "error"}), 400
 
-@app.route('/api/delete_message/<int:message_id>', methods=['POST'])
-def delete_message(message_id):
+# Большие файлы - частями с докачкой (протокол в chunked_upload.py)
+def upload_staging():
+    return current_app.extensions['upload_staging']
+
+@bp.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify({"status": "error", "message": str(e), "offset": e.offset}), e.status
+
+@bp.route('/api/uploads', methods=['POST'])
+def start_upload():
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    data = request.json or {}
+    filename = str(data.get('filename') or '')
+    try: receiver_id, size = int(data.get('receiver_id')), int(data.get('size'))
+    except (TypeError, ValueError): return jsonify({"status": "error"}), 400
+    if not allowed_file(filename): return jsonify({"status": "error", "message": "Недопустимый тип файла"}), 400
+    upload_id = upload_staging().init(session['user_id'], receiver_id, filename, size)
+    return jsonify({"status": "ok", "upload_id": upload_id, "offset": 0, "chunk_size": CHUNK_SIZE})
+
+@bp.route('/api/uploads/<upload_id>')
+def upload_status(upload_id):
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    offset, size = upload_staging().status(upload_id, session['user_id'])
+    return jsonify({"status": "ok", "offset": offset, "size": size})
+
+@bp.route('/api/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    offset = upload_staging().write(upload_id, session['user_id'], request.args.get('offset', type=int), request.stream)
+    return jsonify({"status": "ok", "offset": offset})
+
+@bp.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Файл принят целиком - переносим его к загрузкам, и только теперь появляется сообщение"""
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    user_id = session['user_id']
+    staging = upload_staging()
+    # Имя и получатель - из метаданных, сохраненных при старте загрузки
+    meta = staging.info(upload_id, user_id)
+    encrypted = current_app.config['ENCRYPT_UPLOADS']
+    transform = file_cipher().encrypt_file if encrypted else None
+    msg_id = create_file_message(user_id, meta['receiver_id'], meta['filename'],
+                                 lambda path: staging.finish(upload_id, user_id, path, transform), encrypted)
+    return jsonify({"status": "ok", "id": msg_id})
+
+SEARCH_PAGE_SIZE = 20
+
+@bp.route('/api/search')
+def search():
+    """Поиск по своей истории: ?q=слова&page=1[&friend_id=2]. Расшифровываются только строки страницы."""
     if 'user_id' not in session: return jsonify({"status": "error"}), 403
     user_id = session['user_id']
-    conn = get_db()
-    msg = conn.execute('SELECT sender_id FROM messages WHERE id = ?', (message_id,)).fetchone()
-    if msg and msg['sender_id'] == user_id:
-        conn.execute('DELETE FROM messages WHERE id = ?', (message_id,))
-        conn.commit()
+    page = max(request.args.get('page', 1, type=int), 1)
+    ids = search_index().search(user_id, request.args.get('q', ''), SEARCH_PAGE_SIZE + 1,
+                                (page - 1) * SEARCH_PAGE_SIZE, request.args.get('friend_id', type=int))
+    has_more = len(ids) > SEARCH_PAGE_SIZE
+    ids = ids[:SEARCH_PAGE_SIZE]
+    results = []
+    if ids:
+        conn = read_db()
+        rows = conn.execute(f'''
+            SELECT id, sender_id, receiver_id, text, timestamp, body, msg_type, file_url, flags, key_version
+            FROM messages WHERE id IN ({','.join('?' * len(ids))}) AND (sender_id = ? OR receiver_id = ?) AND {not_expired()}
+        ''', (*ids, user_id, user_id)).fetchall()
         conn.close()
-        return jsonify({"status": "ok"})
+        by_id = {r['id']: r for r in rows}
+        for msg_id in ids:
+            r = by_id.get(msg_id)
+            if r is None: continue
+            try: msg_type, txt, url = message_content(r)
+            except: continue
+            results.append({"id": r['id'], "friend_id": r['receiver_id'] if r['sender_id'] == user_id else r['sender_id'],
+                            "text": txt, "time": r['timestamp'][:16], "is_me": r['sender_id'] == user_id})
+    return jsonify({"results": results, "page": page, "has_more": has_more})
+
+@bp.route('/api/reencrypt_status')
+def reencrypt_status():
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    worker = current_app.extensions.get('reencrypt_worker')
+    if worker is None: return jsonify({"running": False})
+    return jsonify(worker.stats())
+
+@bp.route('/api/db_stats')
+def db_stats():
+    """Ожидания блокировок в этом процессе: пул чтения и поток-писатель; ошибки записи в поисковый индекс"""
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    return jsonify({"read_pool": current_app.extensions['read_pool'].report(), "writer": get_writer().stats(),
+                    "search_index": search_index().stats()})
+
+def update_message_ttl(conn, user_id, friend_id, ttl):
+    return conn.execute('UPDATE friendships SET message_ttl = ? WHERE user_a = ? AND user_b = ?',
+                        (ttl, min(user_id, friend_id), max(user_id, friend_id))).rowcount
+
+@bp.route('/api/message_ttl/<int:friend_id>', methods=['POST'])
+def set_message_ttl(friend_id):
+    """Срок жизни новых сообщений диалога: {"ttl": 86400}, 0 - выключить. Уже отправленные не меняются."""
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    ttl = (request.json or {}).get('ttl')
+    if ttl not in TTL_CHOICES: return jsonify({"status": "error", "message": "Недопустимый срок"}), 400
+    if not get_writer().transaction(update_message_ttl, session['user_id'], friend_id, ttl):
+        return jsonify({"status": "error", "message": "Не в списке друзей"}), 403
+    return jsonify({"status": "ok", "ttl": ttl})
+
+@bp.route('/api/expiry_stats')
+def expiry_stats():
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    sweeper = current_app.extensions.get('expiry_sweeper')
+    if sweeper is None: return jsonify({"running": False})
+    return jsonify(sweeper.stats())
+
+@bp.route('/api/maintenance_stats')
+def maintenance_stats():
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    scheduler = current_app.extensions.get('maintenance')
+    if scheduler is None: return jsonify({"running": False})
+    return jsonify(scheduler.stats())
+
+def delete_own_message(conn, message_id, user_id):
+    # [(file_url,)] удаленной строки или [], если сообщение не найдено или чужое
+    return conn.execute('DELETE FROM messages WHERE id = ? AND sender_id = ? RETURNING file_url',
+                        (message_id, user_id)).fetchall()
+
+@bp.route('/api/files/<int:msg_id>')
+def get_file(msg_id):
+    """Файл сообщения для его участников: расшифровка потоком, с поддержкой Range"""
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    u_id = session['user_id']
+    conn = read_db()
+    row = conn.execute(f'''SELECT file_url, flags FROM messages
+        WHERE id = ? AND (sender_id = ? OR receiver_id = ?) AND file_url IS NOT NULL AND {not_expired()}''',
+        (msg_id, u_id, u_id)).fetchone()
     conn.close()
+    if not row or not row['file_url'].startswith('/static/uploads/'):
+        return jsonify({"status": "error"}), 404
+    if not row['flags'] & FLAG_FILE_ENCRYPTED:
+        return redirect(row['file_url'])
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], row['file_url'][len('/static/uploads/'):])
+    try:
+        reader = file_cipher().open(path)
+    except FileNotFoundError:
+        return jsonify({"status": "error"}), 404
+    name = os.path.basename(path)
+    rv = current_app.response_class(FileWrapper(reader, 64 * 1024), direct_passthrough=True,
+                                    mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+    rv.content_length = reader.size
+    rv.last_modified = os.path.getmtime(path)
+    rv.headers.set('Content-Disposition', 'inline', filename=name)
+    rv.headers['X-Content-Type-Options'] = 'nosniff'
+    rv.cache_control.private = True
+    rv.cache_control.max_age = 3600
+    # Range и If-Range обрабатывает werkzeug: reader умеет seek к нужному сегменту
+    return rv.make_conditional(request, accept_ranges=True, complete_length=reader.size)
+
+@bp.route('/api/delete_message/<int:message_id>', methods=['POST'])
+def delete_message(message_id):
+    if 'user_id' not in session: return jsonify({"status": "error"}), 403
+    user_id = session['user_id']
+    deleted = get_writer().transaction(delete_own_message, message_id, user_id)
+    if deleted:
+        search_index().remove(message_id)
+        remove_upload(current_app.config['UPLOAD_FOLDER'], deleted[0][0])
+        return jsonify({"status": "ok"})
     return jsonify({"status": "error", "message": "Нельзя удалить чужое сообщение"}), 403
 
-@app.route('/add_friend', methods=['POST'])
+@bp.route('/add_friend', methods=['POST'])
 def add_friend():
     friend_username = request.form.get('friend_username', '').strip()
     user_id = session.get('user_id')
-    conn = get_db()
+    conn = read_db()
     friend_user = conn.execute('SELECT id FROM users WHERE username = ?', (friend_username,)).fetchone()
-    if friend_user and friend_user['id'] != user_id:
-        try:
-            conn.execute('INSERT INTO friends (user_id, friend_id) VALUES (?, ?)', (user_id, friend_user['id']))
-            conn.execute('INSERT INTO friends (user_id, friend_id) VALUES (?, ?)', (friend_user['id'], user_id))
-            conn.commit()
-        except: pass
     conn.close()
-    return redirect(url_for('index'))
+    if friend_user and friend_user['id'] != user_id:
+        pair = (min(user_id, friend_user['id']), max(user_id, friend_user['id']))
+        get_writer().execute('INSERT OR IGNORE INTO friendships (user_a, user_b) VALUES (?, ?)', pair)
+    return redirect(url_for('.index'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         u, p = request.form['username'], request.form['password']
-        conn = get_db()
+        conn = read_db()
         user = conn.execute('SELECT * FROM users WHERE username = ?', (u,)).fetchone()
         conn.close()
         if user and check_password_hash(user['password'], p):
             session['user_id'], session['username'] = user['id'], user['username']
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+def create_user(conn, username, password_hash):
+    uid = conn.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password_hash)).lastrowid
+    conn.execute('INSERT INTO friendships (user_a, user_b) VALUES (?, ?)', (uid, uid))
+
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         u, p = request.form['username'], generate_password_hash(request.form['password'])
         try:
-            conn = get_db()
-            c = conn.cursor()
-            c.execute('INSERT INTO users (username, password) VALUES (?, ?)', (u, p))
-            uid = c.lastrowid
-            c.execute('INSERT INTO friends (user_id, friend_id) VALUES (?, ?)', (uid, uid))
-            conn.commit()
-            conn.close()
-            return redirect(url_for('login'))
-        except: return redirect(url_for('register'))
+            get_writer().transaction(create_user, u, p)
+            return redirect(url_for('.login'))
+        except: return redirect(url_for('.register'))
     return render_template('register.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    if config:
+        app.config.from_mapping(config)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    init_db(app.config['DATABASE'])
+    index = SearchIndex(app.config['SEARCH_DATABASE'])
+    index.init()
+    app.extensions['search_index'] = index
+    app.extensions['typing'] = TypingTracker()
+    app.extensions['upload_staging'] = UploadStaging(app.config['UPLOAD_STAGING'], app.config['UPLOAD_MAX_SIZE'])
+    app.extensions['file_cipher'] = FileCipher()
+    app.extensions['read_pool'] = ReadPool(app.config['DATABASE'], app.config['READ_POOL_SIZE'],
+                                           row_factory=sqlite3.Row)
+    # До блюпринта: отклоненный запрос не должен писать last_seen
+    init_rate_limit(app)
+    app.register_blueprint(bp)
+    init_compression(app)
+    # Кириллица в JSON как есть, а не \uXXXX - в UTF-8 вдвое короче
+    app.json.ensure_ascii = False
+    if app.config['PRELOAD']:
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+    return app
 
 if __name__ == '__main__':
+    app = create_app()
+    # Досылаем старые сообщения на текущий ключ в фоне, не останавливая чат
+    app.extensions['reencrypt_worker'] = start_worker(app.config['DATABASE'])
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,312 @@
+"""Резервные копии баз без остановки чата.
+
+Копировать файл базы под нагрузкой нельзя - получится смесь страниц до и
+после записи. Здесь копия делается через SQLite backup API небольшими
+шагами по pages страниц с паузой между ними: между шагами база свободна,
+и поток-писатель приложения не ждет, пока копируется весь файл.
+
+Если между шагами в базу кто-то записал, SQLite начинает копию заново.
+При постоянной записи шаги могли бы перезапускаться бесконечно, поэтому
+после max_restarts перезапусков остаток копируется одним шагом: базы в
+режиме WAL, и чтение одним шагом писателей тоже не блокирует.
+
+Снимок (snapshot) - копии баз и папки загрузок. Файлы загрузок не
+меняются после записи, поэтому вместо копирования они связываются жесткими
+ссылками (на другом диске - копируются). Папка проходится дважды - до и
+после копии баз: файл сохраняется раньше своего сообщения, значит у любого
+сообщения из копии файл уже есть в снимке.
+
+Инкрементная копия - только сообщения с id больше, чем в прошлой копии
+(удаления и прочие таблицы в нее не попадают). Восстановление - снимок
+плюс все инкрементные копии после него по порядку:
+
+    python backup.py snapshot [--db data1.db] [--uploads static/uploads] [--no-uploads] [--out backups]
+    python backup.py incremental [--db data1.db] [--out backups]
+    python backup.py restore backups/snapshot-20240101-120000-000000 --to restored
+
+Для "Мессенджер MAX" - `python manage.py backup` и `python manage.py backup_incremental`.
+Поисковый индекс (search.db) не копируется: он восстанавливается командой
+python search_index.py по сообщениям.
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+from upload_gc import scan_files
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Страниц базы за один шаг копирования (по 4 КБ - 1 МБ) и пауза между шагами
+STEP_PAGES = 256
+STEP_PAUSE = 0.01
+# После стольких перезапусков из-за записи в базу остаток копируется одним шагом
+MAX_RESTARTS = 3
+# Сообщений за одну пачку инкрементной копии
+INCREMENT_BATCH = 5000
+STATE_FILE = 'backup_state.json'
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def connect_readonly(path):
+    return sqlite3.connect(f'file:{quote(path)}?mode=ro', uri=True, timeout=10)
+
+
+def backup_database(source_path, target_path, pages=STEP_PAGES, pause=STEP_PAUSE, max_restarts=MAX_RESTARTS):
+    """Копирует базу source_path в target_path шагами по pages страниц. Возвращает отчет.
+
+    Копия пишется во временный файл и появляется под target_path только
+    целиком и после PRAGMA quick_check. В отчете и last_message_id копии -
+    он читается тем же соединением, которое копию писало: отдельное
+    соединение mode=ro к копии в режиме WAL оставило бы рядом -wal и -shm.
+    """
+    started = time.perf_counter()
+    temp_path = target_path + '.partial'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    report = {'steps': 0, 'restarts': 0, 'one_step': False, 'pages': 0}
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal last_remaining
+        report['steps'] += 1
+        report['pages'] = total
+        if last_remaining is not None and remaining > last_remaining:
+            # Остаток вырос - база изменилась, и SQLite начал копию сначала
+            report['restarts'] += 1
+            if report['restarts'] > max_restarts:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+        # Пауза между шагами - в это время база свободна для записи и checkpoint
+        time.sleep(pause)
+
+    source = connect_readonly(source_path)
+    target = sqlite3.connect(temp_path)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        except _TooManyRestarts:
+            report['one_step'] = True
+            source.backup(target, pages=-1)
+        if target.execute('PRAGMA quick_check').fetchone()[0] != 'ok':
+            raise RuntimeError(f'Копия {source_path} не прошла проверку')
+        report['last_message_id'] = last_message_id(target)
+    except BaseException:
+        target.close()
+        os.remove(temp_path)
+        raise
+    finally:
+        source.close()
+    target.close()
+    os.replace(temp_path, target_path)
+    report['bytes'] = os.path.getsize(target_path)
+    report['elapsed_sec'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def link_tree(source_dir, target_dir):
+    """Жесткие ссылки на файлы source_dir в target_dir (уже перенесенные пропускаются).
+
+    Возвращает (новых файлов, байт).
+    """
+    files = size = 0
+    for relative, entry in scan_files(source_dir):
+        target = os.path.join(target_dir, relative)
+        if os.path.exists(target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(entry.path, target)
+        except FileNotFoundError:
+            # Удален, пока обходили папку
+            continue
+        except OSError:
+            # Снимок на другом диске - жесткую ссылку не сделать
+            try:
+                shutil.copy2(entry.path, target)
+            except FileNotFoundError:
+                continue
+        files += 1
+        size += os.path.getsize(target)
+    return files, size
+
+
+def last_message_id(conn):
+    try:
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+    except sqlite3.OperationalError:
+        # В базе нет таблицы messages (основная база MAX при шардах)
+        return 0
+
+
+def make_stamp():
+    # С микросекундами: по этой метке restore упорядочивает копии, совпадать они не должны
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+def load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def snapshot(databases, out_dir, upload_folder=None, pages=STEP_PAGES, pause=STEP_PAUSE):
+    """Снимок: копии баз (список путей) и, если задана, папки загрузок. Возвращает путь снимка"""
+    stamp = make_stamp()
+    target = os.path.join(out_dir, f'snapshot-{stamp}')
+    partial = target + '.partial'
+    os.makedirs(partial)
+    manifest = {'created': stamp, 'databases': {}, 'uploads': None}
+    uploads_dir = os.path.join(partial, 'uploads')
+    files = size = 0
+    if upload_folder:
+        files, size = link_tree(upload_folder, uploads_dir)
+    for path in databases:
+        name = os.path.basename(path)
+        report = backup_database(path, os.path.join(partial, name), pages, pause)
+        manifest['databases'][name] = report
+        print(f"{name}: {report['bytes']} байт, шагов {report['steps']}, перезапусков {report['restarts']}"
+              f"{', остаток одним шагом' if report['one_step'] else ''}, {report['elapsed_sec']} с")
+    if upload_folder:
+        # Второй проход: файлы, загруженные, пока копировались базы
+        more_files, more_size = link_tree(upload_folder, uploads_dir)
+        manifest['uploads'] = {'files': files + more_files, 'bytes': size + more_size}
+        print(f"Загрузки: {files + more_files} файлов, {size + more_size} байт")
+    with open(os.path.join(partial, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(partial, target)
+    # Следующая инкрементная копия - от этого снимка
+    state = load_state(out_dir)
+    for name, report in manifest['databases'].items():
+        state[name] = report['last_message_id']
+    save_state(out_dir, state)
+    return target
+
+
+def copy_new_messages(source_path, target_path, after_id, batch_size=INCREMENT_BATCH):
+    """Сообщения с id > after_id из source_path в новую базу target_path. Возвращает (число, последний id)"""
+    source = connect_readonly(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        row = source.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages'").fetchone()
+        if row is None:
+            return 0, after_id
+        target.execute(row[0])
+        copied = 0
+        last_id = after_id
+        while True:
+            rows = source.execute('SELECT * FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                                  (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            target.executemany(f'INSERT INTO messages VALUES ({",".join("?" * len(rows[0]))})', rows)
+            copied += len(rows)
+            last_id = rows[-1][0]
+        target.commit()
+        return copied, last_id
+    finally:
+        source.close()
+        target.close()
+
+
+def incremental(databases, out_dir, batch_size=INCREMENT_BATCH):
+    """Новые сообщения после прошлого снимка или инкрементной копии. Возвращает путь копии"""
+    state = load_state(out_dir)
+    if not state:
+        raise RuntimeError('Нет ни одного снимка - сначала snapshot')
+    stamp = make_stamp()
+    target = os.path.join(out_dir, f'incremental-{stamp}')
+    partial = target + '.partial'
+    os.makedirs(partial)
+    manifest = {'created': stamp, 'databases': {}}
+    for path in databases:
+        name = os.path.basename(path)
+        after_id = state.get(name, 0)
+        copied, last_id = copy_new_messages(path, os.path.join(partial, name), after_id, batch_size)
+        manifest['databases'][name] = {'after_id': after_id, 'last_message_id': last_id, 'messages': copied}
+        print(f'{name}: {copied} новых сообщений' + (f' (id {after_id + 1}..{last_id})' if copied else ''))
+    with open(os.path.join(partial, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(partial, target)
+    for name, info in manifest['databases'].items():
+        state[name] = info['last_message_id']
+    save_state(out_dir, state)
+    return target
+
+
+def restore(snapshot_dir, target_dir):
+    """Базы и загрузки снимка в target_dir плюс все инкрементные копии после него"""
+    snapshot_dir = os.path.normpath(snapshot_dir)
+    out_dir = os.path.dirname(snapshot_dir)
+    with open(os.path.join(snapshot_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    os.makedirs(target_dir, exist_ok=True)
+    for name in manifest['databases']:
+        shutil.copyfile(os.path.join(snapshot_dir, name), os.path.join(target_dir, name))
+    if manifest['uploads'] is not None:
+        link_tree(os.path.join(snapshot_dir, 'uploads'), os.path.join(target_dir, 'uploads'))
+    increments = sorted(name for name in os.listdir(out_dir)
+                        if name.startswith('incremental-') and not name.endswith('.partial')
+                        and name[len('incremental-'):] > manifest['created'])
+    for increment in increments:
+        for name in manifest['databases']:
+            source = os.path.join(out_dir, increment, name)
+            if not os.path.exists(source):
+                continue
+            conn = sqlite3.connect(os.path.join(target_dir, name))
+            conn.execute('ATTACH DATABASE ? AS increment', (source,))
+            columns = [row[1] for row in conn.execute('PRAGMA increment.table_info(messages)')]
+            if columns:
+                names = ', '.join(columns)
+                # REPLACE: более поздняя копия новее, даже если id у сообщения совпал
+                count = conn.execute(f'INSERT OR REPLACE INTO main.messages ({names}) '
+                                     f'SELECT {names} FROM increment.messages').rowcount
+                conn.commit()
+                print(f'{increment}/{name}: {count} сообщений')
+            conn.execute('DETACH DATABASE increment')
+            conn.close()
+    return target_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Резервные копии базы и загрузок')
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'data1.db'))
+    parser.add_argument('--out', default=os.path.join(BASE_DIR, 'backups'))
+    commands = parser.add_subparsers(dest='command', required=True)
+    snapshot_parser = commands.add_parser('snapshot', help='копия базы и папки загрузок')
+    snapshot_parser.add_argument('--uploads', default=os.path.join(BASE_DIR, 'static/uploads'))
+    snapshot_parser.add_argument('--no-uploads', action='store_true')
+    snapshot_parser.add_argument('--pages', type=int, default=STEP_PAGES, help='страниц за шаг')
+    snapshot_parser.add_argument('--pause', type=float, default=STEP_PAUSE, help='пауза между шагами, с')
+    commands.add_parser('incremental', help='новые сообщения после прошлой копии')
+    restore_parser = commands.add_parser('restore', help='восстановить снимок и инкрементные копии после него')
+    restore_parser.add_argument('snapshot')
+    restore_parser.add_argument('--to', required=True)
+    args = parser.parse_args()
+
+    if args.command == 'snapshot':
+        path = snapshot([args.db], args.out, None if args.no_uploads else args.uploads, args.pages, args.pause)
+    elif args.command == 'incremental':
+        try:
+            path = incremental([args.db], args.out)
+        except RuntimeError as e:
+            parser.exit(1, f'{e}\n')
+    else:
+        path = restore(args.snapshot, args.to)
+    print(f'Готово: {path}')
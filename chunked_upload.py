@@ -0,0 +1,185 @@
+"""Докачиваемая загрузка больших файлов частями.
+
+Протокол (одинаковый в обоих приложениях):
+
+    POST /api/uploads                 {receiver_id, filename, size} -> upload_id
+    GET  /api/uploads/<id>            сколько байт уже принято (offset)
+    PUT  /api/uploads/<id>?offset=N   тело запроса - байты файла начиная с N
+    POST /api/uploads/<id>/finalize   файл целиком принят -> сообщение
+
+Части пишутся в промежуточную папку (не под static - туда нельзя попасть
+по ссылке), а сообщение появляется только после finalize. Оборвалась
+связь - клиент спрашивает offset и продолжает с него, уже принятое не
+передается заново, а каждый запрос держит воркер только на время одной части.
+
+Состояние загрузки лежит на диске, а не в памяти процесса, поэтому части
+могут приходить в разные воркеры. Принятый offset - это размер файла части.
+Повторная отправка уже принятого куска просто перезаписывает те же байты,
+поэтому блокировки не нужны.
+"""
+import json
+import os
+import time
+import uuid
+
+# Файлы больше этого браузер отправляет частями
+CHUNKED_THRESHOLD = 1024 * 1024
+# Размер одной части
+CHUNK_SIZE = 1024 * 1024
+# Недокачанные загрузки старше суток удаляются
+STAGING_MAX_AGE = 24 * 3600
+# Блок копирования из тела запроса в файл
+COPY_BLOCK = 64 * 1024
+
+
+class UploadError(Exception):
+    """Ошибка протокола: status - HTTP-код ответа"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class UploadStaging:
+    def __init__(self, directory, max_size, max_age=STAGING_MAX_AGE):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self._last_purge = 0
+
+    def _paths(self, upload_id):
+        # upload_id приходит из URL - допускаем только то, что выдали сами
+        if len(upload_id) != 32 or not all(ch in '0123456789abcdef' for ch in upload_id):
+            raise UploadError('Загрузка не найдена', 404)
+        base = os.path.join(self.directory, upload_id)
+        return base + '.json', base + '.part'
+
+    @staticmethod
+    def _received(part_path):
+        # Файла части нет, а метаданные есть - загрузку прямо сейчас завершает параллельный finalize
+        try:
+            return os.path.getsize(part_path)
+        except FileNotFoundError:
+            raise UploadError('Загрузка не найдена', 404)
+
+    def _meta(self, upload_id, user_id):
+        meta_path, part_path = self._paths(upload_id)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Загрузка не найдена', 404)
+        if meta['user_id'] != user_id:
+            raise UploadError('Загрузка не найдена', 404)
+        return meta, part_path
+
+    def init(self, user_id, receiver_id, filename, size):
+        """Заводит загрузку; filename уже проверен вызывающим. Возвращает upload_id"""
+        if not 0 < size <= self.max_size:
+            raise UploadError(f'Файл больше {self.max_size // (1024 * 1024)} МБ', 413)
+        os.makedirs(self.directory, exist_ok=True)
+        self.purge()
+        upload_id = uuid.uuid4().hex
+        meta_path, part_path = self._paths(upload_id)
+        open(part_path, 'wb').close()
+        meta = {'user_id': user_id, 'receiver_id': receiver_id, 'filename': filename, 'size': size,
+                'created': time.time()}
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return upload_id
+
+    def info(self, upload_id, user_id):
+        """Метаданные загрузки: user_id, receiver_id, filename, size"""
+        return self._meta(upload_id, user_id)[0]
+
+    def status(self, upload_id, user_id):
+        meta, part_path = self._meta(upload_id, user_id)
+        return self._received(part_path), meta['size']
+
+    def write(self, upload_id, user_id, offset, stream):
+        """Пишет тело запроса в файл с позиции offset; возвращает новый offset.
+
+        offset больше уже принятого - пропуск в файле, UploadError 409 с тем
+        offset, с которого клиенту надо продолжить.
+        """
+        meta, part_path = self._meta(upload_id, user_id)
+        received = self._received(part_path)
+        if offset is None or offset < 0 or offset > received:
+            raise UploadError('Неверное смещение', 409, received)
+        position = offset
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            while True:
+                block = stream.read(COPY_BLOCK)
+                if not block:
+                    break
+                position += len(block)
+                if position > meta['size']:
+                    raise UploadError('Данных больше, чем заявлено', 400, received)
+                f.write(block)
+        return max(position, received)
+
+    def finish(self, upload_id, user_id, target_path, transform=None):
+        """Переносит целиком принятый файл в target_path; возвращает метаданные загрузки.
+
+        transform(исходный путь, target_path) - записать файл по-своему
+        (например, зашифровать) вместо простого переноса.
+        """
+        meta, part_path = self._meta(upload_id, user_id)
+        received = self._received(part_path)
+        if received != meta['size']:
+            raise UploadError('Файл принят не полностью', 409, received)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        # Параллельный finalize той же загрузки: файл достается тому, кто первым его переименовал
+        source = target_path if transform is None else part_path + '.done'
+        try:
+            os.replace(part_path, source)
+        except FileNotFoundError:
+            raise UploadError('Загрузка не найдена', 404)
+        if transform is not None:
+            try:
+                transform(source, target_path)
+            except BaseException:
+                # Часть возвращается на место: finalize можно повторить, а брошенную удалит purge
+                os.replace(source, part_path)
+                raise
+            os.remove(source)
+        os.remove(self._paths(upload_id)[0])
+        return meta
+
+    def purge(self):
+        """Удаляет брошенные загрузки; чаще раза в час не проверяет.
+
+        Возраст загрузки - по самому свежему из ее файлов: .json пишется один
+        раз при init, а .part обновляется каждой частью, так что загрузка,
+        которая еще идет, не теряет метаданные. Файлы загрузки удаляются вместе.
+        """
+        now = time.time()
+        if now - self._last_purge < 3600:
+            return
+        self._last_purge = now
+        try:
+            entries = os.scandir(self.directory)
+        except FileNotFoundError:
+            return
+        # upload_id -> (самый свежий mtime, пути файлов)
+        uploads = {}
+        with entries:
+            for entry in entries:
+                try:
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                upload_id = entry.name.split('.', 1)[0]
+                newest, paths = uploads.get(upload_id, (0, []))
+                paths.append(entry.path)
+                uploads[upload_id] = (max(newest, mtime), paths)
+        for newest, paths in uploads.values():
+            if now - newest <= self.max_age:
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,171 @@
+"""Пул соединений только для чтения.
+
+Запросы на чтение (история, опросы, счетчики) берут соединение из пула,
+открытого с mode=ro, а все записи идут через один поток-писатель
+(write_queue.MessageWriter). В режиме WAL читатели не ждут писателя, поэтому
+опросы не стоят в очереди за отправкой сообщений, а писатель один на процесс
+и не спорит сам с собой за блокировку.
+
+Соединение из пула закрывается как обычное - close() возвращает его в пул:
+
+    conn = pool.get()
+    rows = conn.execute('SELECT ...').fetchall()
+    conn.close()
+
+Если между get() и close() вылетело исключение, соединение не теряется:
+пул помнит, какие соединения взял каждый поток, и приложение возвращает
+оставшиеся в конце запроса (release_held в teardown). Повторный close()
+уже возвращенного соединения ничего не делает.
+"""
+import queue
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+
+class PooledConnection(sqlite3.Connection):
+    pool = None
+    checked_out = False
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        elif self.checked_out:
+            self.pool.put(self)
+
+
+class LockStats:
+    """Сколько раз и как долго ждали: блокировку записи или свободное соединение."""
+
+    def __init__(self, threshold=0.001):
+        # Быстрее threshold секунд - это не ожидание, а обычная работа
+        self.threshold = threshold
+        self.acquired = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, timed_out=False):
+        with self._lock:
+            self.acquired += 1
+            if timed_out:
+                self.timeouts += 1
+            if seconds >= self.threshold:
+                self.waits += 1
+                self.wait_seconds += seconds
+                self.max_wait = max(self.max_wait, seconds)
+
+    def report(self):
+        return {
+            'acquired': self.acquired,
+            'waits': self.waits,
+            'wait_ms_total': round(self.wait_seconds * 1000, 1),
+            'wait_ms_avg': round(self.wait_seconds * 1000 / self.waits, 2) if self.waits else 0,
+            'wait_ms_max': round(self.max_wait * 1000, 1),
+            'timeouts': self.timeouts,
+        }
+
+
+class ReadPool:
+    """До size соединений mode=ro к одной базе; лишние запросы ждут свободное до timeout секунд.
+
+    Соединения открываются по требованию - уже в воркере, а не в мастере до fork.
+    """
+
+    def __init__(self, path, size=8, timeout=5, row_factory=None, detect_types=0, attach=None):
+        self.path = path
+        # {псевдоним: путь} - базы, которые подключаются к каждому соединению (тоже mode=ro)
+        self.attach = attach or {}
+        self.size = size
+        self.timeout = timeout
+        self.row_factory = row_factory
+        self.detect_types = detect_types
+        self.stats = LockStats()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # Соединения, взятые текущим потоком и еще не возвращенные
+        self._local = threading.local()
+        # Сколько соединений вернул release_held, а не close() в коде запроса
+        self.released = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(f'file:{quote(self.path)}?mode=ro', uri=True, timeout=self.timeout,
+                               detect_types=self.detect_types, check_same_thread=False,
+                               factory=PooledConnection)
+        # Сколько ждать, если база занята (восстановление WAL, checkpoint с RESTART)
+        conn.execute(f'PRAGMA busy_timeout = {int(self.timeout * 1000)}')
+        for alias, path in self.attach.items():
+            conn.execute(f'ATTACH DATABASE ? AS {alias}', (f'file:{quote(path)}?mode=ro',))
+        conn.row_factory = self.row_factory
+        conn.pool = self
+        return conn
+
+    def _held(self):
+        if not hasattr(self._local, 'held'):
+            self._local.held = set()
+        return self._local.held
+
+    def _take(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            self.stats.record(0.0)
+            return conn
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+                self.stats.record(0.0)
+                return conn
+        started = time.monotonic()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            self.stats.record(time.monotonic() - started, timed_out=True)
+            raise sqlite3.OperationalError('read pool exhausted')
+        self.stats.record(time.monotonic() - started)
+        return conn
+
+    def get(self):
+        conn = self._take()
+        conn.checked_out = True
+        self._held().add(conn)
+        return conn
+
+    def put(self, conn):
+        conn.checked_out = False
+        self._held().discard(conn)
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Сломанное соединение в пул не возвращаем - вместо него откроется новое
+            with self._lock:
+                self._created -= 1
+            sqlite3.Connection.close(conn)
+            return
+        self._idle.put(conn)
+
+    def release_held(self):
+        """Возвращает в пул соединения, которые текущий поток взял и не закрыл; сколько вернул"""
+        held = list(self._held())
+        for conn in held:
+            conn.close()
+        if held:
+            with self._lock:
+                self.released += len(held)
+        return len(held)
+
+    def report(self):
+        return {'size': self.size, 'open': self._created, 'idle': self._idle.qsize(),
+                'released_on_teardown': self.released, **self.stats.report()}
@@ -0,0 +1,112 @@
+import base64
+import os
+import zlib
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+
+# Исходный ключ шифрования - версия 1. Им зашифрованы все старые сообщения,
+# поэтому удалять его из связки можно только после полного перешифрования.
+ENCRYPTION_KEY = b'uX6-f1vE0zP_kYQ-jD2pL_9a_N3b_C4d_E5f_G6h_I7='
+
+# Флаги в колонке messages.flags
+FLAG_COMPRESSED = 1
+# Файл сообщения (file_url) зашифрован на диске - см. file_crypto.py
+FLAG_FILE_ENCRYPTED = 2
+
+# Короче этого порога сжимать нет смысла: zlib-заголовок съест всю выгоду
+COMPRESS_THRESHOLD = 200
+
+
+def load_keys():
+    """Читает связку ключей из MESSENGER_KEYS ("2:ключ,1:ключ").
+
+    Без переменной окружения в связке только исходный ключ версии 1.
+    """
+    raw = os.environ.get('MESSENGER_KEYS', '').strip()
+    if not raw:
+        return {1: ENCRYPTION_KEY}
+    keys = {}
+    for item in raw.split(','):
+        version, key = item.strip().split(':', 1)
+        keys[int(version)] = key.encode()
+    return keys
+
+
+class KeyRing:
+    """Связка версионированных ключей Fernet.
+
+    Шифрует всегда самым новым ключом, расшифровывает любым из связки.
+    """
+
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError('Связка ключей пуста')
+        self.fernets = {version: Fernet(key) for version, key in keys.items()}
+        self.current_version = max(self.fernets)
+        self.multi = MultiFernet([self.fernets[v] for v in sorted(self.fernets, reverse=True)])
+
+    def encrypt(self, data):
+        """Возвращает (токен, версия ключа)."""
+        return self.fernets[self.current_version].encrypt(data), self.current_version
+
+    def decrypt(self, token, version=None):
+        # Если версия известна, пробуем сразу нужный ключ, иначе перебираем все
+        fernet = self.fernets.get(version)
+        if fernet is not None:
+            try:
+                return fernet.decrypt(token)
+            except InvalidToken:
+                pass
+        return self.multi.decrypt(token)
+
+    def rotate(self, token):
+        """Перешифровывает токен текущим ключом, сохраняя его исходную метку времени."""
+        return self.multi.rotate(token)
+
+
+keyring = KeyRing(load_keys())
+
+
+def encrypt_payload(text):
+    """Шифрует текст сообщения и возвращает (сырой шифротекст для BLOB, флаги, версия ключа)."""
+    data = text.encode()
+    flags = 0
+    if len(data) >= COMPRESS_THRESHOLD:
+        packed = zlib.compress(data, 6)
+        if len(packed) < len(data):
+            data, flags = packed, flags | FLAG_COMPRESSED
+    # Fernet отдает токен в base64 - храним декодированные байты, это на треть меньше
+    token, version = keyring.encrypt(data)
+    return base64.urlsafe_b64decode(token), flags, version
+
+
+def decrypt_payload(blob, flags=0, key_version=None):
+    data = keyring.decrypt(base64.urlsafe_b64encode(bytes(blob)), key_version)
+    if flags & FLAG_COMPRESSED:
+        data = zlib.decompress(data)
+    return data.decode()
+
+
+def encrypt_text(text):
+    """Текстовый формат (base64-токен) - для копия1 и старых строк."""
+    token, version = keyring.encrypt(text.encode())
+    return token.decode(), version
+
+
+def decrypt_legacy(token, key_version=None):
+    """Старый формат: base64-токен Fernet в колонке messages.text."""
+    return keyring.decrypt(token.encode(), key_version).decode()
+
+
+def rotate_value(value):
+    """Перешифровывает значение колонки текущим ключом: BLOB остается BLOB, TEXT - TEXT."""
+    if isinstance(value, bytes):
+        return base64.urlsafe_b64decode(keyring.rotate(base64.urlsafe_b64encode(value)))
+    return keyring.rotate(value.encode()).decode()
+
+
+def parse_legacy_file(text):
+    """Разбирает строку вида __file__:{type}:{url}. Возвращает (type, url) или None."""
+    if not text.startswith('__file__:'):
+        return None
+    _, msg_type, url = text.split(':', 2)
+    return msg_type, url
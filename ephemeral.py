@@ -0,0 +1,54 @@
+"""Кратковременные события диалога ("печатает...") в памяти процесса.
+
+В базу они не попадают: индикатор живет несколько секунд, и писать его на
+каждое нажатие клавиши незачем. Клиент сообщает о наборе не чаще раза в
+throttle секунд, а собеседник узнает о нем из ответа на обычный опрос.
+
+Состояние свое у каждого процесса - с несколькими воркерами индикатор виден,
+только если отметка и опрос попали в один процесс; сообщения от этого не
+зависят, теряется лишь подсказка.
+"""
+import threading
+import time
+
+# Сколько секунд после последней отметки собеседник видит "печатает..."
+TYPING_TTL = 6
+# Не чаще раза в столько секунд принимаем отметку от одного пользователя в одном диалоге
+TYPING_THROTTLE = 3
+
+
+class TypingTracker:
+    def __init__(self, ttl=TYPING_TTL, throttle=TYPING_THROTTLE, max_entries=100000):
+        self.ttl = ttl
+        self.throttle = throttle
+        self.max_entries = max_entries
+        # (кто печатает, кому) -> время последней принятой отметки
+        self._typing = {}
+        self._lock = threading.Lock()
+
+    def touch(self, user_id, peer_id):
+        """Отмечает, что user_id печатает peer_id. False - отметка пришла слишком рано и пропущена."""
+        key = (int(user_id), int(peer_id))
+        now = time.monotonic()
+        with self._lock:
+            if now - self._typing.get(key, -self.throttle) < self.throttle:
+                return False
+            if len(self._typing) >= self.max_entries and key not in self._typing:
+                self._prune(now)
+            self._typing[key] = now
+        return True
+
+    def stop(self, user_id, peer_id):
+        """Сообщение отправлено - индикатор больше не нужен"""
+        with self._lock:
+            self._typing.pop((int(user_id), int(peer_id)), None)
+
+    def is_typing(self, user_id, peer_id):
+        """Печатает ли user_id сообщение для peer_id прямо сейчас"""
+        started = self._typing.get((int(user_id), int(peer_id)))
+        return started is not None and time.monotonic() - started < self.ttl
+
+    def _prune(self, now):
+        self._typing = {key: started for key, started in self._typing.items() if now - started < self.ttl}
+        if len(self._typing) >= self.max_entries:
+            self._typing.clear()
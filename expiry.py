@@ -0,0 +1,109 @@
+"""Исчезающие сообщения: срок жизни диалога и фоновая очистка.
+
+У каждого диалога свой срок (0 - хранить всегда). Сообщение получает
+expires_at (unix-время) при записи, а удаляет его фоновый поток
+ExpirySweeper - небольшими пачками по индексу на expires_at, каждая пачка
+через поток-писатель, поэтому блокировка записи держится миллисекунды.
+
+Пока поток не дошел до сообщения, его скрывают сами запросы на чтение
+условием not_expired() - оно проверяется только у строк, которые запрос и
+так прочитал, лишних обращений к диску нет.
+"""
+import threading
+import time
+
+# Сроки, которые можно выбрать в интерфейсе: выключено, сутки, неделя
+TTL_CHOICES = (0, 24 * 3600, 7 * 24 * 3600)
+
+# Сколько строк удалять за одну транзакцию
+SWEEP_BATCH = 500
+# Раз в сколько секунд искать истекшие сообщения
+SWEEP_INTERVAL = 30
+
+# Частичный индекс: строки без срока в него не попадают и места не занимают
+EXPIRES_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS idx_messages_expires ON messages (expires_at) WHERE expires_at IS NOT NULL'
+
+
+def not_expired(column='expires_at'):
+    """Условие для WHERE: у сообщения нет срока или он еще не наступил"""
+    return f"({column} IS NULL OR {column} > CAST(strftime('%s', 'now') AS INTEGER))"
+
+
+def expires_at(ttl, now=None):
+    """expires_at для нового сообщения диалога со сроком ttl секунд (None - бессрочно)"""
+    if not ttl:
+        return None
+    return int(now if now is not None else time.time()) + int(ttl)
+
+
+def delete_expired(conn, now, limit, columns='id'):
+    """Удаляет до limit истекших сообщений и возвращает их columns.
+
+    Выполняется в потоке-писателе (MessageWriter.transaction). RETURNING отдает
+    только реально удаленные строки, поэтому если очистку запустили несколько
+    процессов, файлы каждого сообщения убирает ровно один из них.
+    """
+    return conn.execute(f'''
+        DELETE FROM messages WHERE id IN (
+            SELECT id FROM messages WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+        )
+        RETURNING {columns}
+    ''', (now, limit)).fetchall()
+
+
+class ExpirySweeper(threading.Thread):
+    """Раз в interval секунд вызывает sweep(), пока та находит истекшие сообщения.
+
+    sweep() удаляет одну пачку и возвращает число удаленных строк; между
+    пачками поток спит pause секунд, чтобы не занимать писателя подряд.
+    """
+
+    def __init__(self, sweep, interval=SWEEP_INTERVAL, pause=0.05):
+        super().__init__(daemon=True, name='expiry-sweeper')
+        self.sweep = sweep
+        self.interval = interval
+        self.pause = pause
+        self.deleted = 0
+        self.batches = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run_once(self):
+        """Удаляет все истекшие на сейчас сообщения; возвращает их число"""
+        total = 0
+        while not self._stop_event.is_set():
+            deleted = self.sweep()
+            self.batches += 1
+            total += deleted
+            if not deleted:
+                break
+            self._stop_event.wait(self.pause)
+        self.deleted += total
+        self.last_run = time.time()
+        return total
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                # Ошибка одного прохода (база занята и т.п.) не останавливает поток
+                self.errors += 1
+                self.last_error = repr(e)
+            self._stop_event.wait(self.interval)
+
+    def stats(self):
+        return {
+            'deleted': self.deleted,
+            'batches': self.batches,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'last_run': self.last_run,
+            'interval_sec': self.interval,
+            'running': self.is_alive(),
+        }
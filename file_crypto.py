@@ -0,0 +1,250 @@
+"""Шифрование загруженных файлов на диске потоком, сегментами AES-GCM.
+
+Файл никогда не читается в память целиком: он режется на сегменты по
+SEGMENT_SIZE байт, и каждый шифруется отдельно со своим тегом. Поэтому
+расшифровать можно любой кусок файла, не трогая остальные, - на этом
+держатся Range-запросы (перемотка видео, докачка в браузере).
+
+Формат файла:
+
+    заголовок: MAGIC | размер сегмента (4 байта) | salt (16) | префикс nonce (7)
+    сегменты:  шифротекст сегмента + тег GCM (16), последний может быть короче
+
+Ключ файла - HMAC мастер-ключа и salt, так что у каждого файла свой ключ.
+Nonce сегмента - префикс, номер сегмента и признак последнего сегмента:
+сегменты нельзя переставить, подменить чужими или отрезать хвост файла.
+Заголовок входит в проверяемые данные каждого сегмента.
+
+Зашифровать уже загруженные открытые файлы (можно прерывать и запускать заново):
+
+    python file_crypto.py [--db data1.db] [--uploads static/uploads] [--batch 200]
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import sqlite3
+import struct
+import time
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from encryption import ENCRYPTION_KEY, FLAG_FILE_ENCRYPTED
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MAGIC = b'BGF1'
+# Открытых байт в одном сегменте: столько же расшифровывается ради одного байта из Range
+SEGMENT_SIZE = 64 * 1024
+TAG_SIZE = 16
+HEADER = struct.Struct('>4sI16s7s')
+
+
+def default_key():
+    # Свой ключ, не из связки MESSENGER_KEYS: после смены ключа сообщений
+    # и удаления старого из связки файлы остаются читаемыми без перешифрования
+    raw = os.environ.get('MESSENGER_FILE_KEY')
+    if raw:
+        return raw.encode()
+    return hmac.new(ENCRYPTION_KEY, b'upload-files', hashlib.sha256).digest()
+
+
+def _read_full(src, size):
+    # Поток запроса может отдавать меньше запрошенного - добираем до size или конца
+    chunks = []
+    while size:
+        block = src.read(size)
+        if not block:
+            break
+        chunks.append(block)
+        size -= len(block)
+    return b''.join(chunks)
+
+
+class FileCipher:
+    def __init__(self, key=None, segment_size=SEGMENT_SIZE):
+        self.key = key or default_key()
+        self.segment_size = segment_size
+
+    def _aead(self, salt):
+        return AESGCM(hmac.new(self.key, b'file' + salt, hashlib.sha256).digest())
+
+    @staticmethod
+    def _nonce(prefix, index, last):
+        return prefix + struct.pack('>IB', index, 1 if last else 0)
+
+    def encrypt_stream(self, src, dst):
+        """Шифрует поток src (read) в dst (write); в памяти не больше двух сегментов.
+
+        Возвращает число открытых байт.
+        """
+        salt, prefix = os.urandom(16), os.urandom(7)
+        header = HEADER.pack(MAGIC, self.segment_size, salt, prefix)
+        aead = self._aead(salt)
+        dst.write(header)
+        # Сегмент читается наперед: шифруя текущий, надо знать, последний ли он
+        block = _read_full(src, self.segment_size)
+        index = size = 0
+        while True:
+            following = _read_full(src, self.segment_size)
+            last = not following
+            dst.write(aead.encrypt(self._nonce(prefix, index, last), block, header))
+            size += len(block)
+            if last:
+                return size
+            block = following
+            index += 1
+
+    def encrypt_to(self, src, path):
+        """Шифрует поток src в файл path; недописанный файл не остается"""
+        try:
+            with open(path, 'wb') as dst:
+                return self.encrypt_stream(src, dst)
+        except BaseException:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def encrypt_file(self, source_path, target_path):
+        with open(source_path, 'rb') as src:
+            return self.encrypt_to(src, target_path)
+
+    def open(self, path):
+        return DecryptingReader(self, path)
+
+
+def is_encrypted(path):
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    return len(header) == HEADER.size and header.startswith(MAGIC)
+
+
+class DecryptingReader:
+    """Зашифрованный файл как обычный файл только для чтения: read, seek, tell.
+
+    В памяти один расшифрованный сегмент. seek переходит сразу к нужному
+    сегменту - так werkzeug отдает Range-ответ без чтения файла с начала.
+    """
+
+    def __init__(self, cipher, path):
+        self.file = open(path, 'rb')
+        try:
+            header = self.file.read(HEADER.size)
+            if len(header) != HEADER.size or not header.startswith(MAGIC):
+                raise ValueError('Файл не зашифрован')
+            _, self.segment_size, salt, self.prefix = HEADER.unpack(header)
+            body = os.fstat(self.file.fileno()).st_size - HEADER.size
+            stored = self.segment_size + TAG_SIZE
+            self.segments = max(-(-body // stored), 1)
+            # Размер открытого файла - из размера шифротекста, без чтения сегментов
+            self.size = body - self.segments * TAG_SIZE
+            if self.size < 0:
+                raise ValueError('Файл обрезан')
+        except BaseException:
+            self.file.close()
+            raise
+        self.header = header
+        self.aead = cipher._aead(salt)
+        self.position = 0
+        self._index = None
+        self._plain = b''
+
+    def _segment(self, index):
+        if index != self._index:
+            stored = self.segment_size + TAG_SIZE
+            self.file.seek(HEADER.size + index * stored)
+            data = self.file.read(stored)
+            last = index == self.segments - 1
+            # Подмененный или испорченный сегмент - cryptography.exceptions.InvalidTag
+            self._plain = self.aead.decrypt(FileCipher._nonce(self.prefix, index, last), data, self.header)
+            self._index = index
+        return self._plain
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        chunks = []
+        while size > 0:
+            index, start = divmod(self.position, self.segment_size)
+            chunk = self._segment(index)[start:start + size]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def encrypt_existing(conn, cipher, upload_folder, batch_size=200):
+    """Шифрует открытые файлы сообщений и ставит им FLAG_FILE_ENCRYPTED.
+
+    Файл шифруется во временный и подменяет исходный через os.replace, а флаг
+    ставится после. Если прервать между ними, следующий запуск увидит
+    MAGIC в начале файла и только допишет флаг, не шифруя второй раз.
+    Возвращает (зашифровано, файлов не найдено).
+    """
+    prefix = '/static/uploads/'
+    done = missing = 0
+    last_id = 0
+    while True:
+        rows = conn.execute('''SELECT id, file_url FROM messages
+                               WHERE id > ? AND file_url LIKE ? AND (COALESCE(flags, 0) & ?) = 0
+                               ORDER BY id LIMIT ?''',
+                            (last_id, prefix + '%', FLAG_FILE_ENCRYPTED, batch_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for message_id, file_url in rows:
+            last_id = message_id
+            path = os.path.join(upload_folder, file_url[len(prefix):])
+            try:
+                if not is_encrypted(path):
+                    cipher.encrypt_file(path, path + '.enc')
+                    os.replace(path + '.enc', path)
+            except FileNotFoundError:
+                missing += 1
+                continue
+            updates.append((FLAG_FILE_ENCRYPTED, message_id))
+        conn.executemany('UPDATE messages SET flags = COALESCE(flags, 0) | ? WHERE id = ?', updates)
+        conn.commit()
+        done += len(updates)
+        print(f'... {done} файлов зашифровано')
+    return done, missing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Шифрование уже загруженных файлов')
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'data1.db'))
+    parser.add_argument('--uploads', default=os.path.join(BASE_DIR, 'static/uploads'))
+    parser.add_argument('--batch', type=int, default=200)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    conn = sqlite3.connect(args.db, timeout=10)
+    done, missing = encrypt_existing(conn, FileCipher(), args.uploads, args.batch)
+    conn.close()
+    print(f'Готово: {done} файлов зашифровано, не найдено: {missing}, '
+          f'{time.perf_counter() - started:.2f} с')
@@ -0,0 +1,284 @@
+"""Плановое обслуживание баз: статистика для планировщика, возврат свободных страниц, checkpoint WAL.
+
+После удалений (сообщения, друзья, отклоненные заявки, очистка истекших)
+страницы остаются в файле как свободные, а без ANALYZE планировщик выбирает
+индексы наугад. Фоновый поток MaintenanceScheduler раз в interval секунд:
+
+- ANALYZE с analysis_limit (читается ограниченное число строк каждого
+  индекса, поэтому проход занимает миллисекунды) и PRAGMA optimize;
+- PRAGMA incremental_vacuum шагами по step_pages страниц - каждый шаг
+  отдельной транзакцией через поток-писатель, блокировка записи держится
+  миллисекунды; за проход не больше max_pages страниц;
+- PRAGMA wal_checkpoint(TRUNCATE) - WAL переписывается в базу и обрезается.
+
+Возврат страниц и checkpoint делаются только в тихое время: если за
+последнюю минуту сообщений было больше quiet_messages, проход ограничивается
+ANALYZE. Из нескольких воркеров проход делает один - тот, кто первым
+отметил время запуска в таблице maintenance_state.
+
+incremental_vacuum работает только с auto_vacuum = INCREMENTAL. Новые базы
+создаются сразу так, уже существующие переводятся один раз полным VACUUM
+(база на это время заблокирована, лучше при остановленном приложении):
+
+    python maintenance.py [--db data1.db] [--index search.db] [--convert]
+
+Для "Мессенджер MAX" - `python manage.py maintenance [--convert]`.
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Раз в сколько секунд обслуживать базы
+MAINTENANCE_INTERVAL = 600
+# Страниц за один шаг incremental_vacuum и не больше стольких за проход
+VACUUM_STEP_PAGES = 256
+VACUUM_MAX_PAGES = 25600
+# Тихое время: не больше стольких сообщений за последнюю минуту
+QUIET_MESSAGES = 30
+# Строк каждого индекса, которые читает ANALYZE
+ANALYSIS_LIMIT = 400
+# Сколько checkpoint ждет читателей, прежде чем сдаться до следующего прохода
+CHECKPOINT_TIMEOUT = 1
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def file_stats(conn, path):
+    """Размер файла и WAL, число страниц и свободных страниц"""
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    try:
+        wal_bytes = os.path.getsize(path + '-wal')
+    except FileNotFoundError:
+        wal_bytes = 0
+    return {
+        'file_bytes': os.path.getsize(path),
+        'wal_bytes': wal_bytes,
+        'page_size': page_size,
+        'page_count': conn.execute('PRAGMA page_count').fetchone()[0],
+        'freelist_pages': conn.execute('PRAGMA freelist_count').fetchone()[0],
+        'auto_vacuum': conn.execute('PRAGMA auto_vacuum').fetchone()[0],
+    }
+
+
+def recent_messages(conn, seconds=60):
+    """Сколько сообщений записано за последние seconds секунд (смотрит только последние 1000)"""
+    try:
+        return conn.execute(f'''SELECT COUNT(*) FROM (SELECT timestamp FROM messages ORDER BY id DESC LIMIT 1000)
+                                WHERE timestamp > datetime('now', '-{int(seconds)} seconds')''').fetchone()[0]
+    except sqlite3.OperationalError:
+        # Базы без таблицы messages (поисковый индекс)
+        return 0
+
+
+def claim(conn, interval, now=None):
+    """Отмечает запуск прохода; False - другой процесс уже делал его меньше interval секунд назад.
+
+    Выполняется в потоке-писателе (MessageWriter.transaction).
+    """
+    now = int(now if now is not None else time.time())
+    conn.execute('CREATE TABLE IF NOT EXISTS maintenance_state (key TEXT PRIMARY KEY, value INTEGER) WITHOUT ROWID')
+    return conn.execute('''INSERT INTO maintenance_state (key, value) VALUES ('last_run', ?1)
+                           ON CONFLICT (key) DO UPDATE SET value = ?1 WHERE value <= ?1 - ?2''',
+                        (now, int(interval) - 1)).rowcount == 1
+
+
+def analyze(conn):
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA optimize')
+
+
+def vacuum_step(conn, pages):
+    """Возвращает в систему до pages свободных страниц; сколько свободных осталось"""
+    # Каждый шаг выполнения этой PRAGMA освобождает одну страницу, а модуль sqlite3
+    # у запроса без колонок делает только один шаг - поэтому вызов на каждую страницу
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    for _ in range(min(int(pages), free)):
+        conn.execute('PRAGMA incremental_vacuum(1)')
+    return conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def checkpoint(path, timeout=CHECKPOINT_TIMEOUT):
+    """Переписывает WAL в базу и обрезает его. Возвращает (busy, страниц в WAL, перенесено)"""
+    conn = sqlite3.connect(path, timeout=timeout)
+    try:
+        return tuple(conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone())
+    finally:
+        conn.close()
+
+
+def maintain(path, transaction, quiet=True, step_pages=VACUUM_STEP_PAGES, max_pages=VACUUM_MAX_PAGES, pause=0.05):
+    """Один проход по базе path. transaction(fn, *args) выполняет fn(conn, *args) в транзакции записи.
+
+    Возвращает отчет: размеры и свободные страницы до и после, время каждого шага.
+    """
+    started = time.perf_counter()
+    conn = sqlite3.connect(path, timeout=5)
+    try:
+        before = file_stats(conn, path)
+        report = {'database': os.path.basename(path), 'before': before, 'quiet': quiet}
+
+        step = time.perf_counter()
+        transaction(analyze)
+        report['analyze_ms'] = round((time.perf_counter() - step) * 1000, 1)
+
+        report['vacuumed_pages'] = 0
+        report['vacuum_ms'] = 0
+        if quiet and before['auto_vacuum'] == AUTO_VACUUM_INCREMENTAL:
+            step = time.perf_counter()
+            free = before['freelist_pages']
+            while free and report['vacuumed_pages'] < max_pages:
+                left = transaction(vacuum_step, min(step_pages, max_pages - report['vacuumed_pages']))
+                report['vacuumed_pages'] += free - left
+                if left >= free:
+                    break
+                free = left
+                time.sleep(pause)
+            report['vacuum_ms'] = round((time.perf_counter() - step) * 1000, 1)
+
+        report['checkpoint'] = None
+        if quiet:
+            step = time.perf_counter()
+            busy, log, done = checkpoint(path)
+            report['checkpoint'] = {'busy': bool(busy), 'wal_frames': log, 'checkpointed': done,
+                                    'ms': round((time.perf_counter() - step) * 1000, 1)}
+
+        report['after'] = file_stats(conn, path)
+    finally:
+        conn.close()
+    report['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return report
+
+
+def enable_incremental_vacuum(path):
+    """Переводит существующую базу в auto_vacuum = INCREMENTAL (полный VACUUM, один раз)"""
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return False
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return True
+    finally:
+        conn.close()
+
+
+def direct_transaction(path):
+    """transaction для запуска из командной строки: свое соединение вместо потока-писателя"""
+    def transaction(fn, *args):
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = fn(conn, *args)
+            conn.execute('COMMIT')
+            return result
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+    return transaction
+
+
+def format_report(report):
+    before, after = report['before'], report['after']
+    line = (f"{report['database']}: {before['file_bytes']} -> {after['file_bytes']} байт, "
+            f"свободных страниц {before['freelist_pages']} -> {after['freelist_pages']}, "
+            f"WAL {before['wal_bytes']} -> {after['wal_bytes']} байт; "
+            f"ANALYZE {report['analyze_ms']} мс, vacuum {report['vacuumed_pages']} стр. за {report['vacuum_ms']} мс")
+    if report['checkpoint']:
+        line += f", checkpoint {report['checkpoint']['ms']} мс{' (занято)' if report['checkpoint']['busy'] else ''}"
+    if not report['quiet']:
+        line += ' (не тихое время: только ANALYZE)'
+    if after['auto_vacuum'] != AUTO_VACUUM_INCREMENTAL:
+        line += ' [auto_vacuum выключен - запустите с --convert]'
+    return f"{line}, всего {report['elapsed_ms']} мс"
+
+
+class MaintenanceScheduler(threading.Thread):
+    """Раз в interval секунд вызывает run() - один проход обслуживания всех баз.
+
+    run() возвращает список отчетов maintain() или None, если проход сделал
+    другой процесс. Последние отчеты и счетчики - в stats().
+    """
+
+    def __init__(self, run, interval=MAINTENANCE_INTERVAL):
+        super().__init__(daemon=True, name='db-maintenance')
+        self.run_pass = run
+        self.interval = interval
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_error = None
+        self.last_reports = []
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run_once(self):
+        reports = self.run_pass()
+        if reports is None:
+            self.skipped += 1
+            return None
+        self.runs += 1
+        self.last_run = time.time()
+        self.last_reports = reports
+        return reports
+
+    def run(self):
+        # Первый проход - не сразу после старта воркера, а через interval
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = repr(e)
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'last_run': self.last_run,
+            'interval_sec': self.interval,
+            'running': self.is_alive(),
+            'reports': self.last_reports,
+        }
+
+
+def run_all(paths, transactions, quiet_messages=QUIET_MESSAGES, **kwargs):
+    """Проход по нескольким базам; тихое ли время - по сообщениям за минуту во всех сразу"""
+    recent = 0
+    for path in paths:
+        conn = sqlite3.connect(path, timeout=5)
+        recent += recent_messages(conn)
+        conn.close()
+    quiet = recent <= quiet_messages
+    return [maintain(path, transaction, quiet, **kwargs) for path, transaction in zip(paths, transactions)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Обслуживание базы: ANALYZE, incremental vacuum, checkpoint')
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'data1.db'))
+    parser.add_argument('--index', default=os.path.join(BASE_DIR, 'search.db'))
+    parser.add_argument('--convert', action='store_true', help='один раз включить auto_vacuum = INCREMENTAL (полный VACUUM)')
+    parser.add_argument('--force', action='store_true', help='vacuum и checkpoint даже при активной переписке')
+    parser.add_argument('--max-pages', type=int, default=VACUUM_MAX_PAGES)
+    args = parser.parse_args()
+    paths = [path for path in (args.db, args.index) if os.path.exists(path)]
+    if args.convert:
+        for path in paths:
+            if enable_incremental_vacuum(path):
+                print(f'{path}: auto_vacuum = INCREMENTAL')
+    reports = run_all(paths, [direct_transaction(path) for path in paths],
+                      quiet_messages=float('inf') if args.force else QUIET_MESSAGES, max_pages=args.max_pages)
+    for report in reports:
+        print(format_report(report))
@@ -0,0 +1,87 @@
+"""Переводит старые сообщения (base64-токен в messages.text) в компактный формат.
+
+Шифротекст переезжает в BLOB-колонку body, файловые сообщения
+(__file__:{type}:{url}) - в колонки msg_type/file_url.
+
+    python migrate_payloads.py [--db data1.db] [--batch 500]
+
+Скрипт можно прерывать и запускать заново: обрабатываются только строки,
+у которых body и file_url еще пустые.
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+from encryption import encrypt_payload, decrypt_legacy, parse_legacy_file
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+NEW_COLUMNS = ("body BLOB", "msg_type TEXT DEFAULT 'text'", "file_url TEXT", "flags INTEGER DEFAULT 0",
+               "key_version INTEGER DEFAULT 1")
+
+
+def add_columns(conn):
+    for column in NEW_COLUMNS:
+        try:
+            conn.execute(f'ALTER TABLE messages ADD COLUMN {column}')
+        except sqlite3.OperationalError:
+            pass
+    conn.commit()
+
+
+def table_bytes(conn):
+    row = conn.execute('''SELECT COALESCE(SUM(LENGTH(text)), 0) + COALESCE(SUM(LENGTH(body)), 0)
+                          + COALESCE(SUM(LENGTH(file_url)), 0) FROM messages''').fetchone()
+    return row[0]
+
+
+def migrate(db_path, batch=500):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    add_columns(conn)
+    before = table_bytes(conn)
+    done = failed = 0
+    last_id = 0
+    started = time.perf_counter()
+    while True:
+        rows = conn.execute('''SELECT id, text, key_version FROM messages
+                               WHERE id > ? AND body IS NULL AND file_url IS NULL AND text IS NOT NULL
+                               ORDER BY id LIMIT ?''', (last_id, batch)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for r in rows:
+            last_id = r['id']
+            try:
+                txt = decrypt_legacy(r['text'], r['key_version'])
+            except Exception:
+                # Нечитаемые строки оставляем как есть, чтобы не потерять данные
+                failed += 1
+                continue
+            file_info = parse_legacy_file(txt)
+            if file_info:
+                updates.append((None, 0, r['key_version'], file_info[0], file_info[1], r['id']))
+            else:
+                body, flags, key_version = encrypt_payload(txt)
+                updates.append((body, flags, key_version, 'text', None, r['id']))
+        conn.executemany('''UPDATE messages SET body = ?, flags = ?, key_version = ?, msg_type = ?, file_url = ?,
+                            text = NULL WHERE id = ?''', updates)
+        conn.commit()
+        done += len(updates)
+        print(f'... {done} сообщений перенесено')
+    elapsed = time.perf_counter() - started
+    after = table_bytes(conn)
+    conn.close()
+    print(f'Готово: {done} перенесено, {failed} с ошибкой расшифровки, {elapsed:.2f} с')
+    print(f'Размер полезной нагрузки: {before} -> {after} байт')
+    return done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'data1.db'))
+    parser.add_argument('--batch', type=int, default=500)
+    args = parser.parse_args()
+    migrate(args.db, args.batch)
@@ -0,0 +1,247 @@
+"""Ограничение частоты запросов (token bucket) и подсказки клиенту, как часто опрашивать.
+
+У каждой пары (пользователь, endpoint) своя "корзина" на burst жетонов, которая
+пополняется со скоростью rate жетонов в секунду. Запрос забирает жетон; если
+корзина пуста - ответ 429 с Retry-After, и до обработчика (и записи last_seen)
+дело не доходит.
+
+Состояние корзин по умолчанию в памяти процесса, т.е. у каждого воркера gunicorn
+свой счетчик. Чтобы лимит был общим, укажите RATE_LIMIT_STORAGE - путь к файлу
+SQLite, который все воркеры используют вместе. Если файл занят дольше секунды,
+запрос пропускается без проверки (счетчик failed_open) - лимит не должен
+превращать каждый запрос в 500.
+
+    app.config['RATE_LIMITS'] = {'main.send': (5, 20)}   # endpoint: (в секунду, запас)
+    init_rate_limit(app)
+"""
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, jsonify, request, session
+
+
+class MemoryBackend:
+    """Корзины в памяти процесса, не больше max_keys.
+
+    Корзины лежат в порядке последнего обращения. Когда места нет, вытесняются
+    самые давние - и только полные (за прошедшее время пополнились бы до
+    burst): такая корзина ничем не отличается от новой. Живые корзины не
+    сбрасываются, поэтому перебор адресов не обнуляет чужие лимиты; если
+    вытеснить нечего, новый ключ получает корзину без запаса.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.failed_open = 0
+        self.evicted = 0
+        # key -> (жетоны, время обновления, сколько секунд до полной корзины)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while len(self._buckets) >= self.max_keys:
+            key, (tokens, updated, refill) = next(iter(self._buckets.items()))
+            if now - updated < refill:
+                return False
+            del self._buckets[key]
+            self.evicted += 1
+        return True
+
+    def take(self, key, rate, burst, now):
+        """Забирает жетон. Возвращает (получилось ли, сколько жетонов осталось)."""
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated, _ = self._buckets.pop(key)
+            elif self._evict(now):
+                tokens, updated = burst, now
+            else:
+                # Все корзины живые - новый ключ ждет, как будто свою уже исчерпал
+                tokens, updated = 0, now
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if len(self._buckets) < self.max_keys:
+                self._buckets[key] = (tokens, now, (burst - tokens) / rate)
+            return allowed, tokens
+
+
+class SQLiteBackend:
+    """Общие корзины для нескольких процессов в отдельном файле SQLite."""
+
+    def __init__(self, path):
+        self.path = path
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL
+        ) WITHOUT ROWID''')
+        conn.commit()
+        conn.close()
+        self._local = threading.local()
+        # Сколько запросов пропущено без проверки, потому что файл корзин был занят
+        self.failed_open = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+        # Счетчики не стоят fsync: после сбоя корзины просто начнутся заново
+        conn.execute('PRAGMA synchronous = OFF')
+        return conn
+
+    def take(self, key, rate, burst, now):
+        try:
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens, updated = row if row else (burst, now)
+                tokens = min(burst, tokens + max(now - updated, 0) * rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                             (key, tokens, now))
+                conn.execute('COMMIT')
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+        except sqlite3.OperationalError:
+            # Файл занят (или недоступен): пропускаем запрос, а не отвечаем 500
+            self.failed_open += 1
+            return True, burst
+        return allowed, tokens
+
+
+class LoadMeter:
+    """Сколько запросов процесс обрабатывает прямо сейчас."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+
+
+class RequestStats:
+    """Сколько запросов к каждому endpoint пришло за последние window секунд и от скольких клиентов.
+
+    Счетчики свои у каждого процесса - с несколькими воркерами это доля общей нагрузки.
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self._counts = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, client, now):
+        second = int(now)
+        with self._lock:
+            counts = self._counts.setdefault(endpoint, {})
+            counts[second] = counts.get(second, 0) + 1
+            clients = self._clients.setdefault(endpoint, {})
+            clients[client] = now
+            if len(counts) > self.window * 2 or len(clients) > 10000:
+                self._prune(endpoint, now)
+
+    def _prune(self, endpoint, now):
+        start = now - self.window
+        self._counts[endpoint] = {s: n for s, n in self._counts[endpoint].items() if s >= start}
+        self._clients[endpoint] = {c: t for c, t in self._clients[endpoint].items() if t >= start}
+
+    def report(self, now):
+        result = {}
+        with self._lock:
+            for endpoint in list(self._counts):
+                self._prune(endpoint, now)
+                total = sum(self._counts[endpoint].values())
+                clients = len(self._clients[endpoint])
+                result[endpoint] = {
+                    'requests_per_sec': round(total / self.window, 3),
+                    'clients': clients,
+                    'per_client_per_min': round(total * 60 / self.window / clients, 2) if clients else 0,
+                }
+        return result
+
+
+def poll_hint(idle_seconds, busy=False):
+    """Через сколько миллисекунд клиенту опросить сервер снова.
+
+    Живой диалог опрашиваем часто, затихший - реже; под нагрузкой все вдвое реже.
+    """
+    if idle_seconds is None or idle_seconds > 600:
+        interval = 10000
+    elif idle_seconds > 60:
+        interval = 5000
+    else:
+        interval = 2000
+    return interval * 2 if busy else interval
+
+
+def next_poll_ms(idle_seconds=None):
+    meter = current_app.extensions.get('load_meter')
+    # Больше запросов в работе, чем потоков у воркера - сервер не успевает
+    busy = meter is not None and meter.in_flight > current_app.config['RATE_LIMIT_BUSY_REQUESTS']
+    return poll_hint(idle_seconds, busy)
+
+
+def client_key():
+    user_id = session.get('user_id')
+    return f'u{user_id}' if user_id else f'ip{request.remote_addr}'
+
+
+def init_rate_limit(app):
+    """Подключает лимиты. Вызывать до register_blueprint, чтобы проверка шла раньше
+    before_request блюпринта (обновления last_seen)."""
+    app.config.setdefault('RATE_LIMITS', {})
+    app.config.setdefault('RATE_LIMIT_STORAGE', None)
+    app.config.setdefault('RATE_LIMIT_BUSY_REQUESTS', 8)
+    storage = app.config['RATE_LIMIT_STORAGE']
+    backend = SQLiteBackend(storage) if storage else MemoryBackend()
+    meter = LoadMeter()
+    stats = RequestStats()
+    app.extensions['rate_limit_backend'] = backend
+    app.extensions['load_meter'] = meter
+    app.extensions['request_stats'] = stats
+
+    @app.before_request
+    def check_rate_limit():
+        meter.enter()
+        rule = app.config['RATE_LIMITS'].get(request.endpoint)
+        if rule is None:
+            return None
+        rate, burst = rule
+        key = client_key()
+        now = time.time()
+        stats.record(request.endpoint, key, now)
+        allowed, tokens = backend.take(f'{key}:{request.endpoint}', rate, burst, now)
+        if allowed:
+            return None
+        retry_after = max(1, math.ceil((1 - tokens) / rate))
+        response = jsonify({
+            'status': 'error',
+            'error': 'Слишком много запросов, попробуйте позже',
+            'retry_after': retry_after,
+            'next_poll_ms': retry_after * 1000,
+        })
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    @app.teardown_request
+    def leave_request(exc):
+        meter.leave()
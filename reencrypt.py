@@ -0,0 +1,120 @@
+"""Фоновое перешифрование сообщений текущим ключом из связки.
+
+Строки обрабатываются небольшими пачками, каждая пачка - отдельная короткая
+транзакция, между пачками поток спит. Поэтому чат продолжает работать,
+пока старые сообщения постепенно переезжают на новый ключ.
+
+    MESSENGER_KEYS="2:новый,1:старый" python reencrypt.py [--db data1.db] [--columns body,text]
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+from encryption import keyring, rotate_value
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class ReencryptWorker(threading.Thread):
+    def __init__(self, db_path, table='messages', columns=('body', 'text'), batch_size=200, pause=0.2):
+        super().__init__(daemon=True, name='reencrypt')
+        self.db_path = db_path
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.pause = pause
+        self.target_version = keyring.current_version
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+        self._stop_event = threading.Event()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            conn.execute(f'ALTER TABLE {self.table} ADD COLUMN key_version INTEGER DEFAULT 1')
+        except sqlite3.OperationalError:
+            pass
+        return conn
+
+    def pending(self, conn):
+        return conn.execute(f'SELECT COUNT(*) FROM {self.table} WHERE COALESCE(key_version, 1) < ?',
+                            (self.target_version,)).fetchone()[0]
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        conn = self._connect()
+        self.started_at = time.time()
+        self.total = self.pending(conn)
+        cols = ', '.join(self.columns)
+        last_id = 0
+        while not self._stop_event.is_set():
+            rows = conn.execute(f'''SELECT id, {cols} FROM {self.table}
+                                    WHERE id > ? AND COALESCE(key_version, 1) < ?
+                                    ORDER BY id LIMIT ?''',
+                                (last_id, self.target_version, self.batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                last_id = row[0]
+                try:
+                    values = [rotate_value(v) if v is not None else None for v in row[1:]]
+                except Exception:
+                    self.failed += 1
+                    continue
+                updates.append((*values, self.target_version, row[0]))
+            assignments = ', '.join(f'{c} = ?' for c in self.columns)
+            conn.executemany(f'UPDATE {self.table} SET {assignments}, key_version = ? WHERE id = ?', updates)
+            conn.commit()
+            self.done += len(updates)
+            self._stop_event.wait(self.pause)
+        conn.close()
+        self.finished_at = time.time()
+
+    def stats(self):
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0
+        return {
+            'target_version': self.target_version,
+            'total': self.total,
+            'done': self.done,
+            'failed': self.failed,
+            'remaining': max(self.total - self.done - self.failed, 0),
+            'rows_per_sec': round(self.done / elapsed, 1) if elapsed else 0,
+            'elapsed_sec': round(elapsed, 2),
+            'running': self.is_alive(),
+        }
+
+
+def start_worker(db_path, **kwargs):
+    """Запускает воркер, только если есть строки со старой версией ключа."""
+    worker = ReencryptWorker(db_path, **kwargs)
+    conn = worker._connect()
+    pending = worker.pending(conn)
+    conn.close()
+    if pending:
+        print(f'Перешифрование: {pending} строк до версии ключа {worker.target_version}')
+        worker.start()
+    return worker
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Перешифрование сообщений текущим ключом')
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'data1.db'))
+    parser.add_argument('--columns', default='body,text')
+    parser.add_argument('--batch', type=int, default=200)
+    parser.add_argument('--pause', type=float, default=0.2)
+    args = parser.parse_args()
+    w = start_worker(args.db, columns=tuple(args.columns.split(',')), batch_size=args.batch, pause=args.pause)
+    while w.is_alive():
+        w.join(2)
+        if w.is_alive():
+            print(w.stats())
+    print(w.stats())
@@ -0,0 +1,235 @@
+"""Полнотекстовый поиск по истории сообщений на FTS5.
+
+Общие функции разбора запроса используются обоими приложениями. В "Мессенджер MAX"
+текст хранится открыто, и индекс messages_fts ведется триггерами прямо в его базе.
+
+Основное приложение хранит сообщения зашифрованными, поэтому для него индекс
+лежит в отдельном файле (search.db), а вместо слов в нем записаны их HMAC:
+по файлу индекса нельзя восстановить текст, но можно найти сообщения, в которых
+есть заданное слово. Цена - только поиск целых слов, без префиксов.
+
+Первичное заполнение индекса по уже существующим сообщениям:
+
+    python search_index.py [--db data1.db] [--index search.db] [--batch 2000]
+"""
+import argparse
+import hashlib
+import hmac
+import logging
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+from write_queue import MessageWriter
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Больше слов в запросе не берем - длинный запрос ничего не уточняет, но дорого стоит
+MAX_QUERY_WORDS = 8
+
+WORD_RE = re.compile(r'\w+')
+
+log = logging.getLogger(__name__)
+
+
+def split_words(text):
+    return WORD_RE.findall((text or '').casefold())
+
+
+def strip_diacritics(word):
+    # "ё" и "е", "é" и "e" дают одинаковый хеш
+    return ''.join(ch for ch in unicodedata.normalize('NFKD', word) if not unicodedata.combining(ch))
+
+
+def owner_token(user_id):
+    return f'u{int(user_id)}'
+
+
+def match_expression(words, user_id, peer_id=None, prefix=True):
+    """Строка для MATCH: все слова запроса в тексте и пользователь среди участников.
+
+    Участники сообщения лежат в колонке owners ("u1 u2"), поэтому ограничение
+    "только мои диалоги" проверяется самим индексом, а не фильтром по таблице.
+    С prefix=True последнее слово ищется по началу - его могут еще дописывать.
+    """
+    quoted = ['"%s"' % word.replace('"', '""') for word in words]
+    if prefix:
+        quoted[-1] += '*'
+    terms = ' '.join(quoted)
+    owners = owner_token(user_id)
+    if peer_id is not None:
+        owners += ' AND owners:' + owner_token(peer_id)
+    return f'owners:{owners} AND body:({terms})'
+
+
+def default_key():
+    # Ключ индекса не зависит от ротации ключей шифрования, иначе индекс
+    # пришлось бы перестраивать после каждой смены ключа
+    raw = os.environ.get('MESSENGER_SEARCH_KEY')
+    if raw:
+        return raw.encode()
+    from encryption import ENCRYPTION_KEY
+    return hmac.new(ENCRYPTION_KEY, b'search-index', hashlib.sha256).digest()
+
+
+class SearchIndex:
+    """Индекс зашифрованного чата в отдельной базе с хешированными словами."""
+
+    def __init__(self, path, key=None):
+        self.path = path
+        self.key = key or default_key()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        # Записи в индекс идут в фоне и никто не ждет их результата: ошибки
+        # считаются здесь (stats), иначе поиск молча разойдется с сообщениями
+        self.failed = 0
+        self.last_error = None
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def init(self):
+        exists = os.path.exists(self.path)
+        conn = self.connect()
+        # Страницы удаленных документов возвращаются по шагам (maintenance.py)
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        # body - HMAC слов через пробел; FTS5 берет содержимое отсюда
+        conn.execute('''CREATE TABLE IF NOT EXISTS search_docs (
+            id INTEGER PRIMARY KEY,
+            owners TEXT NOT NULL,
+            body TEXT NOT NULL
+        )''')
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+            body, owners, content='search_docs', content_rowid='id'
+        )''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS search_docs_ai AFTER INSERT ON search_docs BEGIN
+            INSERT INTO search_fts (rowid, body, owners) VALUES (new.id, new.body, new.owners);
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS search_docs_ad AFTER DELETE ON search_docs BEGIN
+            INSERT INTO search_fts (search_fts, rowid, body, owners) VALUES ('delete', old.id, old.body, old.owners);
+        END''')
+        # Докуда дошло первичное заполнение (новые сообщения индексируются сразу)
+        conn.execute('CREATE TABLE IF NOT EXISTS search_meta (key TEXT PRIMARY KEY, value INTEGER)')
+        conn.commit()
+        conn.close()
+        if not exists:
+            os.chmod(self.path, 0o600)
+
+    @property
+    def writer(self):
+        # Поток-писатель создается при первой записи - уже в воркере, а не до fork
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = MessageWriter(self.path)
+        return self._writer
+
+    def _submit(self, sql, params):
+        self.writer.submit(sql, params).add_done_callback(self._check_write)
+
+    def _check_write(self, future):
+        error = future.exception()
+        if error is None:
+            return
+        self.failed += 1
+        self.last_error = repr(error)
+        log.error('Запись в поисковый индекс %s не удалась: %r', self.path, error)
+
+    def stats(self):
+        return {
+            'failed_writes': self.failed,
+            'last_error': self.last_error,
+            'writer': self._writer.stats() if self._writer is not None else None,
+        }
+
+    def _term(self, word):
+        return hmac.new(self.key, strip_diacritics(word).encode(), hashlib.sha256).hexdigest()[:16]
+
+    def document(self, message_id, sender_id, receiver_id, text):
+        owners = ' '.join(sorted({owner_token(sender_id), owner_token(receiver_id)}))
+        return (message_id, owners, ' '.join(self._term(w) for w in split_words(text)))
+
+    def add(self, message_id, sender_id, receiver_id, text):
+        """Индексирует сообщение в фоне - отправка не ждет записи в индекс"""
+        self._submit('INSERT OR REPLACE INTO search_docs (id, owners, body) VALUES (?, ?, ?)',
+                     self.document(message_id, sender_id, receiver_id, text))
+
+    def add_many(self, conn, docs):
+        conn.executemany('INSERT OR REPLACE INTO search_docs (id, owners, body) VALUES (?, ?, ?)', docs)
+
+    def remove(self, message_id):
+        self._submit('DELETE FROM search_docs WHERE id = ?', (message_id,))
+
+    def remove_many(self, message_ids):
+        """Убирает из индекса пачку сообщений одной записью в очередь (очистка истекших)"""
+        self._submit(self.remove_docs, ([(message_id,) for message_id in message_ids],))
+
+    def remove_docs(self, conn, ids):
+        conn.executemany('DELETE FROM search_docs WHERE id = ?', ids)
+
+    def search(self, user_id, query, limit=20, offset=0, peer_id=None):
+        """id сообщений пользователя по релевантности (bm25), лучшие первыми"""
+        words = split_words(query)[:MAX_QUERY_WORDS]
+        if not words:
+            return []
+        expression = match_expression([self._term(w) for w in words], user_id, peer_id, prefix=False)
+        conn = self.connect()
+        rows = conn.execute('''
+            SELECT rowid FROM search_fts WHERE search_fts MATCH ?
+            ORDER BY bm25(search_fts, 1.0, 0.0), rowid DESC
+            LIMIT ? OFFSET ?
+        ''', (expression, limit, offset)).fetchall()
+        conn.close()
+        return [r[0] for r in rows]
+
+
+def backfill(index, db_path, batch_size=2000):
+    """Индексирует старые сообщения пачками, продолжая с места остановки."""
+    # Импорт здесь: app тянет Flask, а сам модуль индекса нужен и без него
+    from app import message_content
+    index.init()
+    conn = sqlite3.connect(db_path, timeout=5)
+    conn.row_factory = sqlite3.Row
+    out = index.connect()
+    row = out.execute("SELECT value FROM search_meta WHERE key = 'backfill_id'").fetchone()
+    last_id = row[0] if row else 0
+    stop_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+    done = 0
+    while last_id < stop_id:
+        rows = conn.execute('''
+            SELECT id, sender_id, receiver_id, text, body, msg_type, file_url, flags, key_version
+            FROM messages WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+        ''', (last_id, stop_id, batch_size)).fetchall()
+        if not rows:
+            break
+        docs = []
+        for r in rows:
+            try:
+                msg_type, text, _ = message_content(r)
+            except Exception:
+                continue
+            if msg_type == 'text' and text:
+                docs.append(index.document(r['id'], r['sender_id'], r['receiver_id'], text))
+        last_id = rows[-1]['id']
+        index.add_many(out, docs)
+        out.execute("INSERT OR REPLACE INTO search_meta (key, value) VALUES ('backfill_id', ?)", (last_id,))
+        out.commit()
+        done += len(docs)
+    conn.close()
+    out.close()
+    return done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Первичное заполнение поискового индекса')
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'data1.db'))
+    parser.add_argument('--index', default=os.path.join(BASE_DIR, 'search.db'))
+    parser.add_argument('--batch', type=int, default=2000)
+    args = parser.parse_args()
+    count = backfill(SearchIndex(args.index), args.db, args.batch)
+    print(f'Проиндексировано сообщений: {count}')
@@ -0,0 +1,116 @@
+"""Загрузка файла частями: смещения, лишние данные, завершение и очистка."""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chunked_upload import UploadError, UploadStaging
+
+USER = 1
+OTHER_USER = 2
+
+
+class UploadStagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.staging = UploadStaging(os.path.join(self.directory, 'staging'), max_size=1000, max_age=60)
+        self.data = os.urandom(100)
+        self.upload_id = self.staging.init(USER, OTHER_USER, 'photo.png', len(self.data))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, offset, data, user_id=USER):
+        return self.staging.write(self.upload_id, user_id, offset, io.BytesIO(data))
+
+    def test_parts_in_order_and_retry(self):
+        self.assertEqual(self.write(0, self.data[:40]), 40)
+        # Повтор уже принятой части (ответ потерялся) не ломает файл
+        self.assertEqual(self.write(20, self.data[20:40]), 40)
+        self.assertEqual(self.write(40, self.data[40:]), 100)
+        self.assertEqual(self.staging.status(self.upload_id, USER), (100, 100))
+        target = os.path.join(self.directory, 'uploads', 'photo.png')
+        meta = self.staging.finish(self.upload_id, USER, target)
+        self.assertEqual(meta['filename'], 'photo.png')
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(os.listdir(self.staging.directory), [])
+
+    def test_offset_gap_returns_received(self):
+        self.write(0, self.data[:30])
+        for offset in (31, 100, -1, None):
+            with self.subTest(offset=offset):
+                with self.assertRaises(UploadError) as raised:
+                    self.write(offset, self.data[30:])
+                self.assertEqual(raised.exception.status, 409)
+                self.assertEqual(raised.exception.offset, 30)
+        self.assertEqual(self.staging.status(self.upload_id, USER), (30, 100))
+
+    def test_oversize_body_is_rejected(self):
+        self.write(0, self.data[:50])
+        with self.assertRaises(UploadError) as raised:
+            self.write(50, os.urandom(51))
+        self.assertEqual(raised.exception.status, 400)
+        received, size = self.staging.status(self.upload_id, USER)
+        self.assertLessEqual(received, size)
+        self.assertEqual(self.write(50, self.data[50:]), 100)
+
+    def test_init_size_limits(self):
+        for size in (0, -1, 1001):
+            with self.subTest(size=size):
+                with self.assertRaises(UploadError) as raised:
+                    self.staging.init(USER, OTHER_USER, 'big.bin', size)
+                self.assertEqual(raised.exception.status, 413)
+
+    def test_unknown_upload_or_user(self):
+        for upload_id, user_id in ((self.upload_id, OTHER_USER), ('0' * 32, USER), ('../../etc/passwd', USER)):
+            with self.subTest(upload_id=upload_id, user_id=user_id):
+                with self.assertRaises(UploadError) as raised:
+                    self.staging.status(upload_id, user_id)
+                self.assertEqual(raised.exception.status, 404)
+
+    def test_finish_incomplete(self):
+        self.write(0, self.data[:99])
+        with self.assertRaises(UploadError) as raised:
+            self.staging.finish(self.upload_id, USER, os.path.join(self.directory, 'uploads', 'x'))
+        self.assertEqual((raised.exception.status, raised.exception.offset), (409, 99))
+
+    def test_failed_transform_keeps_part(self):
+        self.write(0, self.data)
+        target = os.path.join(self.directory, 'uploads', 'photo.png')
+
+        def broken(source, target_path):
+            raise OSError('диск заполнен')
+
+        with self.assertRaises(OSError):
+            self.staging.finish(self.upload_id, USER, target, transform=broken)
+        self.assertEqual(self.staging.status(self.upload_id, USER), (100, 100))
+        self.staging.finish(self.upload_id, USER, target, transform=shutil.copyfile)
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_purge_keeps_active_upload(self):
+        meta_path = os.path.join(self.staging.directory, self.upload_id + '.json')
+        part_path = os.path.join(self.staging.directory, self.upload_id + '.part')
+        old = time.time() - 3600
+        # Метаданные старые, но часть пришла только что - загрузка еще идет
+        os.utime(meta_path, (old, old))
+        self.write(0, self.data[:10])
+        stale = self.staging.init(USER, OTHER_USER, 'old.png', 10)
+        for suffix in ('.json', '.part'):
+            path = os.path.join(self.staging.directory, stale + suffix)
+            os.utime(path, (old, old))
+        self.staging._last_purge = 0
+        self.staging.purge()
+        self.assertEqual(sorted(os.listdir(self.staging.directory)),
+                         sorted([os.path.basename(meta_path), os.path.basename(part_path)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
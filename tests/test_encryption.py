@@ -0,0 +1,87 @@
+"""Шифрование текста сообщений: связка ключей разных версий и флаг сжатия."""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.fernet import Fernet, InvalidToken
+
+import encryption
+from encryption import (COMPRESS_THRESHOLD, FLAG_COMPRESSED, KeyRing, decrypt_legacy, decrypt_payload,
+                        encrypt_payload, encrypt_text, rotate_value)
+
+KEY_1 = encryption.ENCRYPTION_KEY
+KEY_2 = Fernet.generate_key()
+
+SHORT = 'привет, мир'
+LONG = 'длинное сообщение, которое хорошо сжимается. ' * 20
+
+
+class PayloadTest(unittest.TestCase):
+
+    def test_short_text_is_not_compressed(self):
+        body, flags, version = encrypt_payload(SHORT)
+        self.assertIsInstance(body, bytes)
+        self.assertFalse(flags & FLAG_COMPRESSED)
+        self.assertEqual(decrypt_payload(body, flags, version), SHORT)
+
+    def test_long_text_is_compressed(self):
+        self.assertGreaterEqual(len(LONG.encode()), COMPRESS_THRESHOLD)
+        body, flags, version = encrypt_payload(LONG)
+        self.assertTrue(flags & FLAG_COMPRESSED)
+        self.assertLess(len(body), len(LONG.encode()))
+        self.assertEqual(decrypt_payload(body, flags, version), LONG)
+
+    def test_incompressible_text_keeps_flag_clear(self):
+        text = os.urandom(300).hex()[:COMPRESS_THRESHOLD + 50]
+        body, flags, version = encrypt_payload(text)
+        self.assertEqual(decrypt_payload(body, flags, version), text)
+
+    def test_empty_text(self):
+        body, flags, version = encrypt_payload('')
+        self.assertEqual(decrypt_payload(body, flags, version), '')
+
+
+class KeyRotationTest(unittest.TestCase):
+
+    def test_old_messages_readable_after_new_key(self):
+        with mock.patch.object(encryption, 'keyring', KeyRing({1: KEY_1})):
+            old_body, old_flags, old_version = encrypt_payload(LONG)
+            old_token, _ = encrypt_text(SHORT)
+        self.assertEqual(old_version, 1)
+
+        with mock.patch.object(encryption, 'keyring', KeyRing({1: KEY_1, 2: KEY_2})):
+            new_body, new_flags, new_version = encrypt_payload(SHORT)
+            self.assertEqual(new_version, 2)
+            self.assertEqual(decrypt_payload(old_body, old_flags, old_version), LONG)
+            self.assertEqual(decrypt_payload(new_body, new_flags, new_version), SHORT)
+            # Неверная или неизвестная версия - перебор всех ключей связки
+            self.assertEqual(decrypt_payload(old_body, old_flags, 2), LONG)
+            self.assertEqual(decrypt_payload(old_body, old_flags, None), LONG)
+            self.assertEqual(decrypt_legacy(old_token, 1), SHORT)
+
+    def test_rotated_values_need_only_the_new_key(self):
+        with mock.patch.object(encryption, 'keyring', KeyRing({1: KEY_1})):
+            body, flags, _ = encrypt_payload(LONG)
+            token, _ = encrypt_text(SHORT)
+        with mock.patch.object(encryption, 'keyring', KeyRing({1: KEY_1, 2: KEY_2})):
+            rotated_body = rotate_value(body)
+            rotated_token = rotate_value(token)
+        self.assertIsInstance(rotated_body, bytes)
+        self.assertIsInstance(rotated_token, str)
+        with mock.patch.object(encryption, 'keyring', KeyRing({2: KEY_2})):
+            self.assertEqual(decrypt_payload(rotated_body, flags, 2), LONG)
+            self.assertEqual(decrypt_legacy(rotated_token, 2), SHORT)
+            # Неперешифрованное без старого ключа не читается
+            with self.assertRaises(InvalidToken):
+                decrypt_payload(body, flags, 1)
+
+    def test_empty_key_ring_is_an_error(self):
+        with self.assertRaises(ValueError):
+            KeyRing({})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Исчезающие сообщения: удаление истекших пачками и фильтр в выборках."""
+import os
+import sqlite3
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from expiry import EXPIRES_INDEX_SQL, ExpirySweeper, delete_expired, expires_at, not_expired
+
+NOW = 1_000_000
+
+
+class DeleteExpiredTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, file_url TEXT, expires_at INTEGER)')
+        self.conn.execute(EXPIRES_INDEX_SQL)
+        rows = [(None, None), ('/static/uploads/a.png', NOW - 10), (None, NOW - 5), (None, NOW),
+                (None, NOW + 1), ('/static/uploads/b.png', NOW - 20)]
+        self.conn.executemany('INSERT INTO messages (file_url, expires_at) VALUES (?, ?)', rows)
+
+    def ids(self):
+        return [row[0] for row in self.conn.execute('SELECT id FROM messages ORDER BY id')]
+
+    def test_deletes_only_expired(self):
+        deleted = delete_expired(self.conn, NOW, 100, 'id, file_url')
+        self.assertEqual(sorted(deleted), [(2, '/static/uploads/a.png'), (3, None), (4, None),
+                                           (6, '/static/uploads/b.png')])
+        # Бессрочное и еще не истекшее остаются
+        self.assertEqual(self.ids(), [1, 5])
+        self.assertEqual(delete_expired(self.conn, NOW, 100), [])
+
+    def test_limit_takes_oldest_first(self):
+        self.assertEqual(sorted(delete_expired(self.conn, NOW, 2)), [(2,), (6,)])
+        self.assertEqual(self.ids(), [1, 3, 4, 5])
+
+    def test_not_expired_filter(self):
+        self.conn.execute('UPDATE messages SET expires_at = ? WHERE id = 5', (int(time.time()) + 60,))
+        rows = self.conn.execute(f'SELECT id FROM messages WHERE {not_expired()} ORDER BY id').fetchall()
+        self.assertEqual(rows, [(1,), (5,)])
+
+    def test_expires_at(self):
+        self.assertIsNone(expires_at(0, NOW))
+        self.assertIsNone(expires_at(None, NOW))
+        self.assertEqual(expires_at(3600, NOW), NOW + 3600)
+
+
+class ExpirySweeperTest(unittest.TestCase):
+
+    def test_run_once_repeats_until_nothing_left(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, expires_at INTEGER)')
+        conn.executemany('INSERT INTO messages (expires_at) VALUES (?)', [(NOW - i,) for i in range(25)])
+        sweeper = ExpirySweeper(lambda: len(delete_expired(conn, NOW, 10)), pause=0)
+        self.assertEqual(sweeper.run_once(), 25)
+        # 10 + 10 + 5 и пустой проход, после которого поток засыпает
+        self.assertEqual(sweeper.stats()['batches'], 4)
+        self.assertEqual(sweeper.stats()['deleted'], 25)
+        self.assertEqual(sweeper.run_once(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""Шифрование файлов по сегментам: чтение, seek и Range на границах сегментов."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.exceptions import InvalidTag
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import FileWrapper
+
+from file_crypto import HEADER, TAG_SIZE, FileCipher, is_encrypted
+
+SEGMENT = 16
+# Пустой файл, меньше сегмента, ровно один и два сегмента, на байт больше
+SIZES = (0, 1, SEGMENT - 1, SEGMENT, 2 * SEGMENT, 2 * SEGMENT + 1, 5 * SEGMENT + 7)
+
+
+class FileCipherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cipher = FileCipher(os.urandom(32), segment_size=SEGMENT)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def encrypt(self, data):
+        source = os.path.join(self.directory, 'plain')
+        target = os.path.join(self.directory, f'enc{len(data)}')
+        with open(source, 'wb') as f:
+            f.write(data)
+        self.assertEqual(self.cipher.encrypt_file(source, target), len(data))
+        return target
+
+    def test_read_whole_file(self):
+        for size in SIZES:
+            with self.subTest(size=size):
+                data = os.urandom(size)
+                path = self.encrypt(data)
+                self.assertTrue(is_encrypted(path))
+                with self.cipher.open(path) as reader:
+                    self.assertEqual(reader.size, size)
+                    self.assertEqual(reader.read(), data)
+                    self.assertEqual(reader.read(), b'')
+
+    def test_empty_file_is_one_tag(self):
+        path = self.encrypt(b'')
+        self.assertEqual(os.path.getsize(path), HEADER.size + TAG_SIZE)
+
+    def test_seek_and_read_across_boundaries(self):
+        for size in SIZES:
+            data = os.urandom(size)
+            path = self.encrypt(data)
+            with self.cipher.open(path) as reader:
+                points = sorted({0, 1, SEGMENT - 1, SEGMENT, SEGMENT + 1, 2 * SEGMENT, size - 1, size, size + 5})
+                for start in points:
+                    for length in (0, 1, SEGMENT - 1, SEGMENT, SEGMENT + 1, 3 * SEGMENT):
+                        with self.subTest(size=size, start=start, length=length):
+                            self.assertEqual(reader.seek(start), max(start, 0))
+                            self.assertEqual(reader.read(length), data[max(start, 0):max(start, 0) + length])
+                reader.seek(-3, os.SEEK_END)
+                self.assertEqual(reader.read(), data[-3:] if size >= 3 else data)
+
+    def test_range_request(self):
+        for size in SIZES:
+            data = os.urandom(size)
+            path = self.encrypt(data)
+            for first, last in ((0, 0), (SEGMENT - 1, SEGMENT), (SEGMENT, 2 * SEGMENT - 1), (size - 1, size - 1)):
+                if not 0 <= first <= last < size:
+                    continue
+                with self.subTest(size=size, range=(first, last)):
+                    environ = EnvironBuilder(headers={'Range': f'bytes={first}-{last}'}).get_environ()
+                    with self.cipher.open(path) as reader:
+                        response = Response(FileWrapper(reader), direct_passthrough=True)
+                        response.make_conditional(environ, accept_ranges=True, complete_length=reader.size)
+                        self.assertEqual(response.status_code, 206)
+                        self.assertEqual(response.headers['Content-Range'], f'bytes {first}-{last}/{size}')
+                        self.assertEqual(b''.join(response.response), data[first:last + 1])
+
+    def test_tampered_segment_is_rejected(self):
+        path = self.encrypt(os.urandom(3 * SEGMENT))
+        with open(path, 'r+b') as f:
+            f.seek(HEADER.size + SEGMENT + TAG_SIZE + 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 1]))
+        with self.cipher.open(path) as reader:
+            self.assertEqual(len(reader.read(SEGMENT)), SEGMENT)
+            with self.assertRaises(InvalidTag):
+                reader.read(1)
+
+    def test_truncated_file_is_rejected(self):
+        # Отрезанный последний сегмент: предпоследний не помечен последним в nonce
+        path = self.encrypt(os.urandom(3 * SEGMENT))
+        with open(path, 'r+b') as f:
+            f.truncate(HEADER.size + 2 * (SEGMENT + TAG_SIZE))
+        with self.cipher.open(path) as reader:
+            with self.assertRaises(InvalidTag):
+                reader.read()
+
+    def test_other_key_is_rejected(self):
+        path = self.encrypt(b'secret')
+        with FileCipher(os.urandom(32), segment_size=SEGMENT).open(path) as reader:
+            with self.assertRaises(InvalidTag):
+                reader.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Сборка мусора в uploads: файлы, на которые ссылаются сообщения, не удаляются."""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from upload_gc import collect, collect_root
+
+OLD = time.time() - 2 * 24 * 3600
+
+
+class CollectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def make(self, relative, old=True, size=10):
+        path = os.path.join(self.root, *relative.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        if old:
+            os.utime(path, (OLD, OLD))
+        return path
+
+    def remaining(self):
+        found = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                found.append(os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, '/'))
+        return sorted(found)
+
+    def test_referenced_files_survive(self):
+        referenced = {'a.png', 'nested/deep/c.png'}
+        for relative in ('a.png', 'b.png', 'nested/deep/c.png', 'nested/d.png'):
+            self.make(relative)
+        self.make('young.png', old=False)
+        seen = []
+
+        def lookup(paths):
+            seen.append(len(paths))
+            return {path for path in paths if path in referenced}
+
+        report = collect(self.root, lookup, delete=True, batch_size=2)
+        self.assertEqual(self.remaining(), ['a.png', 'nested/deep/c.png', 'young.png'])
+        self.assertEqual((report['scanned'], report['young'], report['referenced']), (5, 1, 2))
+        self.assertEqual((report['orphans'], report['deleted'], report['deleted_bytes']), (2, 2, 20))
+        self.assertTrue(all(size <= 2 for size in seen))
+
+    def test_dry_run_deletes_nothing(self):
+        for relative in ('a.png', 'b.png'):
+            self.make(relative)
+        report = collect(self.root, lambda paths: set(), delete=False)
+        self.assertTrue(report['dry_run'])
+        self.assertEqual((report['orphans'], report['deleted']), (2, 0))
+        self.assertEqual(self.remaining(), ['a.png', 'b.png'])
+
+    def test_subdir_limits_scan(self):
+        self.make('voice/a.ogg')
+        self.make('b.png')
+        report = collect(self.root, lambda paths: set(), subdir='voice', delete=True)
+        self.assertEqual(report['scanned'], 1)
+        self.assertEqual(self.remaining(), ['b.png'])
+
+    def test_collect_root_uses_file_url(self):
+        db_path = os.path.join(self.root, 'messenger.db')
+        uploads = os.path.join(self.root, 'uploads')
+        conn = sqlite3.connect(db_path)
+        conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, body BLOB, file_url TEXT)')
+        conn.execute('CREATE INDEX idx_messages_file_url ON messages (file_url)')
+        conn.executemany('INSERT INTO messages (body, file_url) VALUES (?, ?)',
+                         [(b'x', '/static/uploads/kept.png'), (b'x', None)])
+        conn.commit()
+        self.make('uploads/kept.png')
+        self.make('uploads/orphan.png')
+        report = collect_root(db_path, uploads, delete=True)
+        self.assertEqual(report['deleted'], 1)
+        self.assertTrue(os.path.exists(os.path.join(uploads, 'kept.png')))
+        self.assertFalse(os.path.exists(os.path.join(uploads, 'orphan.png')))
+
+        # Строка старого формата: ссылки не видно - сборка отказывается работать
+        conn.execute('INSERT INTO messages (body, file_url) VALUES (NULL, NULL)')
+        conn.commit()
+        conn.close()
+        with self.assertRaises(RuntimeError):
+            collect_root(db_path, uploads, delete=True)
+        self.assertTrue(os.path.exists(os.path.join(uploads, 'kept.png')))
+
+
+if __name__ == '__main__':
+    unittest.main()
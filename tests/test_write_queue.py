@@ -0,0 +1,78 @@
+"""Поток-писатель: ошибка одного запроса не роняет остальные запросы пачки."""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from write_queue import MessageWriter
+
+
+def insert_then_fail(conn, value):
+    conn.execute('INSERT INTO items (value) VALUES (?)', (value,))
+    raise RuntimeError('ошибка посреди транзакции')
+
+
+class MessageWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'writer.db')
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)')
+        conn.commit()
+        conn.close()
+        # Долгое ожидание пачки: все запросы теста попадают в одну пачку
+        self.writer = MessageWriter(self.path, max_batch=64, max_wait=0.3)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def values(self):
+        conn = sqlite3.connect(self.path)
+        rows = conn.execute('SELECT value FROM items ORDER BY id').fetchall()
+        conn.close()
+        return [row[0] for row in rows]
+
+    def test_failed_statement_does_not_roll_back_its_batch(self):
+        sql = 'INSERT INTO items (value) VALUES (?)'
+        futures = [
+            self.writer.submit(sql, ('a',)),
+            self.writer.submit(sql, ('b',)),
+            self.writer.submit(sql, (None,)),  # NOT NULL
+            self.writer.submit(sql, ('a',)),   # UNIQUE
+            self.writer.submit(sql, ('c',)),
+        ]
+        for index in (2, 3):
+            with self.assertRaises(sqlite3.IntegrityError):
+                futures[index].result(5)
+        ids = [futures[index].result(5) for index in (0, 1, 4)]
+        self.assertEqual(self.values(), ['a', 'b', 'c'])
+        self.assertEqual(ids, sorted(ids))
+        # Все пять пришли одной пачкой и разобраны по одному после отката
+        self.assertEqual(self.writer.stats()['batches'], 1)
+
+    def test_failed_transaction_leaves_no_partial_writes(self):
+        sql = 'INSERT INTO items (value) VALUES (?)'
+        before = self.writer.submit(sql, ('before',))
+        failed = self.writer.submit(insert_then_fail, ('half-written',))
+        after = self.writer.submit(sql, ('after',))
+        with self.assertRaises(RuntimeError):
+            failed.result(5)
+        before.result(5)
+        after.result(5)
+        self.assertEqual(self.values(), ['before', 'after'])
+
+    def test_transaction_returns_function_result(self):
+        count = self.writer.transaction(lambda conn: conn.execute('SELECT COUNT(*) FROM items').fetchone()[0])
+        self.assertEqual(count, 0)
+        self.assertEqual(self.writer.execute('INSERT INTO items (value) VALUES (?)', ('x',)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
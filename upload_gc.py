@@ -0,0 +1,161 @@
+"""Сборка мусора в папке загрузок: файлы, на которые не ссылается ни одно сообщение.
+
+Такие файлы остаются после удаления сообщения или после неудачной отправки,
+когда файл уже сохранен, а строка в messages так и не появилась.
+
+Mark-and-sweep без списка всех файлов в памяти: папка обходится потоком
+(os.scandir), файлы идут пачками, и для каждой пачки одним запросом по
+индексу проверяется, какие из них упомянуты в messages. Файлы моложе grace
+секунд не трогаются - сообщение о них может быть еще в очереди на запись.
+
+По умолчанию только отчет, удаляет с --delete:
+
+    python upload_gc.py [--db data1.db] [--uploads static/uploads] [--grace 3600] [--delete]
+
+Для "Мессенджер MAX" - `python manage.py gc_uploads`.
+"""
+import argparse
+import os
+import sqlite3
+import time
+from urllib.parse import quote
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Не трогать файлы моложе часа
+GRACE_PERIOD = 3600
+# Сколько файлов проверять одним запросом (лимит параметров SQLite - 999)
+GC_BATCH = 500
+
+
+def scan_files(root, subdir=''):
+    """Файлы под root/subdir по одному: (путь относительно root через '/', os.DirEntry)"""
+    stack = [subdir]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(root, current))
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                relative = f'{current}/{entry.name}' if current else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relative)
+                elif entry.is_file(follow_symlinks=False):
+                    yield relative, entry
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def referenced_in(conn, column, values):
+    """Какие из values встречаются в messages.column - один запрос по индексу"""
+    rows = conn.execute(f'SELECT DISTINCT {column} FROM messages WHERE {column} IN ({",".join("?" * len(values))})',
+                        values).fetchall()
+    return {row[0] for row in rows}
+
+
+def collect(root, referenced, subdir='', grace=GRACE_PERIOD, delete=False, batch_size=GC_BATCH, now=None):
+    """Находит (и с delete=True удаляет) файлы без сообщений.
+
+    referenced(paths) получает пачку путей относительно root и возвращает
+    множество тех, на которые есть ссылки. Возвращает отчет со счетчиками.
+    """
+    started = time.time()
+    cutoff = (now if now is not None else started) - grace
+    report = {'scanned': 0, 'young': 0, 'referenced': 0, 'orphans': 0, 'orphan_bytes': 0,
+              'deleted': 0, 'deleted_bytes': 0, 'errors': 0, 'dry_run': not delete, 'sample': []}
+
+    def old_files():
+        for relative, entry in scan_files(root, subdir):
+            report['scanned'] += 1
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime > cutoff:
+                report['young'] += 1
+                continue
+            yield relative, entry.path, stat.st_size
+
+    for batch in batches(old_files(), batch_size):
+        used = referenced([relative for relative, _, _ in batch])
+        for relative, path, size in batch:
+            if relative in used:
+                report['referenced'] += 1
+                continue
+            report['orphans'] += 1
+            report['orphan_bytes'] += size
+            if len(report['sample']) < 20:
+                report['sample'].append(relative)
+            if delete:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    report['errors'] += 1
+                    continue
+                report['deleted'] += 1
+                report['deleted_bytes'] += size
+    report['elapsed_sec'] = round(time.time() - started, 3)
+    return report
+
+
+def legacy_rows(conn):
+    """Есть ли строки старого формата: ссылка на файл у них внутри зашифрованного text"""
+    return conn.execute('SELECT 1 FROM messages WHERE body IS NULL AND file_url IS NULL LIMIT 1').fetchone() is not None
+
+
+def collect_root(db_path, upload_folder, **kwargs):
+    """Сборка мусора основного приложения: file_url = /static/uploads/<имя>"""
+    conn = sqlite3.connect(f'file:{quote(db_path)}?mode=ro', uri=True, timeout=5)
+    try:
+        if legacy_rows(conn):
+            raise RuntimeError('В базе есть сообщения старого формата - сначала python migrate_payloads.py')
+
+        def referenced(paths):
+            urls = referenced_in(conn, 'file_url', [f'/static/uploads/{path}' for path in paths])
+            return {url[len('/static/uploads/'):] for url in urls}
+
+        return collect(upload_folder, referenced, **kwargs)
+    finally:
+        conn.close()
+
+
+def format_report(report):
+    if report['dry_run']:
+        result = f"будет освобождено {report['orphan_bytes']} байт (запустите с --delete)"
+    else:
+        result = f"удалено {report['deleted']}, освобождено {report['deleted_bytes']} байт"
+    lines = [
+        f"Просмотрено файлов: {report['scanned']}, моложе срока: {report['young']}, "
+        f"используются: {report['referenced']}, без сообщений: {report['orphans']}",
+        f"{result}, ошибок: {report['errors']}, {report['elapsed_sec']} с",
+    ]
+    lines += [f'  {path}' for path in report['sample']]
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Удаление загруженных файлов без сообщений')
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'data1.db'))
+    parser.add_argument('--uploads', default=os.path.join(BASE_DIR, 'static/uploads'))
+    parser.add_argument('--grace', type=int, default=GRACE_PERIOD, help='не трогать файлы моложе стольких секунд')
+    parser.add_argument('--batch', type=int, default=GC_BATCH)
+    parser.add_argument('--delete', action='store_true', help='удалять, а не только показать отчет')
+    args = parser.parse_args()
+    try:
+        report = collect_root(args.db, args.uploads, grace=args.grace, delete=args.delete, batch_size=args.batch)
+    except RuntimeError as e:
+        parser.exit(1, f'{e}\n')
+    print(format_report(report))
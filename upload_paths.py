@@ -0,0 +1,126 @@
+"""Раскладка загрузок по подпапкам: два уровня по хешу имени файла.
+
+В одной папке с миллионами файлов медленно работает и поиск имени, и
+резервное копирование. Поэтому файл лежит в подпапке из первых символов
+md5 своего имени - 256 * 256 папок, в каждой на порядки меньше файлов:
+
+    static/uploads/1700000000_photo.png  ->  static/uploads/3f/a2/1700000000_photo.png
+
+Перенос уже загруженных файлов основного приложения (включая ссылки внутри
+зашифрованных сообщений старого формата __file__:...):
+
+    python upload_paths.py [--db data1.db] [--uploads static/uploads] [--batch 500]
+
+Для "Мессенджер MAX" - `python manage.py fanout_uploads`. Перенос можно
+прерывать и запускать заново: выбираются только строки со старым, плоским путем.
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def fanout_path(filename):
+    """Путь файла внутри папки загрузок: 'ab/cd/имя'"""
+    digest = hashlib.md5(filename.encode()).hexdigest()
+    return f'{digest[:2]}/{digest[2:4]}/{filename}'
+
+
+def move_upload(directory, name):
+    """Переносит directory/name в подпапку по fanout_path. False - файла нет ни там, ни там"""
+    target = os.path.join(directory, fanout_path(name))
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(os.path.join(directory, name), target)
+    except FileNotFoundError:
+        # Уже перенесен прошлым запуском, который прервался до UPDATE
+        return os.path.exists(target)
+    return True
+
+
+def migrate_column(conn, directory, column, prefix, batch_size=500, where='1'):
+    """Переносит файлы строк messages, у которых column = prefix + плоское имя, и переписывает путь.
+
+    Файл переезжает раньше, чем обновляется строка: если перенос прервать между
+    ними, следующий запуск найдет файл уже на новом месте и допишет строку.
+    Возвращает (перенесено, файлов не найдено).
+    """
+    moved = missing = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(f'''
+            SELECT id, {column} FROM messages
+            WHERE id > ? AND {where} AND {column} LIKE ? AND {column} NOT LIKE ?
+            ORDER BY id LIMIT ?
+        ''', (last_id, prefix + '%', prefix + '%/%', batch_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for message_id, value in rows:
+            last_id = message_id
+            name = value[len(prefix):]
+            if not move_upload(directory, name):
+                missing += 1
+            updates.append((prefix + fanout_path(name), message_id))
+        conn.executemany(f'UPDATE messages SET {column} = ? WHERE id = ?', updates)
+        conn.commit()
+        moved += len(updates)
+        print(f'... {moved} путей переписано')
+    return moved, missing
+
+
+def migrate_legacy(conn, directory, batch_size=500):
+    """Ссылки на файлы внутри зашифрованного text (__file__:{type}:{url}) у строк старого формата."""
+    # Импорт здесь: "Мессенджер MAX" этот модуль тоже использует, а шифрования у него нет
+    from encryption import decrypt_legacy, encrypt_text, parse_legacy_file
+    prefix = '/static/uploads/'
+    moved = missing = failed = 0
+    last_id = 0
+    while True:
+        rows = conn.execute('''SELECT id, text, key_version FROM messages
+                               WHERE id > ? AND body IS NULL AND file_url IS NULL AND text IS NOT NULL
+                               ORDER BY id LIMIT ?''', (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for message_id, token, key_version in rows:
+            last_id = message_id
+            try:
+                file_info = parse_legacy_file(decrypt_legacy(token, key_version))
+            except Exception:
+                failed += 1
+                continue
+            if not file_info or not file_info[1].startswith(prefix) or '/' in file_info[1][len(prefix):]:
+                continue
+            name = file_info[1][len(prefix):]
+            if not move_upload(directory, name):
+                missing += 1
+            updates.append((*encrypt_text(f'__file__:{file_info[0]}:{prefix}{fanout_path(name)}'), message_id))
+        conn.executemany('UPDATE messages SET text = ?, key_version = ? WHERE id = ?', updates)
+        conn.commit()
+        moved += len(updates)
+    return moved, missing, failed
+
+
+def migrate(db_path, upload_folder, batch_size=500):
+    conn = sqlite3.connect(db_path, timeout=10)
+    started = time.perf_counter()
+    moved, missing = migrate_column(conn, upload_folder, 'file_url', '/static/uploads/', batch_size)
+    legacy_moved, legacy_missing, failed = migrate_legacy(conn, upload_folder, batch_size)
+    conn.close()
+    print(f'Готово: {moved} сообщений и {legacy_moved} старого формата перенесено, '
+          f'файлов не найдено: {missing + legacy_missing}, ошибок расшифровки: {failed}, '
+          f'{time.perf_counter() - started:.2f} с')
+    return moved + legacy_moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Перенос загрузок в подпапки по хешу имени')
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'data1.db'))
+    parser.add_argument('--uploads', default=os.path.join(BASE_DIR, 'static/uploads'))
+    parser.add_argument('--batch', type=int, default=500)
+    args = parser.parse_args()
+    migrate(args.db, args.uploads, args.batch)
@@ -0,0 +1,138 @@
+"""Групповая запись сообщений через один фоновый поток.
+
+Обработчики запросов не открывают свое соединение для INSERT, а кладут
+запрос в очередь и ждут Future с id новой строки. Поток-писатель забирает
+из очереди пачку (не больше max_batch штук или то, что успело прийти
+за max_wait секунд) и фиксирует ее одним commit - одна синхронизация с
+диском на всю пачку вместо одной на каждое сообщение.
+
+Очередь одна и разбирается по порядку, поэтому сообщения одного диалога
+записываются в том порядке, в котором были отправлены.
+
+Кроме одиночных запросов в очередь можно поставить функцию fn(conn, *args)
+(transaction) - для записей, которым нужно сначала что-то прочитать. Она
+выполняется внутри общей транзакции пачки и не должна сама делать commit.
+"""
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from db_pool import LockStats
+
+_STOP = object()
+
+
+class MessageWriter:
+    def __init__(self, db_path, max_batch=64, max_wait=0.005, timeout=10):
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self.lock_stats = LockStats()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='message-writer')
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, sql, params=()):
+        """Ставит запрос в очередь. Результат Future - lastrowid (или то, что вернула функция)."""
+        future = Future()
+        self.queue.put((sql, params, future))
+        return future
+
+    def execute(self, sql, params=()):
+        """Ставит запрос в очередь и ждет, пока пачка с ним будет зафиксирована."""
+        return self.submit(sql, params).result(self.timeout)
+
+    def transaction(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке-писателе и возвращает ее результат."""
+        return self.submit(fn, args).result(self.timeout)
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'avg_batch': round(self.items / self.batches, 2) if self.batches else 0,
+            'queued': self.queue.qsize(),
+            'lock': self.lock_stats.report(),
+        }
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self.queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _begin(self, conn):
+        # Блокировку записи берем сразу, поэтому время BEGIN IMMEDIATE - это
+        # ожидание других процессов с той же базой (busy_timeout = timeout)
+        started = time.monotonic()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError:
+            self.lock_stats.record(time.monotonic() - started, timed_out=True)
+            raise
+        self.lock_stats.record(time.monotonic() - started)
+
+    def _apply(self, conn, sql, params):
+        if callable(sql):
+            return sql(conn, *params)
+        return conn.execute(sql, params).lastrowid
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+        # В режиме WAL fsync при каждом commit не нужен для целостности
+        conn.execute('PRAGMA synchronous = NORMAL')
+        while True:
+            first = self.queue.get()
+            if first is _STOP:
+                break
+            batch = self._collect(first)
+            try:
+                self._begin(conn)
+                ids = [self._apply(conn, sql, params) for sql, params, _ in batch]
+                conn.commit()
+            except Exception:
+                # Пачка откатывается целиком, и каждый запрос повторяется отдельно,
+                # чтобы ошибка в одном не роняла остальные
+                conn.rollback()
+                self._run_one_by_one(conn, batch)
+            else:
+                for (_, _, future), row_id in zip(batch, ids):
+                    future.set_result(row_id)
+            self.batches += 1
+            self.items += len(batch)
+        conn.close()
+
+    def _run_one_by_one(self, conn, batch):
+        for sql, params, future in batch:
+            try:
+                self._begin(conn)
+                row_id = self._apply(conn, sql, params)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                future.set_exception(e)
+            else:
+                future.set_result(row_id)
@@ -0,0 +1,10 @@
+"""Точка входа для production-сервера:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Фоновое перешифрование здесь не запускается (поток в мастере не переживет
+fork) - для него есть отдельная команда python reencrypt.py.
+"""
+from app import create_app
+
+app = create_app({'PRELOAD': True})
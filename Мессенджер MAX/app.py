@@ -1,25 +1,137 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory
+from werkzeug.local import LocalProxy
+from markupsafe import Markup
 from database import Database
+from sticker_bundle import StickerBundle
+from http_compression import init_compression
+from rate_limit import init_rate_limit, next_poll_ms
+from ephemeral import TypingTracker
+from expiry import TTL_CHOICES, ExpirySweeper
+from maintenance import MaintenanceScheduler, claim, run_all
+from upload_paths import fanout_path
+from chunked_upload import CHUNK_SIZE, CHUNKED_THRESHOLD, UploadError, UploadStaging
 from functools import wraps
 import os
 from werkzeug.utils import secure_filename
 import uuid
+import time
+import threading
 from datetime import datetime
 
-app = Flask(__name__)
-app.secret_key = 'your-secret-key-here'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
-app.config['ALLOWED_IMAGE_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
-app.config['ALLOWED_STICKER_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-db = Database()
+DEFAULT_CONFIG = {
+    'SECRET_KEY': os.environ.get('SECRET_KEY', 'your-secret-key-here'),
+    'MAX_CONTENT_LENGTH': 16 * 1024 * 1024,  # 16MB max file size
+    'DATABASE': os.path.join(BASE_DIR, 'messenger.db'),
+    'UPLOAD_FOLDER': os.path.join(BASE_DIR, 'static/uploads'),
+    # Большие изображения приходят частями (/api/uploads): недокачанное лежит здесь,
+    # а ограничение на файл целиком - UPLOAD_MAX_SIZE, а не MAX_CONTENT_LENGTH
+    'UPLOAD_STAGING': os.path.join(BASE_DIR, 'upload_staging'),
+    'UPLOAD_MAX_SIZE': 64 * 1024 * 1024,
+    'ALLOWED_IMAGE_EXTENSIONS': {'png', 'jpg', 'jpeg', 'gif'},
+    'ALLOWED_STICKER_EXTENSIONS': {'png', 'jpg', 'jpeg', 'gif', 'webp'},
+    'BULK_SEND_LIMIT': 1000,
+    # Лимиты запросов: endpoint -> (запросов в секунду, запас). Общий для всех
+    # воркеров счетчик - путь к файлу SQLite в RATE_LIMIT_STORAGE
+    'RATE_LIMITS': {
+        'messenger.check_updates': (2, 10),
+        'messenger.send_message': (5, 20),
+        'messenger.send_bulk': (0.5, 3),
+        'messenger.upload_image': (1, 5),
+        'messenger.start_upload': (1, 5),
+        'messenger.upload_chunk': (10, 40),
+        'messenger.search_messages': (2, 10),
+        'messenger.api_search_messages': (2, 10),
+        'messenger.update_online_status': (0.2, 3),
+        'messenger.typing': (1, 3),
+    },
+    'RATE_LIMIT_STORAGE': os.environ.get('RATE_LIMIT_STORAGE'),
+    # Число файлов-шардов для сообщений (0 - все в DATABASE). Меняется только
+    # вместе с `python manage.py init --shards N` и `python manage.py shard --shards N`
+    'MESSAGE_SHARDS': int(os.environ.get('MESSAGE_SHARDS', 0)),
+    # Раз в сколько секунд удалять истекшие исчезающие сообщения (0 - не удалять в этом процессе)
+    'EXPIRY_SWEEP_INTERVAL': 30,
+    'EXPIRY_SWEEP_BATCH': 500,
+    # Раз в сколько секунд ANALYZE, возврат свободных страниц и checkpoint основной базы
+    # и шардов (0 - не в этом процессе); тихое время - не больше стольких сообщений за минуту
+    'MAINTENANCE_INTERVAL': 600,
+    'MAINTENANCE_QUIET_MESSAGES': 30,
+    # Подготовить общие данные (схема, каталог стикеров, шаблоны) сразу в create_app -
+    # с gunicorn --preload это делается один раз в мастере до fork воркеров
+    'PRELOAD': False,
+}
+
+bp = Blueprint('messenger', __name__)
+
+# Объекты текущего приложения: у каждого приложения из create_app свои
+db = LocalProxy(lambda: current_app.extensions['messenger_db'])
+sticker_catalog = LocalProxy(lambda: current_app.extensions['sticker_catalog'])
+typing_tracker = LocalProxy(lambda: current_app.extensions['typing'])
+upload_staging = LocalProxy(lambda: current_app.extensions['upload_staging'])
+
+@bp.before_app_request
+def ensure_database():
+    # После первого запроса в процессе - просто проверка флага
+    db.ensure_schema()
+    # Поток очистки запускается при первом запросе - уже в воркере, а не в мастере до fork
+    if 'expiry_sweeper' not in current_app.extensions and current_app.config['EXPIRY_SWEEP_INTERVAL']:
+        start_expiry_sweeper(current_app._get_current_object())
+    if 'maintenance' not in current_app.extensions and current_app.config['MAINTENANCE_INTERVAL']:
+        start_maintenance(current_app._get_current_object())
+
+@bp.teardown_app_request
+def release_connections(exc):
+    # Соединение для чтения, не закрытое из-за исключения в обработчике, возвращается в пул здесь
+    db.release_connections()
+
+def sweep_expired(app):
+    """Одна пачка истекших сообщений вместе с файлами изображений"""
+    database = app.extensions['messenger_db']
+    rows = database.delete_expired_messages(app.config['EXPIRY_SWEEP_BATCH'])
+    for _, _, _, message_type, file_path in rows:
+        if message_type == 'image':
+            remove_upload(app.config['UPLOAD_FOLDER'], file_path)
+    return len(rows)
+
+def run_maintenance(app):
+    """Проход обслуживания основной базы и шардов; None - его недавно сделал другой воркер"""
+    database = app.extensions['messenger_db']
+    if not database.writer.transaction(claim, app.config['MAINTENANCE_INTERVAL']):
+        return None
+    writers = [database.writer] + [database.message_writer(shard) for shard in range(database.shards)]
+    return run_all([database.db_name] + database.shard_names, [writer.transaction for writer in writers],
+                   app.config['MAINTENANCE_QUIET_MESSAGES'])
+
+def remove_upload(upload_folder, file_path):
+    """Удаляет загруженный файл сообщения; уже удаленный - не ошибка"""
+    if file_path:
+        try:
+            os.remove(os.path.join(upload_folder, file_path))
+        except FileNotFoundError:
+            pass
+
+_sweeper_lock = threading.Lock()
+
+def start_expiry_sweeper(app):
+    with _sweeper_lock:
+        if 'expiry_sweeper' not in app.extensions:
+            sweeper = ExpirySweeper(lambda: sweep_expired(app), app.config['EXPIRY_SWEEP_INTERVAL'])
+            app.extensions['expiry_sweeper'] = sweeper
+            sweeper.start()
+
+def start_maintenance(app):
+    with _sweeper_lock:
+        if 'maintenance' not in app.extensions:
+            scheduler = MaintenanceScheduler(lambda: run_maintenance(app), app.config['MAINTENANCE_INTERVAL'])
+            app.extensions['maintenance'] = scheduler
+            scheduler.start()
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
-            return redirect(url_for('login'))
+            return redirect(url_for('.login'))
         db.update_last_seen(session['user_id'])
         return f(*args, **kwargs)
     return decorated_function
@@ -29,23 +141,23 @@ def allowed_file(filename, file_type='image'):
         return False
     ext = filename.rsplit('.', 1)[1].lower()
     if file_type == 'image':
-        return ext in app.config['ALLOWED_IMAGE_EXTENSIONS']
+        return ext in current_app.config['ALLOWED_IMAGE_EXTENSIONS']
     elif file_type == 'sticker':
-        return ext in app.config['ALLOWED_STICKER_EXTENSIONS']
+        return ext in current_app.config['ALLOWED_STICKER_EXTENSIONS']
     return False
 
-@app.route('/policy')
+@bp.route('/policy')
 def policy():
     """Страница пользовательского соглашения"""
     return render_template('pol.html')
 
-@app.route('/')
+@bp.route('/')
 def index():
     if 'user_id' in session:
-        return redirect(url_for('chat'))
+        return redirect(url_for('.chat'))
     return render_template('index.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -58,17 +170,17 @@ def register():
         
         if db.register_user(username, password):
             flash('Регистрация успешна! Теперь вы можете войти.', 'success')
-            return redirect(url_for('login'))
+            return redirect(url_for('.login'))
         else:
             return render_template('register.html', error='Пользователь уже существует')
     
     return render_template('register.html')
     
-@app.route('/user-agreement')
+@bp.route('/user-agreement')
 def user_agreement():
     return render_template('user_agreement.html')  # или p1.html
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -80,32 +192,34 @@ def login():
             session['username'] = user['username']
             session['unique_nickname'] = user['unique_nickname']
             flash('Вход выполнен успешно!', 'success')
-            return redirect(url_for('chat'))
+            return redirect(url_for('.chat'))
         else:
             return render_template('login.html', error='Неверные данные')
     
     return render_template('login.html')
 
-@app.route('/profile')
+@bp.route('/profile')
 @login_required
 def profile():
     user = db.get_user_by_id(session['user_id'])
     friend_requests = db.get_friend_requests(session['user_id'])
     friends = db.get_friends_with_status(session['user_id'])
+    suggestions = db.get_friend_suggestions(session['user_id'])
     
     return render_template('profile.html', 
                          user=user, 
                          friend_requests=friend_requests,
-                         friends=friends)
+                         friends=friends,
+                         suggestions=suggestions)
 
-@app.route('/add_friend', methods=['POST'])
+@bp.route('/add_friend', methods=['POST'])
 @login_required
 def add_friend():
     nickname = request.form.get('nickname', '').strip()
     
     if not nickname:
         flash('Введите ник пользователя', 'error')
-        return redirect(url_for('profile'))
+        return redirect(url_for('.profile'))
     
     if not nickname.startswith('@'):
         nickname = f"@{nickname}"
@@ -117,14 +231,14 @@ def add_friend():
     else:
         flash(result['error'], 'error')
     
-    return redirect(url_for('profile'))
+    return redirect(url_for('.profile'))
 
-@app.route('/respond_friend_request/<int:request_id>/<action>')
+@bp.route('/respond_friend_request/<int:request_id>/<action>')
 @login_required
 def respond_friend_request(request_id, action):
     if action not in ['accept', 'reject']:
         flash('Неверное действие', 'error')
-        return redirect(url_for('profile'))
+        return redirect(url_for('.profile'))
     
     result = db.respond_to_friend_request(request_id, session['user_id'], action)
     
@@ -133,9 +247,9 @@ def respond_friend_request(request_id, action):
     else:
         flash(result['error'], 'error')
     
-    return redirect(url_for('profile'))
+    return redirect(url_for('.profile'))
 
-@app.route('/remove_friend/<int:friend_id>')
+@bp.route('/remove_friend/<int:friend_id>')
 @login_required
 def remove_friend(friend_id):
     success = db.remove_friend(session['user_id'], friend_id)
@@ -145,9 +259,21 @@ def remove_friend(friend_id):
     else:
         flash('Ошибка при удалении', 'error')
     
-    return redirect(url_for('profile'))
+    return redirect(url_for('.profile'))
+
+@bp.route('/api/mutual_friends/<int:user_id>')
+@login_required
+def mutual_friends(user_id):
+    mutual = db.get_mutual_friends(session['user_id'], user_id)
+    return jsonify({'mutual_friends': mutual, 'count': len(mutual)})
 
-@app.route('/search_users')
+@bp.route('/api/friend_suggestions')
+@login_required
+def friend_suggestions():
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    return jsonify({'suggestions': db.get_friend_suggestions(session['user_id'], limit)})
+
+@bp.route('/search_users')
 @login_required
 def search_users():
     query = request.args.get('q', '').strip()
@@ -159,14 +285,53 @@ def search_users():
     
     return render_template('search_users.html', users=users, query=query)
 
-@app.route('/chat')
+SEARCH_PAGE_SIZE = 20
+
+def find_messages():
+    """Общая часть страницы и API поиска: (запрос, страница, строки, есть ли еще)"""
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    # Берем на одну строку больше, чтобы знать, есть ли следующая страница
+    messages = db.search_messages(session['user_id'], query, SEARCH_PAGE_SIZE + 1,
+                                  (page - 1) * SEARCH_PAGE_SIZE, request.args.get('peer_id', type=int))
+    return query, page, messages[:SEARCH_PAGE_SIZE], len(messages) > SEARCH_PAGE_SIZE
+
+@bp.route('/search_messages')
 @login_required
-def chat():
-    friends = db.get_friends_with_status(session['user_id'])
+def search_messages():
+    query, page, messages, has_more = find_messages()
+    return render_template('search_messages.html', query=query, page=page, messages=messages, has_more=has_more)
+
+@bp.route('/api/search_messages')
+@login_required
+def api_search_messages():
+    query, page, messages, has_more = find_messages()
+    return jsonify({
+        'results': [format_message(msg) for msg in messages],
+        'page': page,
+        'has_more': has_more
+    })
+
+def render_sidebar(user_id, receiver_id=None):
+    """Список диалогов для chat.html из кэша фрагментов.
+
+    Ключ включает версию данных пользователя, поэтому пока не пришло новое
+    сообщение и не изменился список друзей, запросы к базе не делаются.
+    """
+    key = ('sidebar', user_id, receiver_id, db.fragments.version(user_id))
+    html = db.fragments.get(key)
+    if html is not None:
+        return html
+    
+    # Курсор для /api/updates берется до подсчетов, и счетчики ограничены им:
+    # все, что придет позже, клиент получит приростом - не потеряет и не посчитает дважды
+    since = db.get_updates_cursor(user_id)
+    friends = db.get_friends_with_status(user_id)
+    unread_counts = db.get_unread_counts(user_id, up_to=since)
     
     for friend in friends:
-        friend['unread_count'] = db.get_unread_count(session['user_id'], friend['id'])
-        last_msg = db.get_last_message_preview(session['user_id'], friend['id'])
+        friend['unread_count'] = unread_counts.get(friend['id'], 0)
+        last_msg = db.get_last_message_preview(user_id, friend['id'])
         friend['last_message'] = last_msg
     
     # Упрощенная сортировка без ошибок
@@ -184,59 +349,74 @@ def chat():
     
     friends.sort(key=get_sort_key)
     
-    stickers = db.get_stickers()
-    
-    return render_template('chat.html', friends=friends, stickers=stickers)
+    html = Markup(render_template('chat_sidebar.html', friends=friends, receiver_id=receiver_id, since=since))
+    db.fragments.set(key, html)
+    return html
 
-@app.route('/chat/<int:receiver_id>')
+@bp.route('/chat')
+@login_required
+def chat():
+    return render_template('chat.html', sidebar=render_sidebar(session['user_id']))
+
+@bp.route('/chat/<int:receiver_id>')
 @login_required
 def chat_with(receiver_id):
     receiver = db.get_user_by_id(receiver_id)
     if not receiver:
         flash('Пользователь не найден', 'error')
-        return redirect(url_for('chat'))
+        return redirect(url_for('.chat'))
     
-    friends = db.get_friends_with_status(session['user_id'])
-    is_friend = any(friend['id'] == receiver_id for friend in friends)
-    
-    if not is_friend:
+    if not db.is_friend(session['user_id'], receiver_id):
         flash('Вы можете писать только друзьям', 'error')
-        return redirect(url_for('chat'))
-    
-    db.mark_messages_as_read(session['user_id'], receiver_id)
+        return redirect(url_for('.chat'))
     
     messages = db.get_messages(session['user_id'], receiver_id)
     
-    for friend in friends:
-        friend['unread_count'] = db.get_unread_count(session['user_id'], friend['id'])
-        last_msg = db.get_last_message_preview(session['user_id'], friend['id'])
-        friend['last_message'] = last_msg
-        friend['active'] = (friend['id'] == receiver_id)
-    
-    # Упрощенная сортировка для списка друзей в чате
-    def get_sort_key(friend):
-        unread = -friend.get('unread_count', 0)
-        
-        if friend.get('status') == 'online':
-            status = 0
-        elif friend.get('status') == 'recently':
-            status = 1
-        else:
-            status = 2
-        
-        return (unread, status)
-    
-    friends.sort(key=get_sort_key)
-    
-    stickers = db.get_stickers()
+    # Отмечаем прочитанным все, что сейчас покажем. Если отметка уже стоит,
+    # ничего не пишем - иначе каждое открытие чата сбрасывало бы кэш списка диалогов
+    incoming = [message[0] for message in messages if message[1] == receiver_id]
+    if incoming and max(incoming) > db.get_read_receipt(receiver_id, session['user_id']):
+        db.mark_messages_as_read(session['user_id'], receiver_id, max(incoming))
     
     return render_template('chat.html', 
                          receiver=receiver,
                          messages=messages,
-                         friends=friends,
-                         stickers=stickers)
+                         sidebar=render_sidebar(session['user_id'], receiver_id),
+                         sticker_bundle_url=sticker_bundle_url(),
+                         message_ttl=db.get_message_ttl(session['user_id'], receiver_id),
+                         read_up_to=db.get_read_receipt(session['user_id'], receiver_id),
+                         chunked_threshold=CHUNKED_THRESHOLD)
+
+@bp.route('/chat/<int:receiver_id>/ttl', methods=['POST'])
+@login_required
+def set_message_ttl(receiver_id):
+    """Исчезающие сообщения: срок жизни новых сообщений диалога, 0 - выключить"""
+    ttl = request.form.get('ttl', type=int)
+    if ttl not in TTL_CHOICES or not db.is_friend(session['user_id'], receiver_id):
+        flash('Нельзя изменить срок хранения сообщений', 'error')
+    else:
+        db.set_message_ttl(session['user_id'], receiver_id, ttl)
+    return redirect(url_for('.chat_with', receiver_id=receiver_id))
 
-@app.route('/send_message', methods=['POST'])
+def wants_json():
+    """Запрос из chat.js (fetch с Accept: application/json), а не обычная форма"""
+    return request.accept_mimetypes.best == 'application/json'
+
+def format_message(msg):
+    """Сообщение в формате /api/check_updates и chat.js"""
+    return {
+        'id': msg[0],
+        'sender_id': msg[1],
+        'receiver_id': msg[2],
+        'message': msg[3],
+        'message_type': msg[4],
+        'file_path': msg[5],
+        'timestamp': msg[6],
+        'sender_name': msg[7],
+        'is_own': msg[1] == session['user_id']
+    }
+
+@bp.route('/send_message', methods=['POST'])
 @login_required
 def send_message():
     receiver_id = request.form['receiver_id']
@@ -248,28 +428,94 @@ def send_message():
     # Обработка изображений
     image_file = request.files.get('image')
     
+    saved = None
+    error = None
     if sticker_id:
         # Отправка стикера
-        db.save_message(session['user_id'], receiver_id, f"sticker:{sticker_id}", 'sticker')
+        saved = (f"sticker:{sticker_id}", 'sticker', None)
     elif image_file and image_file.filename:
         # Отправка изображения
         if allowed_file(image_file.filename, 'image'):
             filename = secure_filename(image_file.filename)
             unique_filename = f"{uuid.uuid4().hex}_{filename}"
-            file_path = os.path.join('images', unique_filename)
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], 'images', unique_filename)
+            # images/ab/cd/имя - подпапки по хешу имени, а не миллион файлов в одной папке
+            file_path = os.path.join('images', fanout_path(unique_filename))
+            save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], file_path)
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
             image_file.save(save_path)
             
-            db.save_message(session['user_id'], receiver_id, 'Изображение', 'image', file_path)
+            saved = ('Изображение', 'image', file_path)
         else:
-            flash('Недопустимый формат изображения', 'error')
+            error = 'Недопустимый формат изображения'
     elif message:
         # Отправка текстового сообщения
-        db.save_message(session['user_id'], receiver_id, message, 'text')
+        saved = (message, 'text', None)
+    
+    message_id = None
+    if saved:
+        try:
+            message_id = db.save_message(session['user_id'], receiver_id, saved[0], saved[1], saved[2])
+        except Exception:
+            # Сообщение не записалось - сохраненное изображение без него никому не нужно
+            remove_upload(current_app.config['UPLOAD_FOLDER'], saved[2])
+            raise
+        typing_tracker.stop(session['user_id'], receiver_id)
+    
+    # chat.js получает только само сообщение, без перерисовки всей страницы
+    if wants_json():
+        if saved is None:
+            return jsonify({'success': False, 'error': error or 'Пустое сообщение'}), 400
+        timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        row = (message_id, session['user_id'], int(receiver_id), saved[0], saved[1], saved[2],
+               timestamp, session['username'])
+        return jsonify({'success': True, 'message': format_message(row)})
+    
+    if error:
+        flash(error, 'error')
+    return redirect(url_for('.chat_with', receiver_id=receiver_id))
+
+@bp.route('/api/send_bulk', methods=['POST'])
+@login_required
+def send_bulk():
+    """Пачка сообщений за один запрос: {"items": [{"receiver_id": 2, "message": "..."}, ...]}"""
+    data = request.get_json(silent=True)
+    items = (data.get('items') if isinstance(data, dict) else None) or []
+    if not isinstance(items, list):
+        return jsonify({'error': 'items должен быть списком'}), 400
+    if len(items) > current_app.config['BULK_SEND_LIMIT']:
+        return jsonify({'error': f"Не больше {current_app.config['BULK_SEND_LIMIT']} сообщений за раз"}), 400
+    
+    # Дружбу проверяем один раз на всю пачку
+    friend_ids = db.get_friend_ids(session['user_id'])
+    
+    results = []
+    to_save = []
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({'success': False, 'error': 'Неверный формат сообщения'})
+            continue
+        message = item.get('message', '')
+        try:
+            receiver_id = int(item.get('receiver_id'))
+        except (TypeError, ValueError):
+            receiver_id = None
+        
+        if receiver_id not in friend_ids:
+            results.append({'success': False, 'error': 'Вы можете писать только друзьям'})
+        elif not isinstance(message, str):
+            results.append({'success': False, 'error': 'Текст сообщения должен быть строкой'})
+        elif not message.strip():
+            results.append({'success': False, 'error': 'Пустое сообщение'})
+        else:
+            results.append(None)
+            to_save.append((receiver_id, message.strip()))
     
-    return redirect(url_for('chat_with', receiver_id=receiver_id))
+    ids = iter(db.save_messages_bulk(session['user_id'], to_save))
+    results = [result or {'success': True, 'id': next(ids)} for result in results]
+    
+    return jsonify({'success': True, 'results': results})
 
-@app.route('/upload_image', methods=['POST'])
+@bp.route('/upload_image', methods=['POST'])
 @login_required
 def upload_image():
     if 'image' not in request.files:
@@ -284,11 +530,16 @@ def upload_image():
     if file and allowed_file(file.filename, 'image'):
         filename = secure_filename(file.filename)
         unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        file_path = os.path.join('images', unique_filename)
-        save_path = os.path.join(app.config['UPLOAD_FOLDER'], 'images', unique_filename)
+        file_path = os.path.join('images', fanout_path(unique_filename))
+        save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], file_path)
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
         file.save(save_path)
         
-        db.save_message(session['user_id'], receiver_id, 'Изображение', 'image', file_path)
+        try:
+            db.save_message(session['user_id'], receiver_id, 'Изображение', 'image', file_path)
+        except Exception:
+            remove_upload(current_app.config['UPLOAD_FOLDER'], file_path)
+            raise
         
         return jsonify({
             'success': True,
@@ -298,70 +549,249 @@ def upload_image():
     
     return jsonify({'error': 'Invalid file format'}), 400
 
-@app.route('/uploads/<path:filename>')
+# Большие изображения - частями с докачкой (протокол в chunked_upload.py)
+@bp.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify({'success': False, 'error': str(e), 'offset': e.offset}), e.status
+
+@bp.route('/api/uploads', methods=['POST'])
+@login_required
+def start_upload():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename') or ''))
+    try:
+        receiver_id, size = int(data.get('receiver_id')), int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Нужны receiver_id и size'}), 400
+    if not allowed_file(filename, 'image'):
+        return jsonify({'success': False, 'error': 'Недопустимый формат изображения'}), 400
+    upload_id = upload_staging.init(session['user_id'], receiver_id, filename, size)
+    return jsonify({'success': True, 'upload_id': upload_id, 'offset': 0, 'chunk_size': CHUNK_SIZE})
+
+@bp.route('/api/uploads/<upload_id>')
+@login_required
+def upload_status(upload_id):
+    offset, size = upload_staging.status(upload_id, session['user_id'])
+    return jsonify({'success': True, 'offset': offset, 'size': size})
+
+@bp.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    offset = upload_staging.write(upload_id, session['user_id'], request.args.get('offset', type=int), request.stream)
+    return jsonify({'success': True, 'offset': offset})
+
+@bp.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    """Изображение принято целиком - переносим его к загрузкам, и только теперь появляется сообщение"""
+    meta = upload_staging.info(upload_id, session['user_id'])
+    unique_filename = f"{uuid.uuid4().hex}_{meta['filename']}"
+    file_path = os.path.join('images', fanout_path(unique_filename))
+    upload_staging.finish(upload_id, session['user_id'], os.path.join(current_app.config['UPLOAD_FOLDER'], file_path))
+    
+    receiver_id = meta['receiver_id']
+    try:
+        message_id = db.save_message(session['user_id'], receiver_id, 'Изображение', 'image', file_path)
+    except Exception:
+        remove_upload(current_app.config['UPLOAD_FOLDER'], file_path)
+        raise
+    typing_tracker.stop(session['user_id'], receiver_id)
+    
+    timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    row = (message_id, session['user_id'], receiver_id, 'Изображение', 'image', file_path,
+           timestamp, session['username'])
+    return jsonify({'success': True, 'message': format_message(row)})
+
+@bp.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
 
-@app.route('/get_stickers')
+def sticker_bundle_url():
+    return url_for('.sticker_bundle_file', version=sticker_catalog.current())
+
+@bp.route('/stickers/<version>.json')
+def sticker_bundle_file(version):
+    current = sticker_catalog.current()
+    if version != current:
+        # Старая версия каталога - отправляем на актуальную
+        return redirect(url_for('.sticker_bundle_file', version=current))
+    response = current_app.response_class(sticker_catalog.payload, mimetype='application/json')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.set_etag(current)
+    return response.make_conditional(request)
+
+@bp.route('/get_stickers')
 @login_required
 def get_stickers():
-    stickers = db.get_stickers()
-    return jsonify({'stickers': stickers})
+    version = sticker_catalog.current()
+    return jsonify({'stickers': sticker_catalog.stickers, 'version': version})
+
+# Порядок полей сообщения в компактном ответе /api/check_updates?compact=1
+COMPACT_FIELDS = ('id', 'sender_id', 'message_type', 'message', 'file_path', 'time')
 
-@app.route('/api/check_updates')
+@bp.route('/api/check_updates')
 @login_required
 def check_updates():
     receiver_id = request.args.get('receiver_id', type=int)
     last_message_id = request.args.get('last_message_id', 0, type=int)
     
     if not receiver_id:
-        return jsonify({'new_messages': [], 'user_status': 'offline'})
-    
-    conn = db.get_connection()
-    cursor = conn.cursor()
+        return jsonify({'new_messages': [], 'user_status': 'offline', 'read_up_to': 0})
     
     # Получаем только новые сообщения с ID больше last_message_id
-    cursor.execute('''
-        SELECT m.id, m.sender_id, m.receiver_id, m.message, m.message_type, m.file_path, 
-               strftime('%Y-%m-%d %H:%M:%S', m.timestamp) as timestamp, u.username
-        FROM messages m
-        JOIN users u ON m.sender_id = u.id
-        WHERE ((m.sender_id = ? AND m.receiver_id = ?) 
-           OR (m.sender_id = ? AND m.receiver_id = ?))
-           AND m.id > ?
-        ORDER BY m.timestamp
-    ''', (session['user_id'], receiver_id, receiver_id, session['user_id'], last_message_id))
-    
-    new_messages = cursor.fetchall()
-    conn.close()
-    
-    formatted_messages = []
-    for msg in new_messages:
-        formatted_messages.append({
-            'id': msg[0],
-            'sender_id': msg[1],
-            'receiver_id': msg[2],
-            'message': msg[3],
-            'message_type': msg[4],
-            'file_path': msg[5],
-            'timestamp': msg[6],
-            'sender_name': msg[7],
-            'is_own': msg[1] == session['user_id']
-        })
+    new_messages = db.get_new_messages(session['user_id'], receiver_id, last_message_id)
+    
+    # Сколько секунд диалог молчит - от этого зависит подсказка next_poll_ms.
+    # Собеседник печатает - опрашиваем часто, чтобы сообщение появилось сразу
+    typing = typing_tracker.is_typing(receiver_id, session['user_id'])
+    idle = 0 if typing else db.get_message_age(new_messages[-1][0] if new_messages else last_message_id)
+    
+    # Чат открыт - новые входящие сразу считаются прочитанными
+    incoming = [msg[0] for msg in new_messages if msg[1] == receiver_id]
+    if incoming:
+        db.mark_messages_as_read(session['user_id'], receiver_id, max(incoming))
+    
+    result = {
+        'user_status': db.get_user_status(receiver_id),
+        'read_up_to': db.get_read_receipt(session['user_id'], receiver_id),
+        'typing': typing,
+        'next_poll_ms': next_poll_ms(idle)
+    }
+    
+    if request.args.get('compact', type=int):
+        # Сообщения массивами в порядке COMPACT_FIELDS, имена отправителей - один раз в users
+        result['new_messages'] = [[msg[0], msg[1], msg[4], msg[3], msg[5], msg[6][11:16]] for msg in new_messages]
+        result['users'] = {msg[1]: msg[7] for msg in new_messages}
+        result['me'] = session['user_id']
+    else:
+        result['new_messages'] = [format_message(msg) for msg in new_messages]
     
-    status = db.get_user_status(receiver_id)
+    return jsonify(result)
+
+UPDATES_LIMIT = 500
+
+@bp.route('/api/updates')
+@login_required
+def updates():
+    """Все изменения для страницы чата одним запросом вместо опроса каждого диалога.
+
+    since - курсор из data-since списка диалогов или прошлого ответа (id
+    последнего учтенного входящего, в шардированном режиме - по id на шард). Открытый диалог (receiver_id) получает сами сообщения в
+    компактном формате COMPACT_FIELDS, остальные диалоги - прирост непрочитанных
+    и новое превью в conversations. Без since отвечает только текущим курсором.
+    """
+    user_id = session['user_id']
+    since = request.args.get('since')
+    receiver_id = request.args.get('receiver_id', type=int)
     
+    found = db.get_updates(user_id, since, receiver_id, UPDATES_LIMIT) if since is not None else None
+    if found is None:
+        # Клиент без курсора (или с курсором от другой схемы шардов) - начинаем с текущего момента
+        return jsonify({'since': db.get_updates_cursor(user_id), 'messages': [], 'conversations': {},
+                        'next_poll_ms': next_poll_ms()})
+    
+    rows, since, more = found
+    
+    messages = []
+    users = {}
+    conversations = {}
+    for msg in rows:
+        # Входящие от открытого собеседника и свои в этот диалог (например, из другой вкладки)
+        if receiver_id and msg[1] in (receiver_id, user_id):
+            messages.append([msg[0], msg[1], msg[4], msg[3], msg[5], msg[6][11:16]])
+            users[msg[1]] = msg[7]
+        else:
+            conversation = conversations.setdefault(msg[1], {'unread_delta': 0})
+            conversation['unread_delta'] += 1
+            conversation['preview'] = msg[3]
+            conversation['time'] = msg[6][11:16]
+    
+    result = {
+        'since': since,
+        'messages': messages,
+        'users': users,
+        'me': user_id,
+        'conversations': conversations,
+        # Упёрлись в лимит - остальное клиент заберет следующим запросом сразу
+        'more': more,
+    }
+    
+    if receiver_id:
+        incoming = [msg[0] for msg in messages if msg[1] == receiver_id]
+        if incoming:
+            db.mark_messages_as_read(user_id, receiver_id, max(incoming))
+        result['read_up_to'] = db.get_read_receipt(user_id, receiver_id)
+        result['user_status'] = db.get_user_status(receiver_id)
+        result['typing'] = typing_tracker.is_typing(receiver_id, user_id)
+    
+    if result.get('typing'):
+        idle = 0
+    else:
+        idle = db.get_message_age(rows[-1][0]) if rows else db.get_cursor_age(since)
+    result['next_poll_ms'] = 0 if result['more'] else next_poll_ms(idle)
+    return jsonify(result)
+
+@bp.route('/api/typing', methods=['POST'])
+@login_required
+def typing():
+    """Отметка "печатаю": только в памяти процесса, собеседник видит ее в ответе на опрос"""
+    receiver_id = request.form.get('receiver_id', type=int)
+    if not receiver_id:
+        return jsonify({'success': False, 'error': 'Не указан собеседник'}), 400
+    # Слишком частые отметки отбрасываются - accepted: false
+    return jsonify({'success': True, 'accepted': typing_tracker.touch(session['user_id'], receiver_id)})
+
+@bp.route('/api/unread_counts')
+@login_required
+def unread_counts():
+    counts = db.get_unread_counts(session['user_id'])
     return jsonify({
-        'new_messages': formatted_messages,
-        'user_status': status
+        'unread': {str(sender_id): count for sender_id, count in counts.items()},
+        'total': sum(counts.values())
     })
 
-@app.route('/faq')
+@bp.route('/api/poll_stats')
+@login_required
+def poll_stats():
+    """Частота опроса по endpoint за последнюю минуту в этом процессе"""
+    stats = current_app.extensions['request_stats']
+    return jsonify({
+        'window_sec': stats.window,
+        'endpoints': stats.report(time.time()),
+        'in_flight': current_app.extensions['load_meter'].in_flight,
+        'rate_limit_failed_open': current_app.extensions['rate_limit_backend'].failed_open
+    })
+
+@bp.route('/api/db_stats')
+@login_required
+def db_stats():
+    """Ожидания блокировок в этом процессе: пул чтения и поток-писатель"""
+    return jsonify(db.lock_report())
+
+@bp.route('/api/expiry_stats')
+@login_required
+def expiry_stats():
+    """Сколько исчезающих сообщений удалил поток очистки этого процесса"""
+    sweeper = current_app.extensions.get('expiry_sweeper')
+    if sweeper is None:
+        return jsonify({'running': False})
+    return jsonify(sweeper.stats())
+
+@bp.route('/api/maintenance_stats')
+@login_required
+def maintenance_stats():
+    """Последний проход обслуживания баз в этом процессе: размеры, свободные страницы, время"""
+    scheduler = current_app.extensions.get('maintenance')
+    if scheduler is None:
+        return jsonify({'running': False})
+    return jsonify(scheduler.stats())
+
+@bp.route('/faq')
 def faq():
     """Страница часто задаваемых вопросов"""
     return render_template('faq.html')
 
-@app.route('/api/get_last_message_id')
+@bp.route('/api/get_last_message_id')
 @login_required
 def get_last_message_id():
     receiver_id = request.args.get('receiver_id', type=int)
@@ -369,66 +799,52 @@ def get_last_message_id():
     if not receiver_id:
         return jsonify({'last_message_id': 0})
     
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT MAX(id) FROM messages 
-        WHERE (sender_id = ? AND receiver_id = ?) 
-           OR (sender_id = ? AND receiver_id = ?)
-    ''', (session['user_id'], receiver_id, receiver_id, session['user_id']))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    last_message_id = result[0] if result[0] else 0
+    last_message_id = db.get_last_message_id(session['user_id'], receiver_id)
     
     return jsonify({'last_message_id': last_message_id})
 
-@app.route('/update_online_status')
+@bp.route('/update_online_status')
 @login_required
 def update_online_status():
     db.update_last_seen(session['user_id'])
     return jsonify({'status': 'ok'})
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
     flash('Вы вышли из системы', 'info')
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
+
+def preload(app):
+    """Готовит общие данные только для чтения, чтобы воркеры не делали этого сами"""
+    with app.app_context():
+        db.ensure_schema()
+        sticker_catalog.build()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    if config:
+        app.config.from_mapping(config)
+    
+    database = Database(app.config['DATABASE'], app.config['MESSAGE_SHARDS'])
+    app.extensions['messenger_db'] = database
+    app.extensions['sticker_catalog'] = StickerBundle(database)
+    app.extensions['typing'] = TypingTracker()
+    app.extensions['upload_staging'] = UploadStaging(app.config['UPLOAD_STAGING'], app.config['UPLOAD_MAX_SIZE'])
+    # До блюпринта: отклоненный запрос не доходит до обработчика и записи last_seen
+    init_rate_limit(app)
+    app.register_blueprint(bp)
+    init_compression(app)
+    # Кириллица в JSON как есть, а не \uXXXX - в UTF-8 вдвое короче
+    app.json.ensure_ascii = False
+    
+    if app.config['PRELOAD']:
+        preload(app)
+    return app
 
 if __name__ == '__main__':
-    # Создаем необходимые папки
-    os.makedirs('static/uploads/stickers/demo', exist_ok=True)
-    
-    # Проверяем и добавляем демо-стикеры при первом запуске
-    if not os.path.exists('static/uploads/stickers/demo/initialized.txt'):
-        # Создаем демо стикеры
-        demo_stickers = [
-            ('like', '👍', 'Лайк', 'reactions'),
-            ('heart', '❤️', 'Сердечко', 'reactions'),
-            ('laugh', '😂', 'Смех', 'reactions'),
-            ('wow', '😮', 'Удивление', 'reactions'),
-            ('sad', '😢', 'Грусть', 'reactions'),
-            ('fire', '🔥', 'Огонь', 'reactions'),
-            ('party', '🎉', 'Праздник', 'reactions'),
-            ('poop', '💩', 'Какашка', 'funny'),
-            ('hi', '👋', 'Привет', 'greetings'),
-            ('ok', '✅', 'Готово', 'actions'),
-            ('no', '❌', 'Отмена', 'actions'),
-            ('message', '💬', 'Сообщение', 'actions'),
-            ('eyes', '👀', 'Смотрю', 'reactions'),
-            ('think', '🤔', 'Думаю', 'reactions'),
-            ('celebration', '🥳', 'Веселье', 'reactions')
-        ]
-        
-        for emoji, emoji_char, name, category in demo_stickers:
-            # В реальном проекте здесь должен быть код для сохранения изображений стикеров
-            # Пока используем эмодзи как file_path
-            pass
-        
-        # Создаем файл-маркер, что демо-стикеры добавлены
-        with open('static/uploads/stickers/demo/initialized.txt', 'w') as f:
-            f.write('Демо-стикеры инициализированы\n')
-    
-    app.run(host="0.0.0.0", debug=True, port=5000)
+    # Схема, папки и демо-стикеры создаются командой `python manage.py init`
+    create_app().run(host="0.0.0.0", debug=True, port=5000)
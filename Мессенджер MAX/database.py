@@ -2,20 +2,205 @@ import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import os
+import sys
 import hashlib
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Общие модули (очередь записи и т.п.) лежат в корне репозитория
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from write_queue import MessageWriter
+from db_pool import ReadPool
+from friend_cache import FriendCache
+from fragment_cache import FragmentCache
+from search_index import MAX_QUERY_WORDS, match_expression, split_words
+from expiry import EXPIRES_INDEX_SQL, delete_expired, expires_at, not_expired
+from upload_gc import referenced_in
+
+# Версия схемы хранится в PRAGMA user_version. Увеличивайте ее при каждом
+# изменении init_db, иначе уже созданные базы не получат новых таблиц
+SCHEMA_VERSION = 6
+
+# Не чаще раза в столько секунд обновлять users.last_seen одного пользователя
+LAST_SEEN_INTERVAL = 60
+# Больше стольких пользователей в памяти - отметки старше LAST_SEEN_INTERVAL выбрасываются
+LAST_SEEN_MAX_USERS = 10000
+
+# Сколько миллисекунд ждать освобождения блокировки, прежде чем вернуть "database is locked"
+BUSY_TIMEOUT_MS = 5000
+
+# Соединений mode=ro на процесс для запросов на чтение (не меньше потоков воркера)
+READ_POOL_SIZE = 8
+
+# Колонки, которые пишут save_message и save_messages_bulk
+MESSAGE_COLUMNS = 'sender_id, receiver_id, message, message_type, file_path, expires_at'
+
+def shard_path(db_name, shard):
+    """messenger.db -> messenger.shard0.db, messenger.shard1.db, ..."""
+    base, ext = os.path.splitext(db_name)
+    return f'{base}.shard{shard}{ext or ".db"}'
+
+def create_message_tables(cursor):
+    """Таблица messages с индексами и полнотекстовым индексом.
+
+    Одна и та же схема в основной базе и в каждом шарде сообщений.
+    """
+    # Таблица сообщений с поддержкой разных типов
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER NOT NULL,
+        receiver_id INTEGER NOT NULL,
+        message TEXT,
+        message_type TEXT DEFAULT 'text',
+        file_path TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        read_status INTEGER DEFAULT 0,
+        expires_at INTEGER,
+        FOREIGN KEY (sender_id) REFERENCES users (id),
+        FOREIGN KEY (receiver_id) REFERENCES users (id)
+    )
+    ''')
+    
+    for column in ("message_type TEXT DEFAULT 'text'", "file_path TEXT", "read_status INTEGER DEFAULT 0",
+                   "expires_at INTEGER"):
+        try:
+            cursor.execute(f'ALTER TABLE messages ADD COLUMN {column}')
+        except sqlite3.OperationalError:
+            pass
+    
+    # Индекс под выборку входящих от конкретного собеседника по id
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (receiver_id, sender_id, id)')
+    
+    # Все новые входящие пользователя после курсора (/api/updates)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, id)')
+    
+    # Исчезающие сообщения: expires_at - unix-время удаления, по индексу их находит очистка
+    cursor.execute(EXPIRES_INDEX_SQL)
+    
+    # Какие файлы загрузок еще нужны сообщениям (manage.py gc_uploads)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_file ON messages (file_path) WHERE file_path IS NOT NULL')
+    
+    # Полнотекстовый индекс текстовых сообщений. Сам текст в нем не хранится
+    # (content=''), только слова и участники диалога в колонке owners -
+    # поиск сразу ограничен диалогами пользователя. Ведется триггерами в той же
+    # транзакции, что и INSERT сообщения, т.е. и через поток-писатель.
+    # prefix='2 3' - готовые списки для коротких префиксов, иначе "пр*"
+    # раскрывается в тысячи слов
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+    messages_fts_exists = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        body, owners, content='', prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages
+    WHEN new.message_type = 'text' BEGIN
+        INSERT INTO messages_fts (rowid, body, owners)
+        VALUES (new.id, new.message, 'u' || new.sender_id || ' u' || new.receiver_id);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages
+    WHEN old.message_type = 'text' BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, body, owners)
+        VALUES ('delete', old.id, old.message, 'u' || old.sender_id || ' u' || old.receiver_id);
+    END
+    ''')
+    if not messages_fts_exists:
+        cursor.execute('''
+            INSERT INTO messages_fts (rowid, body, owners)
+            SELECT id, message, 'u' || sender_id || ' u' || receiver_id FROM messages
+            WHERE message_type = 'text'
+        ''')
 
 class Database:
-    def __init__(self, db_name='messenger.db'):
+    def __init__(self, db_name='messenger.db', shards=0):
+        # Конструктор не трогает базу: схему создает `python manage.py init`,
+        # а приложение лишь проверяет ее версию при первом запросе
         self.db_name = db_name
-        self.init_db()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        self.friend_cache = FriendCache()
+        self.fragments = FragmentCache()
+        self._last_seen_written = {}
+        # Чтение - из пула соединений mode=ro, запись - только через self.writer
+        self.readers = ReadPool(db_name, READ_POOL_SIZE, timeout=BUSY_TIMEOUT_MS / 1000,
+                                detect_types=sqlite3.PARSE_DECLTYPES)
+        
+        # Шардированный режим (shards > 0): сообщения лежат в shards отдельных
+        # файлах, диалог - в шарде по хешу пары собеседников. У каждого шарда
+        # свой поток-писатель, поэтому записи в разные шарды не ждут друг друга.
+        # Пользователи, дружба и отметки прочтения остаются в основной базе,
+        # она подключается к соединениям шардов как core
+        self.shards = shards
+        self.shard_names = [shard_path(db_name, shard) for shard in range(shards)]
+        self.shard_readers = [
+            ReadPool(name, READ_POOL_SIZE, timeout=BUSY_TIMEOUT_MS / 1000,
+                     detect_types=sqlite3.PARSE_DECLTYPES, attach={'core': db_name})
+            for name in self.shard_names
+        ]
+        self._shard_writers = {}
+        self._fan_out_executor = None
+    
+    def ensure_schema(self):
+        """Один PRAGMA на процесс; init_db запускается, только если база старее кода"""
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            versions = []
+            for name in [self.db_name] + self.shard_names:
+                conn = self.connect(name)
+                versions.append(conn.execute('PRAGMA user_version').fetchone()[0])
+                conn.close()
+            if min(versions) < SCHEMA_VERSION:
+                self.init_db()
+            self._schema_ready = True
+    
+    @property
+    def writer(self):
+        # Поток-писатель создается при первой отправке сообщения
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = MessageWriter(self.db_name)
+        return self._writer
     
     def get_connection(self):
-        return sqlite3.connect(self.db_name, detect_types=sqlite3.PARSE_DECLTYPES)
+        """Соединение только для чтения; conn.close() возвращает его в пул"""
+        return self.readers.get()
+    
+    def release_connections(self):
+        """Возвращает в пулы соединения, которые текущий поток не закрыл из-за исключения"""
+        self.readers.release_held()
+        for readers in self.shard_readers:
+            readers.release_held()
+    
+    def connect(self, name=None):
+        """Соединение на запись мимо потока-писателя - только для схемы и обслуживания"""
+        conn = sqlite3.connect(name or self.db_name, timeout=BUSY_TIMEOUT_MS / 1000, detect_types=sqlite3.PARSE_DECLTYPES)
+        # В режиме WAL fsync при каждом commit не нужен для целостности
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
     
     def init_db(self):
-        conn = self.get_connection()
+        conn = self.connect()
         cursor = conn.cursor()
         
+        # Освобожденные страницы возвращаются по шагам (manage.py maintenance). Действует
+        # только на новую базу, существующую переводит manage.py maintenance --convert
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # WAL: читатели не блокируют писателя и друг друга, поэтому несколько
+        # воркеров могут работать с одним файлом. Режим сохраняется в самой базе
+        cursor.execute('PRAGMA journal_mode = WAL')
+        
         # Таблица пользователей
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -43,22 +228,50 @@ class Database:
         )
         ''')
         
-        # Таблица сообщений с поддержкой разных типов
+        # Список смежности для принятых дружб: по строке на каждое направление.
+        # Таблица friends остается журналом заявок, а все запросы о друзьях
+        # идут сюда по первичному ключу
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'friend_edges'")
+        friend_edges_exists = cursor.fetchone() is not None
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender_id INTEGER NOT NULL,
-            receiver_id INTEGER NOT NULL,
-            message TEXT,
-            message_type TEXT DEFAULT 'text',
-            file_path TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            read_status INTEGER DEFAULT 0,
-            FOREIGN KEY (sender_id) REFERENCES users (id),
-            FOREIGN KEY (receiver_id) REFERENCES users (id)
+        CREATE TABLE IF NOT EXISTS friend_edges (
+            user_id INTEGER NOT NULL,
+            friend_id INTEGER NOT NULL,
+            accepted_at TIMESTAMP,
+            PRIMARY KEY (user_id, friend_id)
+        ) WITHOUT ROWID
+        ''')
+        if not friend_edges_exists:
+            cursor.execute('''
+                INSERT OR IGNORE INTO friend_edges (user_id, friend_id, accepted_at)
+                SELECT user_id, friend_id, accepted_at FROM friends WHERE status = 'accepted'
+                UNION ALL
+                SELECT friend_id, user_id, accepted_at FROM friends WHERE status = 'accepted'
+            ''')
+        
+        # Отметка прочтения: id последнего прочитанного сообщения в каждом диалоге.
+        # Заменяет поштучное обновление messages.read_status
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'read_state'")
+        read_state_exists = cursor.fetchone() is not None
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS read_state (
+            user_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, peer_id)
         )
         ''')
         
+        # Срок жизни новых сообщений диалога (пара user_a < user_b), 0 - хранить всегда
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_settings (
+            user_a INTEGER NOT NULL,
+            user_b INTEGER NOT NULL,
+            message_ttl INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_a, user_b)
+        ) WITHOUT ROWID
+        ''')
+        
         # Таблица стикеров
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS stickers (
@@ -72,38 +285,132 @@ class Database:
         ''')
         
         # Попробуем добавить недостающие колонки
-        try:
-            cursor.execute("ALTER TABLE messages ADD COLUMN message_type TEXT DEFAULT 'text'")
-        except sqlite3.OperationalError:
-            pass
-        
-        try:
-            cursor.execute("ALTER TABLE messages ADD COLUMN file_path TEXT")
-        except sqlite3.OperationalError:
-            pass
-        
         try:
             cursor.execute("ALTER TABLE users ADD COLUMN last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
         except sqlite3.OperationalError:
             pass
         
-        try:
-            cursor.execute("ALTER TABLE messages ADD COLUMN read_status INTEGER DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass
+        # Входящие заявки ищутся по friend_id
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_friends_friend ON friends (friend_id, status)')
+        
+        create_message_tables(cursor)
         
+        if not read_state_exists:
+            # Переносим старые отметки read_status в read_state
+            cursor.execute('''
+                INSERT OR IGNORE INTO read_state (user_id, peer_id, last_read_id)
+                SELECT receiver_id, sender_id, MAX(id) FROM messages
+                WHERE read_status = 1
+                GROUP BY receiver_id, sender_id
+            ''')
+        
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM messages')
+        id_floor = cursor.fetchone()[0]
         conn.commit()
         conn.close()
         
-        # Создаем необходимые папки
-        os.makedirs('static/uploads/images', exist_ok=True)
-        os.makedirs('static/uploads/stickers', exist_ok=True)
+        for name in self.shard_names:
+            self.init_shard(name, id_floor)
         
         # Добавляем демо-стикеры при первом запуске
         self.add_demo_stickers()
+        self._schema_ready = True
+    
+    def init_shard(self, name, id_floor):
+        conn = self.connect(name)
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('PRAGMA journal_mode = WAL')
+        create_message_tables(cursor)
+        # id_floor - больше всех id основной базы: новые id шарда начинаются
+        # выше, поэтому не совпадут с перенесенными командой manage.py shard
+        cursor.execute('CREATE TABLE IF NOT EXISTS shard_meta (key TEXT PRIMARY KEY, value INTEGER)')
+        cursor.execute('''
+            INSERT INTO shard_meta (key, value) VALUES ('id_floor', ?)
+            ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)
+        ''', (id_floor,))
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
+        conn.close()
+    
+    def shard_of(self, user1_id, user2_id):
+        """Номер шарда диалога: хеш канонической пары (меньший id первым)"""
+        user1_id, user2_id = sorted((int(user1_id), int(user2_id)))
+        return zlib.crc32(f'{user1_id}:{user2_id}'.encode()) % self.shards
+    
+    def message_connection(self, user1_id, user2_id):
+        """Соединение для чтения сообщений диалога - из его шарда или основной базы"""
+        if not self.shards:
+            return self.get_connection()
+        return self.shard_readers[self.shard_of(user1_id, user2_id)].get()
+    
+    def message_writer(self, shard):
+        if not self.shards:
+            return self.writer
+        if shard not in self._shard_writers:
+            with self._writer_lock:
+                if shard not in self._shard_writers:
+                    self._shard_writers[shard] = MessageWriter(self.shard_names[shard])
+        return self._shard_writers[shard]
+    
+    def insert_message_sql(self, shard):
+        if not self.shards:
+            return f'INSERT INTO messages ({MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)'
+        # В шарде id назначается явно: больше всех id шарда и id_floor и равен
+        # shard + 1 по модулю числа шардов - у разных шардов id не пересекаются
+        n = self.shards
+        return f'''
+            INSERT INTO messages (id, {MESSAGE_COLUMNS})
+            SELECT base + 1 + (({shard} - base) % {n} + {n}) % {n}, ?, ?, ?, ?, ?, ?
+            FROM (SELECT MAX(COALESCE((SELECT MAX(id) FROM messages), 0),
+                             COALESCE((SELECT value FROM shard_meta WHERE key = 'id_floor'), 0)) AS base)
+        '''
+    
+    def fan_out(self, fn):
+        """Выполняет fn(conn, shard) во всех хранилищах сообщений; результаты по порядку шардов.
+
+        Шарды опрашиваются параллельно: sqlite3 отпускает GIL на время запроса.
+        """
+        if not self.shards:
+            conn = self.get_connection()
+            try:
+                return [fn(conn, 0)]
+            finally:
+                conn.close()
+        if self._fan_out_executor is None:
+            with self._writer_lock:
+                if self._fan_out_executor is None:
+                    # Потоки создаются при первом запросе - уже в воркере, а не до fork
+                    self._fan_out_executor = ThreadPoolExecutor(self.shards, thread_name_prefix='shard')
+        
+        def run(shard):
+            conn = self.shard_readers[shard].get()
+            try:
+                return fn(conn, shard)
+            finally:
+                conn.close()
+        
+        return list(self._fan_out_executor.map(run, range(self.shards)))
+    
+    def format_cursor(self, last_ids):
+        """Курсор /api/updates: id последнего входящего, в шардах - по id на шард через точку"""
+        if not self.shards:
+            return last_ids[0]
+        return '.'.join(str(last_id) for last_id in last_ids)
+    
+    def parse_cursor(self, cursor):
+        """Список id по шардам или None, если курсор не подходит к текущей схеме"""
+        try:
+            last_ids = [int(part) for part in str(cursor).split('.')]
+        except ValueError:
+            return None
+        if len(last_ids) != max(self.shards, 1):
+            return None
+        return last_ids
     
     def add_demo_stickers(self):
-        conn = self.get_connection()
+        conn = self.connect()
         cursor = conn.cursor()
         
         # Проверяем, есть ли уже стикеры
@@ -140,15 +447,18 @@ class Database:
         conn.close()
     
     def update_last_seen(self, user_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            'UPDATE users SET last_seen = CURRENT_TIMESTAMP WHERE id = ?',
-            (user_id,)
-        )
-        conn.commit()
-        conn.close()
+        # Статус "в сети" держится 5 минут, поэтому одна запись в минуту на
+        # пользователя ничего не меняет для собеседников, но снимает запись с каждого запроса
+        now = time.monotonic()
+        if now - self._last_seen_written.get(user_id, -LAST_SEEN_INTERVAL) < LAST_SEEN_INTERVAL:
+            return
+        if len(self._last_seen_written) >= LAST_SEEN_MAX_USERS:
+            for seen_id, written in list(self._last_seen_written.items()):
+                if now - written >= LAST_SEEN_INTERVAL:
+                    self._last_seen_written.pop(seen_id, None)
+        self._last_seen_written[user_id] = now
+        # Запрос не ждет записи: отметка уходит в очередь писателя
+        self.writer.submit('UPDATE users SET last_seen = CURRENT_TIMESTAMP WHERE id = ?', (user_id,))
     
     def get_user_status(self, user_id):
         conn = self.get_connection()
@@ -158,9 +468,13 @@ class Database:
         result = cursor.fetchone()
         conn.close()
         
-        if result and result[0]:
+        if result:
+            return self.status_from_last_seen(result[0])
+        return 'offline'
+    
+    def status_from_last_seen(self, last_seen):
+        if last_seen:
             try:
-                last_seen = result[0]
                 if isinstance(last_seen, str):
                     # Если это строка, парсим
                     if 'T' in last_seen:
@@ -186,23 +500,17 @@ class Database:
         return 'offline'
     
     def register_user(self, username, password):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         unique_nickname = f"@{username}"
         
         try:
             hashed_password = generate_password_hash(password)
-            cursor.execute(
+            self.writer.execute(
                 'INSERT INTO users (username, password, unique_nickname, last_seen) VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
                 (username, hashed_password, unique_nickname)
             )
-            conn.commit()
             return True
         except sqlite3.IntegrityError:
             return False
-        finally:
-            conn.close()
     
     def authenticate_user(self, username, password):
         conn = self.get_connection()
@@ -282,7 +590,10 @@ class Database:
         return result
     
     def add_friend_request(self, user_id, friend_nickname):
-        conn = self.get_connection()
+        return self.writer.transaction(self._add_friend_request, user_id, friend_nickname)
+    
+    def _add_friend_request(self, conn, user_id, friend_nickname):
+        # Выполняется в потоке-писателе: проверки и вставка в одной транзакции
         cursor = conn.cursor()
         
         cursor.execute('SELECT id FROM users WHERE unique_nickname = ?', (friend_nickname,))
@@ -318,12 +629,9 @@ class Database:
                 'INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, ?)',
                 (user_id, friend_id, 'pending')
             )
-            conn.commit()
             return {'success': True, 'message': 'Заявка отправлена'}
         except sqlite3.IntegrityError:
             return {'success': False, 'error': 'Ошибка при отправке заявки'}
-        finally:
-            conn.close()
     
     def get_friend_requests(self, user_id):
         conn = self.get_connection()
@@ -354,37 +662,42 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT 
-                CASE 
-                    WHEN f.user_id = ? THEN f.friend_id 
-                    ELSE f.user_id 
-                END as friend_id,
-                u.username,
-                u.unique_nickname,
-                f.status,
-                f.accepted_at
-            FROM friends f
-            JOIN users u ON (
-                CASE 
-                    WHEN f.user_id = ? THEN f.friend_id 
-                    ELSE f.user_id 
-                END = u.id
-            )
-            WHERE (f.user_id = ? OR f.friend_id = ?) 
-              AND f.status = ?
-            ORDER BY 
-                CASE WHEN f.accepted_at IS NULL THEN 1 ELSE 0 END,
-                f.accepted_at DESC,
-                u.username
-        ''', (user_id, user_id, user_id, user_id, status))
+        if status == 'accepted':
+            cursor.execute('''
+                SELECT e.friend_id, u.username, u.unique_nickname, 'accepted', e.accepted_at, u.last_seen
+                FROM friend_edges e
+                JOIN users u ON u.id = e.friend_id
+                WHERE e.user_id = ?
+                ORDER BY 
+                    CASE WHEN e.accepted_at IS NULL THEN 1 ELSE 0 END,
+                    e.accepted_at DESC,
+                    u.username
+            ''', (user_id,))
+        else:
+            # Две ветки, каждую обслуживает свой индекс (UNIQUE(user_id, friend_id)
+            # и idx_friends_friend), вместо OR, который индексом не покрыть
+            cursor.execute('''
+                SELECT * FROM (
+                    SELECT f.friend_id, u.username, u.unique_nickname, f.status, f.accepted_at, u.last_seen
+                    FROM friends f JOIN users u ON u.id = f.friend_id
+                    WHERE f.user_id = ? AND f.status = ?
+                    UNION ALL
+                    SELECT f.user_id, u.username, u.unique_nickname, f.status, f.accepted_at, u.last_seen
+                    FROM friends f JOIN users u ON u.id = f.user_id
+                    WHERE f.friend_id = ? AND f.status = ?
+                )
+                ORDER BY 
+                    CASE WHEN accepted_at IS NULL THEN 1 ELSE 0 END,
+                    accepted_at DESC,
+                    username
+            ''', (user_id, status, user_id, status))
         
         friends = cursor.fetchall()
         conn.close()
         
         result = []
         for friend in friends:
-            friend_status = self.get_user_status(friend[0])
+            friend_status = self.status_from_last_seen(friend[5])
             result.append({
                 'id': friend[0],
                 'username': friend[1],
@@ -399,16 +712,91 @@ class Database:
     def get_friends(self, user_id, status='accepted'):
         return self.get_friends_with_status(user_id, status)
     
-    def respond_to_friend_request(self, request_id, user_id, action):
+    def get_friend_ids(self, user_id):
+        """Множество id друзей из кэша в памяти; при промахе - один запрос по ключу"""
+        friend_ids = self.friend_cache.get(user_id)
+        if friend_ids is None:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT friend_id FROM friend_edges WHERE user_id = ?', (user_id,))
+            friend_ids = frozenset(row[0] for row in cursor.fetchall())
+            conn.close()
+            self.friend_cache.set(user_id, friend_ids)
+        return friend_ids
+    
+    def is_friend(self, user_id, other_id):
+        return other_id in self.get_friend_ids(user_id)
+    
+    def get_users_by_ids(self, user_ids):
+        user_ids = list(user_ids)
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        users = []
+        # Лимит параметров SQLite - выбираем кусками
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(
+                f'SELECT id, username, unique_nickname FROM users WHERE id IN ({placeholders})',
+                chunk
+            )
+            users.extend(cursor.fetchall())
+        conn.close()
+        
+        return [{'id': user[0], 'username': user[1], 'unique_nickname': user[2]} for user in users]
+    
+    def get_mutual_friends(self, user_id, other_id):
+        mutual = self.get_friend_ids(user_id) & self.get_friend_ids(other_id)
+        return sorted(self.get_users_by_ids(mutual), key=lambda user: user['username'])
+    
+    def get_friend_suggestions(self, user_id, limit=10):
+        """Люди, с которыми больше всего общих друзей (друзья друзей)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT e2.friend_id, COUNT(*) AS mutual
+            FROM friend_edges e1
+            JOIN friend_edges e2 ON e2.user_id = e1.friend_id
+            WHERE e1.user_id = ? AND e2.friend_id != ?
+              AND NOT EXISTS (
+                  SELECT 1 FROM friend_edges x WHERE x.user_id = ? AND x.friend_id = e2.friend_id
+              )
+            GROUP BY e2.friend_id
+            ORDER BY mutual DESC
+            LIMIT ?
+        ''', (user_id, user_id, user_id, limit))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        users = {user['id']: user for user in self.get_users_by_ids(row[0] for row in rows)}
+        result = []
+        for candidate_id, mutual in rows:
+            if candidate_id in users:
+                users[candidate_id]['mutual_count'] = mutual
+                result.append(users[candidate_id])
+        return result
+    
+    def respond_to_friend_request(self, request_id, user_id, action):
+        result = self.writer.transaction(self._respond_to_friend_request, request_id, user_id, action)
+        friend_id = result.pop('friend_id', None)
+        if friend_id is not None:
+            self.friend_cache.invalidate(user_id, friend_id)
+            self.fragments.bump(user_id, friend_id)
+        return result
+    
+    def _respond_to_friend_request(self, conn, request_id, user_id, action):
+        cursor = conn.cursor()
+        
         cursor.execute('''
-            SELECT id FROM friends 
+            SELECT user_id FROM friends 
             WHERE id = ? AND friend_id = ? AND status = 'pending'
         ''', (request_id, user_id))
         
-        if not cursor.fetchone():
+        request = cursor.fetchone()
+        if not request:
             return {'success': False, 'error': 'Заявка не найдена'}
         
         if action == 'accept':
@@ -417,7 +805,13 @@ class Database:
                 SET status = 'accepted', accepted_at = CURRENT_TIMESTAMP 
                 WHERE id = ?
             ''', (request_id,))
+            cursor.executemany(
+                'INSERT OR IGNORE INTO friend_edges (user_id, friend_id, accepted_at) VALUES (?, ?, CURRENT_TIMESTAMP)',
+                [(user_id, request[0]), (request[0], user_id)]
+            )
             message = 'Заявка принята'
+            # Кэши дружбы сбрасываются уже после commit, в respond_to_friend_request
+            friend_id = request[0]
         elif action == 'reject':
             cursor.execute('''
                 UPDATE friends 
@@ -425,15 +819,19 @@ class Database:
                 WHERE id = ?
             ''', (request_id,))
             message = 'Заявка отклонена'
+            friend_id = None
         else:
             return {'success': False, 'error': 'Неизвестное действие'}
         
-        conn.commit()
-        conn.close()
-        return {'success': True, 'message': message}
+        return {'success': True, 'message': message, 'friend_id': friend_id}
     
     def remove_friend(self, user_id, friend_id):
-        conn = self.get_connection()
+        removed = self.writer.transaction(self._remove_friend, user_id, friend_id)
+        self.friend_cache.invalidate(user_id, friend_id)
+        self.fragments.bump(user_id, friend_id)
+        return removed
+    
+    def _remove_friend(self, conn, user_id, friend_id):
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -441,35 +839,124 @@ class Database:
             WHERE (user_id = ? AND friend_id = ?) 
                OR (user_id = ? AND friend_id = ?)
         ''', (user_id, friend_id, friend_id, user_id))
+        removed = cursor.rowcount > 0
         
-        conn.commit()
-        conn.close()
-        return cursor.rowcount > 0
+        cursor.execute('''
+            DELETE FROM friend_edges 
+            WHERE (user_id = ? AND friend_id = ?) 
+               OR (user_id = ? AND friend_id = ?)
+        ''', (user_id, friend_id, friend_id, user_id))
+        return removed
     
     def save_message(self, sender_id, receiver_id, message, message_type='text', file_path=None):
+        # Запись идет через поток с групповым commit (в шардах - поток шарда), возвращает id сообщения
+        shard = self.shard_of(sender_id, receiver_id) if self.shards else 0
+        message_id = self.message_writer(shard).execute(
+            self.insert_message_sql(shard),
+            (sender_id, receiver_id, message, message_type, file_path,
+             expires_at(self.get_message_ttl(sender_id, receiver_id)))
+        )
+        self.fragments.bump(sender_id, int(receiver_id))
+        return message_id
+    
+    def save_messages_bulk(self, sender_id, items):
+        """Сохраняет пачку текстовых сообщений [(receiver_id, message), ...] одной транзакцией.
+
+        В шардированном режиме - по транзакции на шард, шарды пишутся параллельно.
+        Возвращает список id в том же порядке.
+        """
+        if not items:
+            return []
+        groups = {}
+        ttls = {}
+        for index, (receiver_id, message) in enumerate(items):
+            shard = self.shard_of(sender_id, receiver_id) if self.shards else 0
+            if receiver_id not in ttls:
+                ttls[receiver_id] = self.get_message_ttl(sender_id, receiver_id)
+            groups.setdefault(shard, []).append((index, receiver_id, message, expires_at(ttls[receiver_id])))
+        
+        futures = {shard: self.message_writer(shard).submit(self._insert_messages, (shard, sender_id, group))
+                   for shard, group in groups.items()}
+        ids = [None] * len(items)
+        for shard, future in futures.items():
+            for (index, _, _, _), message_id in zip(groups[shard], future.result(self.writer.timeout)):
+                ids[index] = message_id
+        self.fragments.bump(sender_id, *{int(receiver_id) for receiver_id, _ in items})
+        return ids
+    
+    def _insert_messages(self, conn, shard, sender_id, group):
+        sql = self.insert_message_sql(shard)
+        return [conn.execute(sql, (sender_id, receiver_id, message, 'text', None, expires)).lastrowid
+                for _, receiver_id, message, expires in group]
+    
+    def get_message_ttl(self, user1_id, user2_id):
+        """Срок жизни новых сообщений диалога в секундах (0 - бессрочно)"""
+        user1_id, user2_id = sorted((int(user1_id), int(user2_id)))
         conn = self.get_connection()
         cursor = conn.cursor()
-        
         cursor.execute(
-            'INSERT INTO messages (sender_id, receiver_id, message, message_type, file_path) VALUES (?, ?, ?, ?, ?)',
-            (sender_id, receiver_id, message, message_type, file_path)
+            'SELECT message_ttl FROM conversation_settings WHERE user_a = ? AND user_b = ?',
+            (user1_id, user2_id)
         )
-        conn.commit()
+        result = cursor.fetchone()
         conn.close()
+        return result[0] if result else 0
+    
+    def set_message_ttl(self, user1_id, user2_id, ttl):
+        """Меняет срок для новых сообщений диалога; уже отправленные живут по старому"""
+        user1_id, user2_id = sorted((int(user1_id), int(user2_id)))
+        self.writer.execute('''
+            INSERT INTO conversation_settings (user_a, user_b, message_ttl) VALUES (?, ?, ?)
+            ON CONFLICT(user_a, user_b) DO UPDATE SET message_ttl = excluded.message_ttl
+        ''', (user1_id, user2_id, ttl))
+    
+    def delete_expired_messages(self, limit):
+        """Удаляет по пачке истекших сообщений в каждом хранилище (основная база или шарды).
+
+        Возвращает удаленные строки (id, sender_id, receiver_id, message_type, file_path) -
+        файлы изображений по ним убирает вызывающий.
+        """
+        now = int(time.time())
+        rows = []
+        for shard in range(max(self.shards, 1)):
+            rows.extend(self.message_writer(shard).transaction(
+                delete_expired, now, limit, 'id, sender_id, receiver_id, message_type, file_path'))
+        if rows:
+            # Кэшированные списки диалогов могли показывать удаленное превью
+            self.fragments.bump(*{user_id for row in rows for user_id in row[1:3]})
+        return rows
+    
+    def referenced_files(self, file_paths):
+        """Какие из file_paths (пути относительно папки загрузок) есть в сообщениях - во всех шардах"""
+        found = set()
+        for paths in self.fan_out(lambda conn, shard: referenced_in(conn, 'file_path', list(file_paths))):
+            found |= paths
+        return found
+    
+    def lock_report(self):
+        """Ожидания в этом процессе: свободного соединения для чтения и блокировки записи"""
+        report = {'read_pool': self.readers.report(), 'writer': self.writer.stats()}
+        if self.shards:
+            report['shards'] = [{
+                'read_pool': self.shard_readers[shard].report(),
+                'writer': self._shard_writers[shard].stats() if shard in self._shard_writers else None,
+            } for shard in range(self.shards)]
+        return report
     
     def get_messages(self, user1_id, user2_id):
-        conn = self.get_connection()
+        conn = self.message_connection(user1_id, user2_id)
         cursor = conn.cursor()
         
-        cursor.execute('''
+        cursor.execute(f'''
             SELECT m.id, m.sender_id, m.receiver_id, m.message, m.message_type, m.file_path, 
                    strftime('%Y-%m-%d %H:%M:%S', m.timestamp) as timestamp, 
                    u1.username as sender_name, u2.username as receiver_name
             FROM messages m
             JOIN users u1 ON m.sender_id = u1.id
             JOIN users u2 ON m.receiver_id = u2.id
-            WHERE (m.sender_id = ? AND m.receiver_id = ?) 
-               OR (m.sender_id = ? AND m.receiver_id = ?)
+            WHERE ((m.sender_id = ? AND m.receiver_id = ?) 
+               OR (m.sender_id = ? AND m.receiver_id = ?))
+               AND {not_expired('m.expires_at')}
             ORDER BY m.timestamp
         ''', (user1_id, user2_id, user2_id, user1_id))
         
@@ -478,41 +965,193 @@ class Database:
         
         return messages
     
-    def get_unread_count(self, user_id, sender_id):
-        conn = self.get_connection()
+    def get_new_messages(self, user_id, peer_id, last_message_id):
+        """Сообщения диалога с id больше last_message_id (для /api/check_updates)"""
+        conn = self.message_connection(user_id, peer_id)
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            SELECT m.id, m.sender_id, m.receiver_id, m.message, m.message_type, m.file_path, 
+                   strftime('%Y-%m-%d %H:%M:%S', m.timestamp) as timestamp, u.username
+            FROM messages m
+            JOIN users u ON m.sender_id = u.id
+            WHERE ((m.sender_id = ? AND m.receiver_id = ?) 
+               OR (m.sender_id = ? AND m.receiver_id = ?))
+               AND m.id > ? AND {not_expired('m.expires_at')}
+            ORDER BY m.timestamp
+        ''', (user_id, peer_id, peer_id, user_id, last_message_id))
+        
+        messages = cursor.fetchall()
+        conn.close()
+        return messages
+    
+    def get_last_message_id(self, user1_id, user2_id):
+        conn = self.message_connection(user1_id, user2_id)
         cursor = conn.cursor()
         
         cursor.execute('''
+            SELECT MAX(id) FROM messages 
+            WHERE (sender_id = ? AND receiver_id = ?) 
+               OR (sender_id = ? AND receiver_id = ?)
+        ''', (user1_id, user2_id, user2_id, user1_id))
+        
+        result = cursor.fetchone()
+        conn.close()
+        return result[0] or 0
+    
+    def get_unread_count(self, user_id, sender_id):
+        conn = self.message_connection(user_id, sender_id)
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
             SELECT COUNT(*) FROM messages 
-            WHERE receiver_id = ? AND sender_id = ? AND read_status = 0
-        ''', (user_id, sender_id))
+            WHERE receiver_id = ? AND sender_id = ? AND {not_expired()}
+              AND id > COALESCE((SELECT last_read_id FROM read_state WHERE user_id = ? AND peer_id = ?), 0)
+        ''', (user_id, sender_id, user_id, sender_id))
         
         count = cursor.fetchone()[0]
         conn.close()
         return count
     
-    def mark_messages_as_read(self, user_id, sender_id):
+    def get_unread_counts(self, user_id, up_to=None):
+        """Непрочитанные во всех диалогах пользователя одним запросом на шард: {sender_id: count}
+
+        up_to - курсор get_updates_cursor: считаются только сообщения, которые
+        он уже учел. Пришедшие позже клиент получит из /api/updates приростом,
+        и в счетчике они не окажутся дважды.
+        """
+        last_ids = self.parse_cursor(up_to) if up_to is not None else None
+        
+        def count(conn, shard):
+            params = (user_id, last_ids[shard]) if last_ids else (user_id,)
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT m.sender_id, COUNT(*) FROM messages m
+                LEFT JOIN read_state r ON r.user_id = m.receiver_id AND r.peer_id = m.sender_id
+                WHERE m.receiver_id = ? AND m.id > COALESCE(r.last_read_id, 0) {'AND m.id <= ?' if last_ids else ''}
+                  AND {not_expired('m.expires_at')}
+                GROUP BY m.sender_id
+            ''', params)
+            return cursor.fetchall()
+        
+        # Диалог целиком лежит в одном шарде, поэтому собеседники в ответах шардов не повторяются
+        counts = {}
+        for rows in self.fan_out(count):
+            counts.update(rows)
+        return counts
+    
+    def mark_messages_as_read(self, user_id, sender_id, last_message_id=None):
+        """Сдвигает отметку прочтения диалога - одна строка вне зависимости от числа сообщений"""
+        if last_message_id is None:
+            conn = self.message_connection(user_id, sender_id)
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT MAX(id) FROM messages WHERE receiver_id = ? AND sender_id = ?',
+                (user_id, sender_id)
+            )
+            last_message_id = cursor.fetchone()[0]
+            conn.close()
+        
+        if not last_message_id:
+            return
+        
+        self.writer.execute('''
+            INSERT INTO read_state (user_id, peer_id, last_read_id) VALUES (?, ?, ?)
+            ON CONFLICT(user_id, peer_id) DO UPDATE 
+            SET last_read_id = MAX(last_read_id, excluded.last_read_id)
+        ''', (user_id, sender_id, last_message_id))
+        self.fragments.bump(user_id)
+    
+    def get_read_receipt(self, user_id, peer_id):
+        """id последнего сообщения user_id, которое прочитал peer_id"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            UPDATE messages 
-            SET read_status = 1 
-            WHERE receiver_id = ? AND sender_id = ? AND read_status = 0
-        ''', (user_id, sender_id))
-        
-        conn.commit()
+        cursor.execute(
+            'SELECT last_read_id FROM read_state WHERE user_id = ? AND peer_id = ?',
+            (peer_id, user_id)
+        )
+        result = cursor.fetchone()
         conn.close()
+        return result[0] if result else 0
+    
+    def get_updates_cursor(self, user_id):
+        """Курсор для /api/updates на текущий момент (см. format_cursor)"""
+        def last_incoming(conn, shard):
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM messages WHERE receiver_id = ?', (user_id,))
+            return cursor.fetchone()[0]
+        
+        return self.format_cursor(self.fan_out(last_incoming))
+    
+    def get_message_age(self, message_id):
+        """Сколько секунд назад отправлено сообщение (None, если его нет)"""
+        return self._message_ages([message_id] * max(self.shards, 1))
+    
+    def get_cursor_age(self, cursor):
+        """Сколько секунд назад пришло последнее сообщение, учтенное курсором"""
+        last_ids = self.parse_cursor(cursor)
+        return self._message_ages(last_ids) if last_ids else None
+    
+    def _message_ages(self, ids_by_shard):
+        def age(conn, shard):
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT CAST(strftime('%s', 'now') AS INTEGER) - CAST(strftime('%s', timestamp) AS INTEGER) FROM messages WHERE id = ?",
+                (ids_by_shard[shard],)
+            )
+            result = cursor.fetchone()
+            return result[0] if result else None
+        
+        ages = [result for result in self.fan_out(age) if result is not None]
+        return min(ages) if ages else None
+    
+    def get_updates(self, user_id, since, peer_id=None, limit=500):
+        """Новые сообщения после курсора since: все входящие пользователя и свои в открытый диалог.
+
+        Возвращает (строки, новый курсор, есть ли еще). Один запрос на шард -
+        один снимок, поэтому курсор по максимальному id ничего не пропускает.
+        Строки в формате get_messages, по времени. Неподходящий курсор - None.
+        """
+        since_ids = self.parse_cursor(since)
+        if since_ids is None:
+            return None
+        
+        def new_messages(conn, shard):
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT m.id, m.sender_id, m.receiver_id, m.message, m.message_type, m.file_path, 
+                       strftime('%Y-%m-%d %H:%M:%S', m.timestamp) as timestamp, 
+                       u.username as sender_name
+                FROM messages m
+                JOIN users u ON m.sender_id = u.id
+                WHERE ((m.receiver_id = ? AND m.id > ?)
+                   OR (m.receiver_id = ? AND m.sender_id = ? AND m.id > ?))
+                   AND {not_expired('m.expires_at')}
+                ORDER BY m.id
+                LIMIT ?
+            ''', (user_id, since_ids[shard], peer_id or 0, user_id, since_ids[shard], limit))
+            return cursor.fetchall()
+        
+        results = self.fan_out(new_messages)
+        last_ids = [rows[-1][0] if rows else since_ids[shard] for shard, rows in enumerate(results)]
+        # Упёрлись в лимит хотя бы в одном шарде - остальное клиент заберет следующим запросом
+        more = any(len(rows) == limit for rows in results)
+        messages = [msg for rows in results for msg in rows]
+        if self.shards:
+            messages.sort(key=lambda msg: (msg[6], msg[0]))
+        return messages, self.format_cursor(last_ids), more
     
     def get_last_message_preview(self, user1_id, user2_id):
-        conn = self.get_connection()
+        conn = self.message_connection(user1_id, user2_id)
         cursor = conn.cursor()
         
-        cursor.execute('''
+        cursor.execute(f'''
             SELECT message, timestamp, sender_id 
             FROM messages 
-            WHERE (sender_id = ? AND receiver_id = ?) 
-               OR (sender_id = ? AND receiver_id = ?)
+            WHERE ((sender_id = ? AND receiver_id = ?) 
+               OR (sender_id = ? AND receiver_id = ?))
+               AND {not_expired()}
             ORDER BY timestamp DESC 
             LIMIT 1
         ''', (user1_id, user2_id, user2_id, user1_id))
@@ -539,6 +1178,41 @@ class Database:
             }
         return None
     
+    def search_messages(self, user_id, query, limit=20, offset=0, peer_id=None):
+        """Поиск по истории пользователя: лучшие по bm25 первыми, потом более новые.
+
+        Возвращает строки в формате get_messages.
+        """
+        words = split_words(query)[:MAX_QUERY_WORDS]
+        if not words:
+            return []
+        expression = match_expression(words, user_id, peer_id)
+        # Шарды отдают каждый свои лучшие limit + offset, страница собирается после слияния
+        fetch, skip = (limit + offset, 0) if self.shards else (limit, offset)
+        
+        def found(conn, shard):
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT m.id, m.sender_id, m.receiver_id, m.message, m.message_type, m.file_path, 
+                       strftime('%Y-%m-%d %H:%M:%S', m.timestamp) as timestamp, 
+                       u1.username as sender_name, u2.username as receiver_name, found.score
+                FROM (
+                    SELECT rowid, bm25(messages_fts, 1.0, 0.0) AS score FROM messages_fts
+                    WHERE messages_fts MATCH ?
+                    ORDER BY score, rowid DESC
+                    LIMIT ? OFFSET ?
+                ) found
+                JOIN messages m ON m.id = found.rowid
+                JOIN users u1 ON m.sender_id = u1.id
+                JOIN users u2 ON m.receiver_id = u2.id
+                WHERE {not_expired('m.expires_at')}
+                ORDER BY found.score, m.id DESC
+            ''', (expression, fetch, skip))
+            return cursor.fetchall()
+        
+        messages = sorted((msg for rows in self.fan_out(found) for msg in rows), key=lambda msg: (msg[9], -msg[0]))
+        return [msg[:9] for msg in messages[offset - skip:offset - skip + limit]]
+    
     def get_stickers(self):
         conn = self.get_connection()
         cursor = conn.cursor()
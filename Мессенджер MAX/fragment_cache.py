@@ -0,0 +1,43 @@
+import threading
+import time
+
+
+class FragmentCache:
+    """Готовые куски HTML (список диалогов в чате) в памяти процесса.
+
+    Ключ фрагмента включает версию данных пользователя. Database повышает версию
+    при новом сообщении, прочтении и изменении дружбы, поэтому старые фрагменты
+    просто перестают находиться. Другие процессы версию не видят, и статусы
+    "в сети" со временем меняются сами, поэтому записи живут не дольше ttl секунд.
+    """
+
+    def __init__(self, ttl=30, max_entries=5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._versions = {}
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def version(self, user_id):
+        return self._versions.get(user_id, 0)
+
+    def bump(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def set(self, key, html):
+        with self._lock:
+            if len(self._data) >= self.max_entries:
+                self._data.clear()
+            self._data[key] = (time.monotonic() + self.ttl, html)
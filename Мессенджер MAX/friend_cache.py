@@ -0,0 +1,33 @@
+import threading
+import time
+
+
+class FriendCache:
+    """Кэш множеств друзей в памяти процесса: {user_id: frozenset(friend_ids)}.
+
+    Сбрасывается для обоих участников при принятии заявки или удалении из друзей.
+    Другие процессы об этом не узнают, поэтому записи живут не дольше ttl секунд.
+    """
+
+    def __init__(self, ttl=60, max_users=10000):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self._data.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def set(self, user_id, friend_ids):
+        with self._lock:
+            if len(self._data) >= self.max_users:
+                self._data.clear()
+            self._data[user_id] = (time.monotonic() + self.ttl, friend_ids)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._data.pop(user_id, None)
@@ -0,0 +1,16 @@
+# Настройки gunicorn для мессенджера: gunicorn -c gunicorn.conf.py wsgi:app
+# Количество процессов и потоков задается переменными окружения.
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', 2))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+
+# Приложение (схема, каталог стикеров, шаблоны) создается один раз в мастере,
+# воркеры получают его готовым через fork. Соединения SQLite и поток-писатель
+# создаются лениво уже в воркерах, поэтому через fork они не переходят.
+preload_app = True
+
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+accesslog = os.environ.get('ACCESS_LOG')
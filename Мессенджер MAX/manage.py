@@ -0,0 +1,199 @@
+"""Команды обслуживания мессенджера. Запускать из папки приложения:
+
+    python manage.py init    - создать или обновить схему базы, папки загрузок и демо-стикеры
+    python manage.py shard --shards N  - разложить сообщения основной базы по N шардам
+    python manage.py gc_uploads [--delete]  - найти (и удалить) изображения без сообщений
+    python manage.py fanout_uploads  - разложить старые изображения по подпапкам images/ab/cd/
+    python manage.py backup [--no-uploads]  - снимок базы, шардов и загрузок в backups/ без остановки чата
+    python manage.py backup_incremental  - новые сообщения после прошлого снимка
+    python manage.py maintenance [--convert]  - ANALYZE, возврат свободных страниц и checkpoint
+
+Число шардов (--shards или MESSAGE_SHARDS) должно совпадать с настройкой приложения.
+
+Воркеры приложения эту работу не делают: при старте они только
+импортируют код, а версию схемы проверяют одним PRAGMA при первом запросе.
+"""
+import argparse
+import os
+
+from database import Database, SCHEMA_VERSION
+from upload_gc import GC_BATCH, GRACE_PERIOD, collect, format_report
+from upload_paths import migrate_column
+from backup import STEP_PAGES, STEP_PAUSE, incremental, snapshot
+from maintenance import (QUIET_MESSAGES, VACUUM_MAX_PAGES, direct_transaction, enable_incremental_vacuum, run_all,
+                         format_report as format_maintenance_report)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+UPLOAD_DIRS = ['static/uploads/images', 'static/uploads/stickers/demo']
+
+
+def init(db):
+    db.init_db()
+
+    for path in UPLOAD_DIRS:
+        os.makedirs(os.path.join(BASE_DIR, path), exist_ok=True)
+
+    # Файл-маркер, что демо-стикеры добавлены
+    marker = os.path.join(BASE_DIR, 'static/uploads/stickers/demo/initialized.txt')
+    if not os.path.exists(marker):
+        with open(marker, 'w') as f:
+            f.write('Демо-стикеры инициализированы\n')
+
+    print(f'База {db.db_name} готова, версия схемы {SCHEMA_VERSION}')
+    for name in db.shard_names:
+        print(f'Шард сообщений {name}')
+
+
+def shard(db, batch_size=5000):
+    """Копирует сообщения основной базы в шарды с теми же id, пачками.
+
+    Запускать до включения MESSAGE_SHARDS в приложении. Прерванный перенос
+    продолжается с места остановки; сообщения в основной базе остаются, но в
+    шардированном режиме больше не читаются.
+    """
+    db.init_db()
+    main = db.connect()
+    shards = [db.connect(name) for name in db.shard_names]
+    last_id = min(
+        conn.execute("SELECT COALESCE((SELECT value FROM shard_meta WHERE key = 'migrated_id'), 0)").fetchone()[0]
+        for conn in shards
+    )
+    moved = 0
+    while True:
+        rows = main.execute('''
+            SELECT id, sender_id, receiver_id, message, message_type, file_path, CAST(timestamp AS TEXT), read_status,
+                   expires_at
+            FROM messages WHERE id > ? ORDER BY id LIMIT ?
+        ''', (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        groups = {}
+        for row in rows:
+            groups.setdefault(db.shard_of(row[1], row[2]), []).append(row)
+        last_id = rows[-1][0]
+        for number, conn in enumerate(shards):
+            conn.executemany('''
+                INSERT OR IGNORE INTO messages
+                    (id, sender_id, receiver_id, message, message_type, file_path, timestamp, read_status, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', groups.get(number, []))
+            conn.execute('''
+                INSERT INTO shard_meta (key, value) VALUES ('migrated_id', ?), ('id_floor', ?)
+                ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)
+            ''', (last_id, last_id))
+            conn.commit()
+        moved += len(rows)
+        print(f'Перенесено {moved}, последний id {last_id}')
+    for conn in [main] + shards:
+        conn.close()
+    return moved
+
+
+def gc_uploads(db, grace=GRACE_PERIOD, delete=False, batch_size=GC_BATCH):
+    """Изображения в static/uploads/images, на которые не ссылается ни одно сообщение.
+
+    Стикеры не трогаем - они в таблице stickers, а не в messages.
+    """
+    db.ensure_schema()
+    report = collect(os.path.join(BASE_DIR, 'static/uploads'), db.referenced_files, subdir='images',
+                     grace=grace, delete=delete, batch_size=batch_size)
+    print(format_report(report))
+    return report
+
+
+def fanout_uploads(db, batch_size=500):
+    """Переносит изображения из плоской images/ в images/ab/cd/ и переписывает file_path.
+
+    Можно прерывать и запускать заново. Проходит основную базу и все шарды.
+    """
+    db.ensure_schema()
+    directory = os.path.join(BASE_DIR, 'static/uploads/images')
+    moved = missing = 0
+    for name in [db.db_name] + db.shard_names:
+        conn = db.connect(name)
+        done, lost = migrate_column(conn, directory, 'file_path', 'images/', batch_size, "message_type = 'image'")
+        conn.close()
+        moved += done
+        missing += lost
+    print(f'Готово: {moved} путей переписано, файлов не найдено: {missing}')
+    return moved
+
+
+def backup(db, out_dir, uploads=True, pages=STEP_PAGES, pause=STEP_PAUSE):
+    """Снимок основной базы, всех шардов и static/uploads (восстановление - python ../backup.py restore)"""
+    db.ensure_schema()
+    upload_folder = os.path.join(BASE_DIR, 'static/uploads') if uploads else None
+    path = snapshot([db.db_name] + db.shard_names, out_dir, upload_folder, pages, pause)
+    print(f'Готово: {path}')
+    return path
+
+
+def backup_incremental(db, out_dir):
+    db.ensure_schema()
+    path = incremental([db.db_name] + db.shard_names, out_dir)
+    print(f'Готово: {path}')
+    return path
+
+
+def maintenance(db, convert=False, force=False, max_pages=VACUUM_MAX_PAGES):
+    """Проход обслуживания основной базы и шардов; с convert - сначала включить incremental vacuum"""
+    db.ensure_schema()
+    paths = [db.db_name] + db.shard_names
+    if convert:
+        for path in paths:
+            if enable_incremental_vacuum(path):
+                print(f'{path}: auto_vacuum = INCREMENTAL')
+    reports = run_all(paths, [direct_transaction(path) for path in paths],
+                      float('inf') if force else QUIET_MESSAGES, max_pages=max_pages)
+    for report in reports:
+        print(format_maintenance_report(report))
+    return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Команды обслуживания мессенджера')
+    parser.add_argument('--db', default=os.path.join(BASE_DIR, 'messenger.db'))
+    parser.add_argument('--shards', type=int, default=int(os.environ.get('MESSAGE_SHARDS', 0)))
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('init', help='создать или обновить схему базы, папки и демо-стикеры')
+    shard_parser = commands.add_parser('shard', help='разложить сообщения основной базы по шардам')
+    shard_parser.add_argument('--batch', type=int, default=5000)
+    gc_parser = commands.add_parser('gc_uploads', help='найти изображения без сообщений (с --delete - удалить)')
+    gc_parser.add_argument('--grace', type=int, default=GRACE_PERIOD, help='не трогать файлы моложе стольких секунд')
+    gc_parser.add_argument('--batch', type=int, default=GC_BATCH)
+    gc_parser.add_argument('--delete', action='store_true')
+    fanout_parser = commands.add_parser('fanout_uploads', help='разложить изображения по подпапкам по хешу имени')
+    fanout_parser.add_argument('--batch', type=int, default=500)
+    backup_parser = commands.add_parser('backup', help='снимок баз и загрузок без остановки чата')
+    backup_parser.add_argument('--out', default=os.path.join(BASE_DIR, 'backups'))
+    backup_parser.add_argument('--no-uploads', action='store_true')
+    backup_parser.add_argument('--pages', type=int, default=STEP_PAGES, help='страниц за шаг')
+    backup_parser.add_argument('--pause', type=float, default=STEP_PAUSE, help='пауза между шагами, с')
+    incremental_parser = commands.add_parser('backup_incremental', help='новые сообщения после прошлого снимка')
+    incremental_parser.add_argument('--out', default=os.path.join(BASE_DIR, 'backups'))
+    maintenance_parser = commands.add_parser('maintenance', help='ANALYZE, возврат свободных страниц и checkpoint')
+    maintenance_parser.add_argument('--convert', action='store_true', help='один раз включить auto_vacuum = INCREMENTAL (полный VACUUM)')
+    maintenance_parser.add_argument('--force', action='store_true', help='vacuum и checkpoint даже при активной переписке')
+    maintenance_parser.add_argument('--max-pages', type=int, default=VACUUM_MAX_PAGES)
+    args = parser.parse_args()
+
+    database = Database(args.db, args.shards)
+    if args.command == 'init':
+        init(database)
+    elif args.command == 'shard':
+        if not database.shards:
+            parser.error('укажите число шардов: --shards N или MESSAGE_SHARDS')
+        shard(database, args.batch)
+    elif args.command == 'gc_uploads':
+        gc_uploads(database, args.grace, args.delete, args.batch)
+    elif args.command == 'fanout_uploads':
+        fanout_uploads(database, args.batch)
+    elif args.command == 'backup':
+        backup(database, args.out, not args.no_uploads, args.pages, args.pause)
+    elif args.command == 'backup_incremental':
+        try:
+            backup_incremental(database, args.out)
+        except RuntimeError as e:
+            parser.exit(1, f'{e}\n')
+    elif args.command == 'maintenance':
+        maintenance(database, args.convert, args.force, args.max_pages)
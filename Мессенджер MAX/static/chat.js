@@ -4,6 +4,15 @@ let lastMessageId = 0;
 let currentReceiverId = null;
 let isPolling = false;
 
+// Опрос с паузой: пустые ответы подряд удваивают ее (до POLL_MAX_MS),
+// но не чаще, чем просит сервер в next_poll_ms. В скрытой вкладке опроса нет.
+const POLL_BASE_MS = 2000;
+const POLL_MAX_MS = 30000;
+let pollTimer = null;
+let emptyPolls = 0;
+let serverPollMs = POLL_BASE_MS;
+let stickerCatalog = {};
+
 function scrollToBottom() {
     const container = document.getElementById('messages-container');
     if (container) {
@@ -24,69 +33,107 @@ function formatTime(timestamp) {
     return date.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
 }
 
-function loadNewMessages(receiverId) {
-    if (!receiverId || receiverId !== currentReceiverId || isPolling) {
+function appendMessage(container, msg) {
+    // Проверяем, есть ли уже такое сообщение
+    if (container.querySelector(`[data-message-id="${msg.id}"]`)) {
+        return false;
+    }
+    
+    const messageWrapper = document.createElement('div');
+    messageWrapper.className = 'message-wrapper ' + (msg.is_own ? 'own-message' : 'other-message');
+    messageWrapper.setAttribute('data-message-id', msg.id);
+    
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message ' + (msg.is_own ? 'own' : 'other');
+    
+    let content = '';
+    if (msg.message_type === 'image' && msg.file_path) {
+        content = `<div class="message-image"><img src="/uploads/${msg.file_path}" alt="Изображение" style="max-width: 300px; border-radius: 10px;"></div>`;
+    } else if (msg.message_type === 'sticker') {
+        const stickerId = String(msg.message).split(':').pop();
+        content = `<div class="message-sticker" data-sticker-id="${stickerId}">${msg.message}</div>`;
+    } else {
+        content = `<div class="message-text">${msg.message}</div>`;
+    }
+    
+    messageDiv.innerHTML = `
+        ${!msg.is_own ? `<div class="message-sender">${msg.sender_name}</div>` : ''}
+        <div class="message-content">${content}</div>
+        <div class="message-time">
+            ${formatTime(msg.timestamp)}
+            ${msg.is_own ? '<span class="read-status">✓</span>' : ''}
+        </div>
+    `;
+    
+    messageWrapper.appendChild(messageDiv);
+    container.appendChild(messageWrapper);
+    renderStickerMessages(messageWrapper);
+    
+    // Обновляем lastMessageId
+    if (msg.id > lastMessageId) {
+        lastMessageId = msg.id;
+    }
+    return true;
+}
+
+// Компактный формат check_updates: [id, sender_id, message_type, message, file_path, time],
+// имена отправителей приходят один раз в data.users
+function unpackMessage(row, data) {
+    return {
+        id: row[0],
+        sender_id: row[1],
+        message_type: row[2],
+        message: row[3],
+        file_path: row[4],
+        timestamp: row[5],
+        sender_name: data.users[row[1]],
+        is_own: row[1] === data.me
+    };
+}
+
+// Курсор /api/updates: id последнего учтенного входящего во всех диалогах
+// (с шардами - строка с id по каждому шарду), клиент передает его как есть
+let updatesSince = null;
+
+function loadUpdates() {
+    if (isPolling || updatesSince === null) {
         return;
     }
     
     isPolling = true;
     
-    fetch('/api/check_updates?receiver_id=' + receiverId + '&last_message_id=' + lastMessageId)
+    let url = '/api/updates?since=' + encodeURIComponent(updatesSince);
+    if (currentReceiverId) {
+        url += '&receiver_id=' + currentReceiverId;
+    }
+    
+    fetch(url)
         .then(function(response) {
+            if (response.status === 429) {
+                // Сервер просит подождать - ждем столько, сколько сказано в Retry-After
+                serverPollMs = (parseInt(response.headers.get('Retry-After')) || 5) * 1000;
+                throw new Error('rate limited');
+            }
             return response.json();
         })
         .then(function(data) {
-            if (data.new_messages && data.new_messages.length > 0) {
-                const container = document.getElementById('messages-container');
-                
+            serverPollMs = data.next_poll_ms || POLL_BASE_MS;
+            updatesSince = data.since;
+            
+            let hasNewMessages = false;
+            const container = document.getElementById('messages-container');
+            if (container && data.messages.length > 0) {
                 // Удаляем сообщение "Нет сообщений" если оно есть
                 const noMessages = container.querySelector('.no-messages');
                 if (noMessages) {
                     container.removeChild(noMessages);
                 }
                 
-                let hasNewMessages = false;
-                
-                data.new_messages.forEach(function(msg) {
-                    // Проверяем, есть ли уже такое сообщение
-                    const existingMsg = container.querySelector(`[data-message-id="${msg.id}"]`);
-                    if (existingMsg) {
-                        return; // Пропускаем уже существующие сообщения
-                    }
-                    
-                    hasNewMessages = true;
-                    
-                    const messageWrapper = document.createElement('div');
-                    messageWrapper.className = 'message-wrapper ' + (msg.is_own ? 'own-message' : 'other-message');
-                    messageWrapper.setAttribute('data-message-id', msg.id);
-                    
-                    const messageDiv = document.createElement('div');
-                    messageDiv.className = 'message ' + (msg.is_own ? 'own' : 'other');
-                    
-                    let content = '';
-                    if (msg.message_type === 'image' && msg.file_path) {
-                        content = `<div class="message-image"><img src="/uploads/${msg.file_path}" alt="Изображение" style="max-width: 300px; border-radius: 10px;"></div>`;
-                    } else if (msg.message_type === 'sticker') {
-                        content = `<div class="message-sticker">${msg.message}</div>`;
-                    } else {
-                        content = `<div class="message-text">${msg.message}</div>`;
-                    }
-                    
-                    messageDiv.innerHTML = `
-                        ${!msg.is_own ? `<div class="message-sender">${msg.sender_name}</div>` : ''}
-                        <div class="message-content">${content}</div>
-                        <div class="message-time">
-                            ${formatTime(msg.timestamp)}
-                            ${msg.is_own ? '<span class="read-status">✓</span>' : ''}
-                        </div>
-                    `;
-                    
-                    messageWrapper.appendChild(messageDiv);
-                    container.appendChild(messageWrapper);
-                    
-                    // Обновляем lastMessageId
-                    if (msg.id > lastMessageId) {
-                        lastMessageId = msg.id;
+                data.messages.forEach(function(row) {
+                    const msg = unpackMessage(row, data);
+                    if (appendMessage(container, msg)) {
+                        hasNewMessages = true;
+                        setPreview(currentReceiverId, msg.message, msg.is_own);
                     }
                 });
                 
@@ -95,19 +142,303 @@ function loadNewMessages(receiverId) {
                 }
             }
             
+            Object.keys(data.conversations).forEach(function(friendId) {
+                hasNewMessages = true;
+                applyConversationUpdate(friendId, data.conversations[friendId]);
+            });
+            
+            emptyPolls = hasNewMessages ? 0 : emptyPolls + 1;
+            
+            // Отметки о прочтении своих сообщений
+            if (data.read_up_to) {
+                updateReadReceipts(data.read_up_to);
+            }
+            
             // Обновляем статус пользователя
             if (data.user_status) {
                 updateUserStatus(data.user_status);
             }
             
+            if ('typing' in data) {
+                updateTypingIndicator(data.typing);
+            }
+            
             isPolling = false;
+            schedulePoll(nextPollDelay());
         })
         .catch(function(error) {
             console.error('Error:', error);
             isPolling = false;
+            emptyPolls++;
+            schedulePoll(nextPollDelay());
         });
 }
 
+function findFriendItem(friendId) {
+    return document.querySelector(`.friend-item[data-friend-id="${friendId}"]`);
+}
+
+function setPreview(friendId, text, isOwn) {
+    const item = findFriendItem(friendId);
+    if (!item) {
+        return null;
+    }
+    const preview = item.querySelector('.last-message');
+    text = String(text);
+    preview.textContent = (isOwn ? 'Вы: ' : '') + (text.length > 15 ? text.substring(0, 12) + '...' : text);
+    preview.hidden = false;
+    return item;
+}
+
+// Новые сообщения в другом диалоге: счетчик, превью и подъем наверх списка
+function applyConversationUpdate(friendId, update) {
+    const item = setPreview(friendId, update.preview, false);
+    if (!item) {
+        return; // Новый собеседник появится в списке после перезагрузки
+    }
+    const badge = item.querySelector('.unread-badge');
+    badge.textContent = (parseInt(badge.textContent) || 0) + update.unread_delta;
+    badge.hidden = false;
+    item.parentNode.prepend(item);
+}
+
+function nextPollDelay() {
+    const backoff = POLL_BASE_MS * Math.pow(2, Math.min(emptyPolls, 4));
+    return Math.min(Math.max(backoff, serverPollMs), POLL_MAX_MS);
+}
+
+function schedulePoll(delay) {
+    clearTimeout(pollTimer);
+    pollTimer = null;
+    if (document.hidden || updatesSince === null) {
+        return;
+    }
+    pollTimer = setTimeout(loadUpdates, delay);
+}
+
+// Пользователь что-то делает в чате - проверяем сразу и снова опрашиваем часто
+function pollNow() {
+    emptyPolls = 0;
+    if (!isPolling) {
+        loadUpdates();
+    }
+}
+
+// Каталог стикеров - статический JSON с хешем в URL, кэшируется браузером
+function loadStickerBundle() {
+    const panel = document.getElementById('sticker-panel');
+    if (!panel || !panel.dataset.bundleUrl) {
+        return;
+    }
+    
+    fetch(panel.dataset.bundleUrl)
+        .then(function(response) {
+            return response.json();
+        })
+        .then(function(data) {
+            data.stickers.forEach(function(sticker) {
+                stickerCatalog[sticker.id] = sticker;
+                
+                const button = document.createElement('button');
+                button.type = 'button';
+                button.className = 'sticker-item';
+                button.title = sticker.name;
+                button.textContent = sticker.emoji;
+                button.addEventListener('click', function() {
+                    sendSticker(sticker.id);
+                    panel.hidden = true;
+                });
+                panel.appendChild(button);
+            });
+            renderStickerMessages(document);
+        })
+        .catch(function(error) {
+            console.error('Error:', error);
+        });
+    
+    const toggle = document.getElementById('sticker-toggle');
+    if (toggle) {
+        toggle.addEventListener('click', function() {
+            panel.hidden = !panel.hidden;
+        });
+    }
+}
+
+function renderStickerMessages(root) {
+    root.querySelectorAll('.message-sticker[data-sticker-id]').forEach(function(element) {
+        const sticker = stickerCatalog[element.dataset.stickerId];
+        if (sticker) {
+            element.textContent = sticker.emoji;
+            element.title = sticker.name;
+        }
+    });
+}
+
+// "печатает..." - сервер держит отметку в памяти несколько секунд, поэтому
+// достаточно напоминать о себе раз в TYPING_INTERVAL_MS, а не на каждую клавишу
+const TYPING_INTERVAL_MS = 3000;
+let lastTypingSent = 0;
+
+function notifyTyping() {
+    const now = Date.now();
+    if (!currentReceiverId || now - lastTypingSent < TYPING_INTERVAL_MS) {
+        return;
+    }
+    lastTypingSent = now;
+    const formData = new FormData();
+    formData.append('receiver_id', currentReceiverId);
+    fetch('/api/typing', { method: 'POST', body: formData })
+        .catch(function(error) {
+            console.error('Error:', error);
+        });
+}
+
+function updateTypingIndicator(typing) {
+    const indicator = document.getElementById('typing-indicator');
+    if (indicator) {
+        indicator.hidden = !typing;
+    }
+}
+
+// Отправка без перезагрузки страницы: сервер отвечает JSON с самим сообщением
+function postMessage(formData) {
+    return fetch('/send_message', {
+        method: 'POST',
+        body: formData,
+        headers: { 'Accept': 'application/json' }
+    })
+        .then(function(response) {
+            return response.json();
+        })
+        .then(function(data) {
+            if (data.success) {
+                showSentMessage(data.message);
+            }
+            return data;
+        });
+}
+
+function showSentMessage(message) {
+    const container = document.getElementById('messages-container');
+    const noMessages = container.querySelector('.no-messages');
+    if (noMessages) {
+        container.removeChild(noMessages);
+    }
+    appendMessage(container, message);
+    setPreview(currentReceiverId, message.message, true);
+    scrollToBottom();
+    emptyPolls = 0;
+    schedulePoll(nextPollDelay());
+}
+
+function sendImage(file) {
+    // Изображения больше порога (chunked_upload.CHUNKED_THRESHOLD) уходят частями:
+    // после обрыва связи отправка продолжается с принятого сервером места, а не с начала
+    const threshold = parseInt(document.querySelector('.chat-container').dataset.chunkedThreshold);
+    if (file.size <= threshold) {
+        const formData = new FormData();
+        formData.append('receiver_id', currentReceiverId);
+        formData.append('image', file);
+        return postMessage(formData);
+    }
+    return uploadChunked(file, currentReceiverId).then(function(data) {
+        showSentMessage(data.message);
+        return data;
+    });
+}
+
+function uploadJson(url, options) {
+    return fetch(url, options).then(function(response) {
+        return response.json().then(function(data) {
+            data.status = response.status;
+            return data;
+        });
+    });
+}
+
+function uploadChunked(file, receiverId) {
+    let uploadId, chunkSize;
+    let failures = 0;
+    
+    function sendFrom(offset) {
+        if (offset >= file.size) {
+            return uploadJson('/api/uploads/' + uploadId + '/finalize', { method: 'POST' });
+        }
+        return uploadJson('/api/uploads/' + uploadId + '?offset=' + offset, {
+            method: 'PUT',
+            body: file.slice(offset, offset + chunkSize)
+        }).then(function(data) {
+            if (data.success) {
+                failures = 0;
+                return sendFrom(data.offset);
+            }
+            if (data.status !== 409 && data.status !== 429) {
+                throw new Error(data.error);
+            }
+            return resume(data.error);
+        }, function(error) {
+            return resume(error.message);
+        });
+    }
+    
+    // Обрыв или рассинхронизация - спрашиваем, сколько сервер уже принял, и продолжаем оттуда
+    function resume(reason) {
+        failures++;
+        if (failures > 5) {
+            throw new Error(reason);
+        }
+        return new Promise(function(resolve) {
+            setTimeout(resolve, 1000 * failures);
+        }).then(function() {
+            return uploadJson('/api/uploads/' + uploadId);
+        }).then(function(data) {
+            return sendFrom(data.offset);
+        }, function(error) {
+            return resume(error.message);
+        });
+    }
+    
+    return uploadJson('/api/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ receiver_id: receiverId, filename: file.name, size: file.size })
+    }).then(function(data) {
+        if (!data.success) {
+            throw new Error(data.error);
+        }
+        uploadId = data.upload_id;
+        chunkSize = data.chunk_size;
+        return sendFrom(0);
+    }).then(function(data) {
+        if (!data.success) {
+            throw new Error(data.error);
+        }
+        return data;
+    });
+}
+
+function sendSticker(stickerId) {
+    const formData = new FormData();
+    formData.append('receiver_id', currentReceiverId);
+    formData.append('sticker_id', stickerId);
+    
+    postMessage(formData)
+        .catch(function(error) {
+            console.error('Error:', error);
+        });
+}
+
+function updateReadReceipts(readUpTo) {
+    document.querySelectorAll('.own-message[data-message-id]').forEach(function(wrapper) {
+        const status = wrapper.querySelector('.read-status');
+        if (status && !status.classList.contains('read') &&
+                parseInt(wrapper.getAttribute('data-message-id')) <= readUpTo) {
+            status.classList.add('read');
+            status.textContent = '✓✓';
+        }
+    });
+}
+
 function updateUserStatus(status) {
     const statusBadge = document.getElementById('partner-status-badge');
     const statusText = document.getElementById('partner-status-text');
@@ -166,15 +497,33 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    if (receiverId) {
-        currentReceiverId = receiverId;
+    // Один опрос /api/updates обновляет и открытый диалог, и весь список диалогов
+    const friendsList = document.querySelector('.friends-list[data-since]');
+    if (friendsList) {
+        updatesSince = friendsList.dataset.since;
+        
+        schedulePoll(POLL_BASE_MS);
         
-        // Проверяем новые сообщения каждые 3 секунды
-        const checkInterval = setInterval(function() {
-            if (currentReceiverId === receiverId && !isPolling) {
-                loadNewMessages(receiverId);
+        // Скрытая вкладка не опрашивает сервер, при возврате - сразу проверка
+        document.addEventListener('visibilitychange', function() {
+            if (document.hidden) {
+                clearTimeout(pollTimer);
+                pollTimer = null;
+            } else {
+                pollNow();
             }
-        }, 3000);
+        });
+        window.addEventListener('focus', pollNow);
+        
+        // При смене страницы останавливаем polling
+        window.addEventListener('beforeunload', function() {
+            clearTimeout(pollTimer);
+        });
+    }
+    
+    if (receiverId) {
+        currentReceiverId = receiverId;
+        loadStickerBundle();
         
         // Фокус на поле ввода
         const messageInput = document.getElementById('message-input');
@@ -184,6 +533,43 @@ document.addEventListener('DOMContentLoaded', function() {
             // Отправка формы по Enter (но Shift+Enter для новой строки)
             const messageForm = document.getElementById('message-form');
             if (messageForm) {
+                messageForm.addEventListener('submit', function(e) {
+                    e.preventDefault();
+                    if (!messageInput.value.trim()) {
+                        return;
+                    }
+                    const formData = new FormData(messageForm);
+                    const text = messageInput.value;
+                    messageInput.value = '';
+                    lastTypingSent = 0;
+                    postMessage(formData)
+                        .catch(function(error) {
+                            // Не получилось - отправляем обычной формой
+                            console.error('Error:', error);
+                            messageInput.value = text;
+                            messageForm.submit();
+                        });
+                });
+                
+                messageInput.addEventListener('input', notifyTyping);
+                
+                const imageInput = document.getElementById('image-input');
+                if (imageInput) {
+                    imageInput.addEventListener('change', function() {
+                        const file = imageInput.files[0];
+                        if (!file) {
+                            return;
+                        }
+                        sendImage(file)
+                            .catch(function(error) {
+                                alert('Не удалось отправить изображение: ' + error.message);
+                            })
+                            .then(function() {
+                                imageInput.value = '';
+                            });
+                    });
+                }
+                
                 messageInput.addEventListener('keydown', function(e) {
                     if (e.key === 'Enter' && !e.shiftKey) {
                         e.preventDefault();
@@ -192,15 +578,14 @@ document.addEventListener('DOMContentLoaded', function() {
                 });
             }
         }
-        
-        // При смене страницы останавливаем polling
-        window.addEventListener('beforeunload', function() {
-            clearInterval(checkInterval);
-        });
     }
     
     // Обновляем статус каждую минуту
-    setInterval(updateOnlineStatus, 60000);
+    setInterval(function() {
+        if (!document.hidden) {
+            updateOnlineStatus();
+        }
+    }, 60000);
     
     // При переходе на другой чат
     document.querySelectorAll('.friend-item').forEach(item => {
@@ -0,0 +1,59 @@
+import hashlib
+import json
+import threading
+import time
+
+
+class StickerBundle:
+    """Каталог стикеров, собранный один раз в JSON с хешем содержимого в имени.
+
+    Страницы чата ссылаются на /stickers/<version>.json, а сам файл отдается из
+    памяти с immutable-кэшированием - браузер скачивает его один раз на версию,
+    а рендер страницы не делает ни одного запроса к таблице stickers.
+
+    Новый стикер меняет хеш, т.е. и URL. Свой процесс пересобирает бандл сразу
+    через invalidate(), а остальные процессы замечают изменение по дешевой
+    проверке MAX(id)/COUNT(*) не чаще раза в recheck_interval секунд.
+    """
+
+    def __init__(self, db, recheck_interval=300):
+        self.db = db
+        self.recheck_interval = recheck_interval
+        self.version = None
+        self.payload = None
+        self.stickers = None
+        self._fingerprint = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _fingerprint_now(self):
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT MAX(id), COUNT(*) FROM stickers')
+        fingerprint = cursor.fetchone()
+        conn.close()
+        return fingerprint
+
+    def build(self):
+        with self._lock:
+            fingerprint = self._fingerprint_now()
+            stickers = self.db.get_stickers()
+            payload = json.dumps({'stickers': stickers}, ensure_ascii=False, separators=(',', ':')).encode()
+            self.stickers = stickers
+            self.payload = payload
+            self.version = hashlib.sha256(payload).hexdigest()[:12]
+            self._fingerprint = fingerprint
+            self._checked_at = time.monotonic()
+
+    def invalidate(self):
+        self.version = None
+
+    def current(self):
+        """Возвращает актуальную версию, пересобирая бандл при необходимости."""
+        if self.version is None:
+            self.build()
+        elif time.monotonic() - self._checked_at > self.recheck_interval:
+            self._checked_at = time.monotonic()
+            if self._fingerprint_now() != self._fingerprint:
+                self.build()
+        return self.version
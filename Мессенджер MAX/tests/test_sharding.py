@@ -0,0 +1,91 @@
+"""Шарды сообщений: id сообщения определяет шард и не повторяется между шардами.
+
+    python -m unittest discover -s tests -v      (из папки "Мессенджер MAX")
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from database import Database
+
+SHARDS = 3
+
+
+def close_writers(db):
+    for writer in [db._writer, *db._shard_writers.values()]:
+        if writer is not None:
+            writer.close()
+
+
+class ShardIdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, 'messenger.db')
+        self.databases = []
+
+    def tearDown(self):
+        for db in self.databases:
+            close_writers(db)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open(self, shards):
+        db = Database(self.db_path, shards=shards)
+        db.init_db()
+        self.databases.append(db)
+        return db
+
+    def assert_congruent(self, db, pairs_and_ids):
+        for (sender_id, receiver_id), message_id in pairs_and_ids:
+            shard = db.shard_of(sender_id, receiver_id)
+            self.assertEqual(message_id % SHARDS, (shard + 1) % SHARDS,
+                             f'сообщение {message_id} диалога {sender_id}-{receiver_id} из шарда {shard}')
+
+    def test_ids_match_shard_and_do_not_collide(self):
+        db = self.open(SHARDS)
+        pairs = [(sender_id, receiver_id) for sender_id in range(1, 6) for receiver_id in range(1, 6)
+                 if sender_id != receiver_id]
+        self.assertEqual(len({db.shard_of(*pair) for pair in pairs}), SHARDS)
+
+        sent = []
+        for round_number in range(3):
+            for sender_id, receiver_id in pairs:
+                message_id = db.save_message(sender_id, receiver_id, f'{round_number}: {sender_id}->{receiver_id}')
+                sent.append(((sender_id, receiver_id), message_id))
+        for sender_id in range(1, 6):
+            items = [(receiver_id, f'рассылка {receiver_id}') for receiver_id in range(1, 6) if receiver_id != sender_id]
+            ids = db.save_messages_bulk(sender_id, items * 2)
+            sent.extend(((sender_id, receiver_id), message_id) for (receiver_id, _), message_id in zip(items * 2, ids))
+
+        self.assert_congruent(db, sent)
+        ids = [message_id for _, message_id in sent]
+        self.assertEqual(len(set(ids)), len(ids))
+
+        # В каждом шарде лежат только сообщения своих диалогов
+        for shard, name in enumerate(db.shard_names):
+            conn = db.connect(name)
+            rows = conn.execute('SELECT id, sender_id, receiver_id FROM messages').fetchall()
+            conn.close()
+            for message_id, sender_id, receiver_id in rows:
+                self.assertEqual(db.shard_of(sender_id, receiver_id), shard)
+
+    def test_ids_start_above_unsharded_messages(self):
+        # Сообщения, записанные до включения шардов, остаются ниже id_floor
+        plain = self.open(0)
+        old_ids = [plain.save_message(1, 2, f'старое {i}') for i in range(7)]
+        close_writers(plain)
+
+        db = self.open(SHARDS)
+        new = [((1, 2), db.save_message(1, 2, 'новое')), ((2, 3), db.save_message(2, 3, 'новое')),
+               ((3, 4), db.save_message(3, 4, 'новое'))]
+        self.assert_congruent(db, new)
+        self.assertGreater(min(message_id for _, message_id in new), max(old_ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
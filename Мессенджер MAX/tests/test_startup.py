@@ -0,0 +1,110 @@
+"""Замер запуска воркера: холодный импорт app.py и первый запрос.
+
+Каждый замер - отдельный процесс python, как новый воркер gunicorn.
+Первый процесс только пишет __pycache__ и не учитывается: в рабочей
+установке байткод уже лежит на диске.
+
+    python -m unittest discover -s tests -v      (из папки "Мессенджер MAX")
+
+Число запусков и пороги задаются переменными окружения STARTUP_RUNS,
+STARTUP_IMPORT_BUDGET_MS и STARTUP_FIRST_REQUEST_BUDGET_MS. Пороги
+с большим запасом: тест ловит возврат работы со схемой в импорт
+(десятки DDL и fsync на каждый воркер), а не шум в миллисекундах.
+"""
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import unittest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from database import SCHEMA_VERSION, Database
+
+RUNS = int(os.environ.get('STARTUP_RUNS', 7))
+IMPORT_BUDGET_MS = float(os.environ.get('STARTUP_IMPORT_BUDGET_MS', 1000))
+FIRST_REQUEST_BUDGET_MS = float(os.environ.get('STARTUP_FIRST_REQUEST_BUDGET_MS', 250))
+
+# Выполняется в новом процессе; печатает одну строку JSON
+BOOT_SCRIPT = r'''
+import json, os, sqlite3, sys, time
+db_path, staging = sys.argv[1], sys.argv[2]
+started = time.perf_counter()
+import app
+import_ms = (time.perf_counter() - started) * 1000
+application = app.create_app({'DATABASE': db_path, 'UPLOAD_STAGING': staging, 'RATE_LIMITS': {},
+                              'EXPIRY_SWEEP_INTERVAL': 0, 'MAINTENANCE_INTERVAL': 0})
+boot_ms = (time.perf_counter() - started) * 1000
+# До первого запроса база не должна быть даже открыта
+db_touched = os.path.exists(db_path)
+client = application.test_client()
+started = time.perf_counter()
+status = client.get('/login').status_code
+first_ms = (time.perf_counter() - started) * 1000
+started = time.perf_counter()
+client.get('/login')
+second_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({'import_ms': import_ms, 'boot_ms': boot_ms, 'first_ms': first_ms, 'second_ms': second_ms,
+                  'status': status, 'db_touched': db_touched,
+                  'schema_ready': application.extensions['messenger_db']._schema_ready}))
+'''
+
+
+def boot(db_path, staging):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    result = subprocess.run([sys.executable, '-c', BOOT_SCRIPT, db_path, staging], cwd=APP_DIR, env=env,
+                            capture_output=True, text=True, timeout=60)
+    if result.returncode:
+        raise AssertionError(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+class StartupTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.db_path = os.path.join(cls.directory, 'messenger.db')
+        cls.staging = os.path.join(cls.directory, 'upload_staging')
+        # Схему заранее создает `python manage.py init`, а не воркер
+        Database(cls.db_path).init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def test_boot_does_not_open_database(self):
+        missing = os.path.join(self.directory, 'not_created.db')
+        result = boot(missing, self.staging)
+        # Импорт и create_app не трогают базу: файл появился бы только от init_db
+        self.assertFalse(result['db_touched'])
+
+    def test_cold_start_benchmark(self):
+        boot(self.db_path, self.staging)  # пишет __pycache__
+        runs = [boot(self.db_path, self.staging) for _ in range(RUNS)]
+        for result in runs:
+            self.assertEqual(result['status'], 200)
+            self.assertTrue(result['schema_ready'])
+        report = {key: round(statistics.median(run[key] for run in runs), 1)
+                  for key in ('import_ms', 'boot_ms', 'first_ms', 'second_ms')}
+        print(f"\nзапуск воркера, медиана {RUNS} процессов: импорт {report['import_ms']} мс, "
+              f"импорт + create_app {report['boot_ms']} мс, первый запрос {report['first_ms']} мс, "
+              f"второй {report['second_ms']} мс")
+        self.assertLess(report['import_ms'], IMPORT_BUDGET_MS)
+        self.assertLess(report['first_ms'], FIRST_REQUEST_BUDGET_MS)
+
+    def test_first_request_skips_init_for_current_schema(self):
+        result = boot(self.db_path, self.staging)
+        self.assertTrue(result['schema_ready'])
+        conn = Database(self.db_path).connect()
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,22 +3,22 @@ import sqlite3
 import random
 import string
 import os
+import sys
 from werkzeug.security import generate_password_hash, check_password_hash
-from cryptography.fernet import Fernet
-
-app = Flask(__name__)
-# Для локальной разработки используем простой ключ
-app.secret_key = 'local_secret_key_2025'
-
-# Ключ для шифрования (Fernet требует 32 байта в base64)
-# ВАЖНО: Если вы его измените, старые сообщения в базе не прочитаются!
-ENCRYPTION_KEY = b'uX6-f1vE0zP_kYQ-jD2pL_9a_N3b_C4d_E5f_G6h_I7='
-cipher = Fernet(ENCRYPTION_KEY)
 
 # Локальный путь к базе данных
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE = os.path.join(BASE_DIR, 'data1.db')
 
+# Модуль шифрования общий с основным приложением (лежит уровнем выше)
+sys.path.append(os.path.dirname(BASE_DIR))
+from encryption import encrypt_text as keyring_encrypt, decrypt_legacy
+from reencrypt import start_worker
+
+app = Flask(__name__)
+# Для локальной разработки используем простой ключ
+app.secret_key = 'local_secret_key_2025'
+
 def get_db():
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
@@ -36,7 +36,12 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         room_id INTEGER NOT NULL, username TEXT NOT NULL,
-        text TEXT NOT NULL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+        text TEXT NOT NULL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        key_version INTEGER DEFAULT 1)''')
+    try:
+        c.execute('ALTER TABLE messages ADD COLUMN key_version INTEGER DEFAULT 1')
+    except sqlite3.OperationalError:
+        pass
     c.execute('''CREATE TABLE IF NOT EXISTS online_users (
         room_id INTEGER, username TEXT, last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
         PRIMARY KEY (room_id, username))''')
@@ -48,11 +53,12 @@ init_db()
 
 # --- ЛОГИКА ШИФРОВАНИЯ ---
 def encrypt_text(text):
-    return cipher.encrypt(text.encode()).decode()
+    """Возвращает (токен, версия ключа)."""
+    return keyring_encrypt(text)
 
-def decrypt_text(encrypted_text):
+def decrypt_text(encrypted_text, key_version=None):
     try:
-        return cipher.decrypt(encrypted_text.encode()).decode()
+        return decrypt_legacy(encrypted_text, key_version)
     except:
         return "[Ошибка расшифровки]"
 
@@ -129,13 +135,13 @@ def get_messages(room_id):
     conn = get_db()
     conn.execute('REPLACE INTO online_users (room_id, username) VALUES (?, ?)', (room_id, session['username']))
     conn.commit()
-    rows = conn.execute('SELECT username, text, strftime("%H:%M", timestamp) as time FROM messages WHERE room_id = ? ORDER BY timestamp ASC', (room_id,)).fetchall()
+    rows = conn.execute('SELECT username, text, key_version, strftime("%H:%M", timestamp) as time FROM messages WHERE room_id = ? ORDER BY timestamp ASC', (room_id,)).fetchall()
     users_rows = conn.execute('SELECT username FROM online_users WHERE room_id = ?', (room_id,)).fetchall()
     conn.close()
 
     messages = []
     for r in rows:
-        messages.append({'username': r['username'], 'text': decrypt_text(r['text']), 'time': r['time']})
+        messages.append({'username': r['username'], 'text': decrypt_text(r['text'], r['key_version']), 'time': r['time']})
 
     return jsonify({
         'messages': messages,
@@ -146,9 +152,9 @@ def get_messages(room_id):
 def send_message():
     data = request.json
     if not data or not data.get('text'): return jsonify({'status': 'error'})
-    encrypted = encrypt_text(data['text'])
+    encrypted, key_version = encrypt_text(data['text'])
     conn = get_db()
-    conn.execute('INSERT INTO messages (room_id, username, text) VALUES (?, ?, ?)', (data['room_id'], session['username'], encrypted))
+    conn.execute('INSERT INTO messages (room_id, username, text, key_version) VALUES (?, ?, ?, ?)', (data['room_id'], session['username'], encrypted, key_version))
     conn.commit()
     conn.close()
     return jsonify({'status': 'ok'})
@@ -160,5 +166,7 @@ def logout():
 
 # --- ИЗМЕНЕНИЕ ДЛЯ ЛОКАЛЬНОГО ЗАПУСКА ---
 if __name__ == '__main__':
+    # Сообщения со старой версией ключа перешифровываются в фоне
+    start_worker(DATABASE, columns=('text',))
     # debug=True позволит серверу перезагружаться при изменении кода
     app.run(host='127.0.0.1', port=5000, debug=True)
\ No newline at end of file